@@ -0,0 +1,103 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from model_evaluation import FaissKNeighbors, majority_vote, evaluation_dir
+
+# ==PARAMETERS==:
+# Embedding sizes: merged (1280) and concatenated 3-channel (3840) features
+num_features_list = (1280, 3840)
+num_samples = 20000
+num_queries = 2000
+num_classes = 50
+k = 11
+metric = 'cosine'
+
+# Index specifications to compare against exact search
+index_specs = [
+    {'index': 'flat'},
+    {'index': 'ivf', 'nprobe': 1},
+    {'index': 'ivf', 'nprobe': 8},
+    {'index': 'ivf', 'nprobe': 32},
+    {'index': 'hnsw', 'ef_search': 64},
+    {'index': 'hnsw', 'ef_search': 256},
+    {'index': 'ivfpq', 'nprobe': 16, 'pq_m': 16},
+    {'index': 'ivfpq', 'nprobe': 16, 'pq_m': 64},
+]
+
+
+def simulate_embeddings(num_samples: int, num_features: int,
+                        num_classes: int, seed: int = 0) -> tuple:
+    """Return tuple of (standardized embeddings, labels) for <num_samples>
+    embeddings drawn around <num_classes> cluster centers.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(num_classes, num_features))
+    labels = rng.integers(0, num_classes, num_samples)
+    X = centers[labels] + 4 * rng.normal(size=(num_samples, num_features))
+    X = (X - X.mean(axis=0)) / X.std(axis=0)
+    return X.astype(np.float32), labels
+
+
+def benchmark_index(X_train, y_train, X_query, exact_ind, exact_pred,
+                    index_spec: dict) -> dict:
+    """Return dictionary of build time, queries per second, recall@k and
+    agreement of majority-vote predictions with exact search, for index
+    specified by <index_spec>.
+    """
+    knn_model = FaissKNeighbors(k=k, metric=metric, **index_spec)
+
+    start = time.perf_counter()
+    knn_model.fit(X_train, y_train)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, ind = knn_model.kneighbors(X_query, n_neighbors=k)
+    search_time = time.perf_counter() - start
+
+    # Fraction of exact k nearest neighbours that are found
+    recall = np.mean([len(np.intersect1d(ind[i], exact_ind[i])) / k
+                      for i in range(len(ind))])
+    # Missing neighbours are returned as -1
+    ind = np.where(ind < 0, exact_ind, ind)
+    pred = majority_vote(y_train[ind], num_classes)
+
+    return {**index_spec,
+            'build_time': build_time,
+            'qps': len(X_query) / search_time,
+            f'recall@{k}': recall,
+            'prediction_agreement': np.mean(pred == exact_pred)}
+
+
+def main():
+    accum = []
+    for num_features in num_features_list:
+        X, y = simulate_embeddings(num_samples + num_queries, num_features,
+                                   num_classes)
+        X_train, y_train = X[:num_samples], y[:num_samples]
+        X_query = X[num_samples:]
+
+        # Exact search as reference
+        exact_model = FaissKNeighbors(k=k, metric=metric, index='flat')
+        exact_model.fit(X_train, y_train)
+        _, exact_ind = exact_model.kneighbors(X_query, n_neighbors=k)
+        exact_pred = majority_vote(y_train[exact_ind], num_classes)
+
+        for index_spec in index_specs:
+            results = benchmark_index(X_train, y_train, X_query, exact_ind,
+                                      exact_pred, index_spec)
+            results['num_features'] = num_features
+            print(results)
+            accum.append(results)
+
+    df_results = pd.DataFrame(accum)
+    if not os.path.exists(evaluation_dir):
+        os.makedirs(evaluation_dir)
+    df_results.to_csv(f"{evaluation_dir}knn_index_benchmark.csv", index=False)
+    print(df_results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import datetime
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from model_pretraining import create_image_dataset, create_model, model_dir
+
+# ==PARAMETERS==:
+# Generated images, similar in size and content to CytoImageNet images
+image_dir = os.path.join(tempfile.gettempdir(), 'cytoimagenet_benchmark')
+num_images = 512
+image_size = (520, 696)
+num_classes = 894
+
+# Sweep of batch sizes and parallel decode workers
+batch_sizes = (16, 32, 64)
+num_workers_list = (1, 2, 4, 8, tf.data.experimental.AUTOTUNE)
+channels = 1                # 1 for grayscale input, 3 for RGB
+augment = True
+
+# Number of batches to time, after warm-up batches
+num_steps = 20
+num_warmup = 3
+
+report_path = f"{model_dir}benchmarks/pretraining_throughput.json"
+
+
+def generate_images(out_dir: str = image_dir, n: int = num_images,
+                    size=image_size, seed: int = 0) -> list:
+    """Return paths to <n> grayscale PNG images of <size> in <out_dir>,
+    generating those that don't exist. Images are smooth random textures, so
+    they compress (and decode) like microscopy images rather than noise.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(n):
+        path = f"{out_dir}/image_{i:05d}.png"
+        # Draw texture for every image, so images don't depend on which exist
+        texture = rng.integers(0, 256, (size[0] // 16, size[1] // 16),
+                               dtype=np.uint8)
+        if not os.path.exists(path):
+            img = Image.fromarray(texture).resize((size[1], size[0]),
+                                                  Image.BILINEAR)
+            img.save(path)
+        paths.append(path)
+    return paths
+
+
+def time_steps(step, num_steps: int = num_steps,
+               num_warmup: int = num_warmup) -> float:
+    """Return seconds taken by <num_steps> calls of <step>, after
+    <num_warmup> calls.
+    """
+    for _ in range(num_warmup):
+        step()
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        step()
+    return time.perf_counter() - start
+
+
+def benchmark_pipeline(paths: list, batch_size: int, num_workers) -> float:
+    """Return images/sec of the input pipeline alone (decode, augment,
+    batch).
+    """
+    ds = create_image_dataset(paths, np.zeros(len(paths), dtype=np.int32),
+                              num_classes, batch_size, augment, True,
+                              channels, num_parallel_calls=num_workers)
+    iterator = iter(ds)
+    seconds = time_steps(lambda: next(iterator))
+    return num_steps * batch_size / seconds
+
+
+def benchmark_model(model: tf.keras.Model, batch_size: int) -> float:
+    """Return images/sec of the model train step alone, on synthetic
+    tensors.
+    """
+    imgs = tf.random.uniform((batch_size, 224, 224, channels), maxval=255)
+    labels = tf.one_hot(tf.zeros(batch_size, dtype=tf.int32), num_classes)
+    seconds = time_steps(lambda: model.train_on_batch(imgs, labels))
+    return num_steps * batch_size / seconds
+
+
+def benchmark_combined(model: tf.keras.Model, paths: list, batch_size: int,
+                       num_workers) -> float:
+    """Return images/sec of the model train step fed by the input pipeline.
+    """
+    ds = create_image_dataset(paths, np.zeros(len(paths), dtype=np.int32),
+                              num_classes, batch_size, augment, True,
+                              channels, num_parallel_calls=num_workers)
+    iterator = iter(ds)
+    seconds = time_steps(lambda: model.train_on_batch(*next(iterator)))
+    return num_steps * batch_size / seconds
+
+
+def main():
+    paths = generate_images()
+
+    model = create_model(num_classes, channels=channels)
+    model.compile(tf.keras.optimizers.Adam(), loss="categorical_crossentropy")
+
+    accum = []
+    for batch_size in batch_sizes:
+        model_ips = benchmark_model(model, batch_size)
+        accum.append({'case': 'model', 'batch_size': batch_size,
+                      'num_workers': None, 'images_per_second': model_ips})
+        print(accum[-1])
+        for num_workers in num_workers_list:
+            pipeline_ips = benchmark_pipeline(paths, batch_size, num_workers)
+            combined_ips = benchmark_combined(model, paths, batch_size,
+                                              num_workers)
+            workers = 'autotune' if num_workers == \
+                tf.data.experimental.AUTOTUNE else num_workers
+            accum.append({'case': 'pipeline', 'batch_size': batch_size,
+                          'num_workers': workers,
+                          'images_per_second': pipeline_ips})
+            accum.append({'case': 'combined', 'batch_size': batch_size,
+                          'num_workers': workers,
+                          'images_per_second': combined_ips,
+                          'bound': 'input' if pipeline_ips < model_ips
+                          else 'compute'})
+            print(accum[-2])
+            print(accum[-1])
+
+    report = {'time': datetime.datetime.now().isoformat(),
+              'cpu_count': os.cpu_count(),
+              'gpus': [gpu.name for gpu in
+                       tf.config.list_physical_devices('GPU')],
+              'tensorflow': tf.__version__,
+              'image_size': image_size, 'num_images': len(paths),
+              'channels': channels, 'augment': augment,
+              'num_steps': num_steps, 'num_warmup': num_warmup,
+              'results': accum}
+    if not os.path.exists(os.path.dirname(report_path)):
+        os.makedirs(os.path.dirname(report_path))
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved report to {report_path}")
+
+
+if __name__ == "__main__":
+    main()
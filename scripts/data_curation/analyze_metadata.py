@@ -21,10 +21,114 @@ else:
     data_dir = 'M:/ferrero/stan_data/'
     plot_dir = "/figures/classes/"
 
+# Columnar store of all clean metadata
+metadata_store_path = f"{annotations_dir}clean_metadata.ftr"
 
-def get_df_metadata() -> pd.DataFrame:
+# Metadata store loaded in this process
+loaded_store = {}
+
+
+def get_metadata_sources() -> dict:
+    """Return dictionary of path to [size, modification time] for all
+    *_metadata.csv in annotations/clean/.
+    """
+    files = sorted(glob.glob(f"{annotations_dir}clean/*_metadata.csv"))
+    return {file: [os.stat(file).st_size, os.stat(file).st_mtime]
+            for file in files}
+
+
+def get_metadata_store_info():
+    """Return dictionary of source files ('sources') and columns ('columns')
+    of the compiled metadata store, or None if not compiled.
+    """
+    if not os.path.exists(metadata_store_path) or \
+            not os.path.exists(f"{metadata_store_path}.json"):
+        return None
+    with open(f"{metadata_store_path}.json") as f:
+        return json.load(f)
+
+
+def metadata_store_is_stale() -> bool:
+    """Return True if the metadata store doesn't exist, or if the source
+    CSV files were added, removed or modified since it was compiled.
+    """
+    info = get_metadata_store_info()
+    return info is None or info['sources'] != get_metadata_sources()
+
+
+def to_store_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Return copy of <df> with dtypes that can be saved as Feather.
+
+    Object columns are cast to strings (keeping NaN), since CSV columns can
+    mix strings and numbers. Columns of strings are saved as categoricals
+    (dictionary-encoded) if at most half of their values are unique.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_object_dtype(df[col]):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        if pd.api.types.is_object_dtype(df[col]) or \
+                pd.api.types.is_string_dtype(df[col]):
+            if df[col].nunique() <= len(df) // 2:
+                df[col] = df[col].astype('category')
+    return df
+
+
+def compile_metadata_store(overwrite: bool = False) -> None:
+    """Compile all *_metadata.csv in annotations/clean/ into one Feather
+    file, with dtypes given by to_store_dtypes. Only compiled if stale,
+    unless <overwrite>.
+
+    Source files with their sizes and modification times are saved alongside,
+    to check staleness.
+    """
+    if not overwrite and not metadata_store_is_stale():
+        return
+    sources = get_metadata_sources()
+    df = to_store_dtypes(get_df_metadata_csv().reset_index(drop=True))
+
+    # Atomically save store, then its sources
+    df.to_feather(f"{metadata_store_path}.tmp")
+    os.replace(f"{metadata_store_path}.tmp", metadata_store_path)
+    with open(f"{metadata_store_path}.json.tmp", 'w') as f:
+        json.dump({'sources': sources, 'columns': list(df.columns)}, f)
+    os.replace(f"{metadata_store_path}.json.tmp",
+               f"{metadata_store_path}.json")
+    loaded_store.clear()
+
+
+def get_df_metadata(columns=None, categorical=False) -> pd.DataFrame:
     """Return dataframe containing reference to all *_metadata.csv
     in /home/stan/cytoimagenet/annotations/clean/
+
+    Read from the compiled metadata store (compiled again if stale). Only
+    <columns> are loaded, if specified. Loaded columns are kept for the rest
+    of the process. Rows are numbered 0 to n-1 across all files.
+
+    If <categorical>, columns with repeated strings are returned as
+    categoricals. Otherwise, they are returned as strings, like the CSV files.
+    NOTE: Group by categoricals with observed=True.
+    """
+    if metadata_store_is_stale():
+        compile_metadata_store()
+    if columns is None:
+        columns = get_metadata_store_info()['columns']
+    missing = [col for col in columns if col not in loaded_store]
+    if missing:
+        df_store = pd.read_feather(metadata_store_path, columns=missing)
+        loaded_store.update({col: df_store[col] for col in missing})
+
+    df = pd.DataFrame({col: loaded_store[col].copy() for col in columns})
+    if not categorical:
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].astype(df[col].cat.categories.dtype)
+    return df
+
+
+def get_df_metadata_csv() -> pd.DataFrame:
+    """Return dataframe containing reference to all *_metadata.csv
+    in /home/stan/cytoimagenet/annotations/clean/, read from the CSV files.
     """
     # return dd.read_csv(f"{annotations_dir}clean/*_metadata.csv",
     #                    dtype={"organism": "object",
@@ -430,6 +534,8 @@ def supp_existing_labels_with_unused(labels):
                 used_indices = json.load(f)
                 print("Length Used Indices: ", len(used_indices))
         # Perform supplement in parallel. May lead to race conditions. Recheck later for duplicates
+        # Load metadata once, shared by forked workers
+        get_df_metadata(categorical=True)
         pool = Pool(20)
         updated_indices = pool.map(supplement_existing_label, labels[:data_cut])
         pool.close()
@@ -468,8 +574,8 @@ def supplement_existing_label(label):
     """
     WARNING: Multiprocessing may lead to race conditions.
     """
-    # Get metadata dataframe
-    df = get_df_metadata()
+    # Get metadata dataframe. Categorical, to only search unique values
+    df = get_df_metadata(categorical=True)
     # Load in used_indices if available
     if os.path.exists(f"{annotations_dir}classes/used_images.json"):
         with open(f"{annotations_dir}classes/used_images.json") as f:
@@ -488,7 +594,7 @@ def supplement_existing_label(label):
     col = df_counts.loc[(df_counts.label == label), "category"].iloc[0]
     # Filter metadata dataframe for unused images
     remove_used = ~df["idx"].isin(used_indices)
-    contains_label = df[col].str.contains(label)
+    contains_label = df[col].str.contains(label, na=False).astype(bool)
     df_filtered = df[(contains_label) & (remove_used)]
     # Remove NA idx
     if df_filtered.idx.isna().sum() > 0:
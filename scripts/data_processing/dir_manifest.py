@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+from typing import Callable
+
+import pandas as pd
+
+# PATHS
+if "D:\\" in os.getcwd():
+    manifest_dir = "M:/home/stan/cytoimagenet/evaluation/manifests/"
+else:
+    manifest_dir = "/home/stan/cytoimagenet/evaluation/manifests/"
+
+
+class DirectoryManifest:
+    """Cached listing of files in each subdirectory of <root>, saved to a JSON
+    file with directory modification times.
+
+    Only subdirectories whose modification time changed are listed again. The
+    list of subdirectories is only scanned again if the modification time of
+    <root> changed.
+
+    ==Attributes==:
+        root: directory containing subdirectories (e.g. one per label)
+        path: path to cached manifest
+        root_mtime: modification time of root when last scanned
+        dirs: dictionary of subdirectory name to dictionary of modification
+                time ('mtime') and sorted filenames ('files')
+        dataframes: dataframes built from the current listing, by builder
+    """
+
+    def __init__(self, root: str, cache_dir: str = manifest_dir):
+        self.root = root
+        root_hash = hashlib.sha1(root.encode()).hexdigest()[:16]
+        self.path = f"{cache_dir}/{os.path.basename(root.rstrip('/'))}-" \
+                    f"{root_hash}.json"
+        self.root_mtime = None
+        self.dirs = {}
+        self.dataframes = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if manifest['root'] == root:
+                self.root_mtime = manifest['root_mtime']
+                self.dirs = manifest['dirs']
+
+    def refresh(self) -> bool:
+        """Scan directories that changed since the last scan. Return True if
+        the listing changed.
+        """
+        changed = False
+        rescanned = False
+
+        root_mtime = os.stat(self.root).st_mtime
+        if root_mtime != self.root_mtime:
+            rescanned = True
+            names = sorted(entry.name for entry in os.scandir(self.root)
+                           if entry.is_dir())
+            if names != sorted(self.dirs):
+                self.dirs = {name: self.dirs.get(name, {'mtime': None})
+                             for name in names}
+                changed = True
+            self.root_mtime = root_mtime
+
+        for name, listing in self.dirs.items():
+            mtime = os.stat(os.sep.join([self.root, name])).st_mtime
+            if mtime != listing['mtime']:
+                listing['files'] = sorted(
+                    os.listdir(os.sep.join([self.root, name])))
+                listing['mtime'] = mtime
+                changed = True
+
+        if changed:
+            self.dataframes.clear()
+        if changed or rescanned:
+            self.save()
+        return changed
+
+    def save(self) -> None:
+        """Atomically save manifest."""
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(f"{self.path}.tmp", 'w') as f:
+            json.dump({'root': self.root, 'root_mtime': self.root_mtime,
+                       'dirs': self.dirs}, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def get_files(self) -> dict:
+        """Return dictionary of subdirectory name to sorted filenames."""
+        self.refresh()
+        return {name: listing['files'] for name, listing in self.dirs.items()}
+
+    def get_dataframe(self, build: Callable[[dict], pd.DataFrame]
+                      ) -> pd.DataFrame:
+        """Return copy of dataframe built by <build> from the dictionary of
+        subdirectory name to filenames. The dataframe is only built again if
+        the listing changed.
+        """
+        files = self.get_files()
+        key = build.__qualname__
+        if key not in self.dataframes:
+            self.dataframes[key] = build(files)
+        return self.dataframes[key].copy()
+
+
+# Manifests loaded in this process, by root
+loaded_manifests = {}
+
+
+def get_manifest(root: str) -> DirectoryManifest:
+    """Return manifest for <root>, shared within this process."""
+    if root not in loaded_manifests:
+        loaded_manifests[root] = DirectoryManifest(root)
+    return loaded_manifests[root]
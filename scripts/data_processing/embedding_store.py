@@ -0,0 +1,263 @@
+import json
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+# PATHS
+if "D:\\" in os.getcwd():
+    embedding_dir = "M:/ferrero/stan_data/evaluation/"
+else:
+    embedding_dir = "/ferrero/stan_data/evaluation/"
+
+
+def preproc_str(concat: bool, norm: bool) -> str:
+    """Return string for preprocessing options <concat> and <norm>. Same
+    convention as model_evaluation.create_save_str.
+    """
+    return f"{'concat' if concat else 'merge'}, {'norm' if norm else 'no norm'}"
+
+
+class EmbeddingWriter:
+    """Appends chunks of embeddings to an entry in the EmbeddingStore.
+
+    Rows are appended to a raw binary file. Rows are only considered written
+    once committed, when the manifest is updated with the number of rows
+    flushed to disk. The manifest is marked complete when the writer is
+    closed.
+
+    ==Attributes==:
+        entry_dir: directory of store entry
+        manifest: dictionary of dtype, num_features, num_rows (committed),
+                    num_expected, num_chunks and complete
+        num_rows: number of rows appended, including uncommitted rows
+    """
+
+    def __init__(self, entry_dir: str, manifest: dict):
+        self.entry_dir = entry_dir
+        self.manifest = manifest
+        self.dtype = np.dtype(manifest['dtype'])
+        self.num_rows = manifest['num_rows']
+
+        # Discard rows that were written but never committed
+        row_bytes = self.dtype.itemsize * manifest['num_features']
+        self.file = open(f"{entry_dir}/embeddings.bin", 'ab')
+        self.file.truncate(self.num_rows * row_bytes)
+
+    def append(self, chunk: np.array) -> None:
+        """Append <chunk> of shape (num_rows, num_features) to the store."""
+        chunk = np.ascontiguousarray(chunk, dtype=self.dtype)
+        if chunk.ndim != 2 or chunk.shape[1] != self.manifest['num_features']:
+            raise ValueError(f"Expected chunk of shape "
+                             f"(n, {self.manifest['num_features']}). "
+                             f"Got {chunk.shape}")
+        self.file.write(chunk.tobytes())
+        self.num_rows += len(chunk)
+
+    def commit(self) -> None:
+        """Flush appended rows to disk, and record them in the manifest."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.num_rows != self.manifest['num_rows']:
+            self.manifest['num_rows'] = self.num_rows
+            self.manifest['num_chunks'] += 1
+        write_manifest(self.entry_dir, self.manifest)
+
+    def close(self) -> None:
+        """Commit remaining rows and mark entry as complete."""
+        self.commit()
+        self.file.close()
+        self.manifest['complete'] = True
+        write_manifest(self.entry_dir, self.manifest)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+
+def write_manifest(entry_dir: str, manifest: dict) -> None:
+    """Atomically write <manifest> to <entry_dir>/manifest.json"""
+    with open(f"{entry_dir}/manifest.json.tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(f"{entry_dir}/manifest.json.tmp", f"{entry_dir}/manifest.json")
+
+
+class EmbeddingStore:
+    """Store of extracted embeddings, keyed by (dataset, weights, concat,
+    norm), where weights is the weights string (e.g. 'imagenet', 'random').
+
+    Each entry is a directory containing:
+        - embeddings.bin: row-major array of (num_rows, num_features)
+        - manifest.json: dtype, num_features, number of committed rows and
+            completion status
+        - metadata.csv: OPTIONAL. Row-aligned metadata for embeddings
+
+    ==Attributes==:
+        root: directory containing all entries
+    """
+
+    def __init__(self, root: str = embedding_dir):
+        self.root = root
+
+    def get_dir(self, dataset: str, weights: str, concat: bool,
+                norm: bool) -> str:
+        """Return directory of entry for key."""
+        return f"{self.root}/{weights}_embeddings/" \
+               f"{dataset}_embeddings ({weights}, {preproc_str(concat, norm)})"
+
+    def get_manifest(self, dataset: str, weights: str, concat: bool,
+                     norm: bool) -> Optional[dict]:
+        """Return manifest of entry for key. Return None if it doesn't exist.
+        """
+        manifest_path = f"{self.get_dir(dataset, weights, concat, norm)}" \
+                        f"/manifest.json"
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as f:
+            return json.load(f)
+
+    def exists(self, dataset: str, weights: str, concat: bool,
+               norm: bool) -> bool:
+        """Return True if a complete entry exists for key."""
+        manifest = self.get_manifest(dataset, weights, concat, norm)
+        return manifest is not None and manifest['complete']
+
+    def create(self, dataset: str, weights: str, concat: bool, norm: bool,
+               num_features: int, dtype='float32',
+               metadata: Optional[pd.DataFrame] = None,
+               num_expected: Optional[int] = None) -> EmbeddingWriter:
+        """Return writer for a new, empty entry for key. Overwrites existing
+        entry. If <metadata> specified, save it as row-aligned metadata.
+        <num_expected> is the number of rows expected when complete.
+        """
+        entry_dir = self.get_dir(dataset, weights, concat, norm)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir)
+
+        if num_expected is None and metadata is not None:
+            num_expected = len(metadata)
+        manifest = {'dtype': np.dtype(dtype).name,
+                    'num_features': int(num_features),
+                    'num_rows': 0,
+                    'num_expected': num_expected,
+                    'num_chunks': 0,
+                    'complete': False}
+        write_manifest(entry_dir, manifest)
+
+        # Remove previous embeddings
+        open(f"{entry_dir}/embeddings.bin", 'wb').close()
+
+        if metadata is not None:
+            metadata.to_csv(f"{entry_dir}/metadata.csv", index=False)
+        elif os.path.exists(f"{entry_dir}/metadata.csv"):
+            os.remove(f"{entry_dir}/metadata.csv")
+
+        return EmbeddingWriter(entry_dir, manifest)
+
+    def can_resume(self, dataset: str, weights: str, concat: bool,
+                   norm: bool, num_features: int,
+                   metadata: pd.DataFrame) -> bool:
+        """Return True if an incomplete entry for key exists, which was
+        created for the same number of features and row-aligned <metadata>.
+        """
+        manifest = self.get_manifest(dataset, weights, concat, norm)
+        if manifest is None or manifest['complete'] or \
+                manifest['num_features'] != num_features or \
+                manifest.get('num_expected') != len(metadata):
+            return False
+        # Rows must be in the same order as the interrupted extraction
+        saved_metadata = self.load_metadata(dataset, weights, concat, norm)
+        return saved_metadata is not None and saved_metadata.equals(
+            metadata.reset_index(drop=True))
+
+    def resume(self, dataset: str, weights: str, concat: bool,
+               norm: bool) -> EmbeddingWriter:
+        """Return writer for an incomplete entry for key, which appends after
+        the last committed row.
+        """
+        manifest = self.get_manifest(dataset, weights, concat, norm)
+        if manifest is None:
+            raise FileNotFoundError(f"No embeddings for {dataset} ({weights},"
+                                    f" {preproc_str(concat, norm)})")
+        return EmbeddingWriter(self.get_dir(dataset, weights, concat, norm),
+                               manifest)
+
+    def load(self, dataset: str, weights: str, concat: bool, norm: bool,
+             mmap: bool = True) -> np.array:
+        """Return array of (num_rows, num_features) embeddings for key. If
+        <mmap>, embeddings are memory-mapped (read-only) instead of loaded.
+        """
+        manifest = self.get_manifest(dataset, weights, concat, norm)
+        if manifest is None:
+            raise FileNotFoundError(f"No embeddings for {dataset} ({weights},"
+                                    f" {preproc_str(concat, norm)})")
+
+        shape = (manifest['num_rows'], manifest['num_features'])
+        filename = f"{self.get_dir(dataset, weights, concat, norm)}" \
+                   f"/embeddings.bin"
+        if shape[0] == 0:
+            return np.empty(shape, dtype=manifest['dtype'])
+        if mmap:
+            return np.memmap(filename, dtype=manifest['dtype'], mode='r',
+                             shape=shape)
+        return np.fromfile(filename, dtype=manifest['dtype'],
+                           count=shape[0] * shape[1]).reshape(shape)
+
+    def load_metadata(self, dataset: str, weights: str, concat: bool,
+                      norm: bool) -> Optional[pd.DataFrame]:
+        """Return row-aligned metadata for key, or None if not saved."""
+        filename = f"{self.get_dir(dataset, weights, concat, norm)}" \
+                   f"/metadata.csv"
+        if not os.path.exists(filename):
+            return None
+        return pd.read_csv(filename)
+
+    def get_scaler(self, dataset: str, weights: str, concat: bool,
+                   norm: bool, chunk_size: int = 8192) -> tuple:
+        """Return (mean, scale) of features for key, matching
+        sklearn.preprocessing.StandardScaler (population standard deviation,
+        with 0 replaced by 1).
+
+        Statistics are computed once from the complete entry, in chunks of
+        <chunk_size> rows, and saved alongside the embeddings (see
+        get_scaler_path). They are computed again if the entry changed since.
+        """
+        entry_dir = self.get_dir(dataset, weights, concat, norm)
+        scaler_path = self.get_scaler_path(dataset, weights, concat, norm)
+        if os.path.exists(scaler_path) and \
+                os.path.getmtime(scaler_path) >= \
+                os.path.getmtime(f"{entry_dir}/manifest.json"):
+            scaler = np.load(scaler_path)
+            return scaler['mean'], scaler['scale']
+
+        embeddings = self.load(dataset, weights, concat, norm)
+        mean = np.zeros(embeddings.shape[1], dtype=np.float64)
+        for start in range(0, len(embeddings), chunk_size):
+            mean += embeddings[start:start + chunk_size].sum(axis=0,
+                                                            dtype=np.float64)
+        mean /= len(embeddings)
+        var = np.zeros(embeddings.shape[1], dtype=np.float64)
+        for start in range(0, len(embeddings), chunk_size):
+            var += ((embeddings[start:start + chunk_size] - mean) ** 2).sum(
+                axis=0)
+        var /= len(embeddings)
+        scale = np.sqrt(var)
+        scale[scale == 0] = 1.
+
+        # Temporary file is unique to this process, as other processes may
+        # compute the same statistics
+        tmp_path = f"{entry_dir}/scaler.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, mean=mean, scale=scale)
+        os.replace(tmp_path, scaler_path)
+        return mean, scale
+
+    def get_scaler_path(self, dataset: str, weights: str, concat: bool,
+                        norm: bool) -> str:
+        """Return path of saved scaler statistics for key."""
+        return f"{self.get_dir(dataset, weights, concat, norm)}/scaler.npz"
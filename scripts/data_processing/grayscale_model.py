@@ -0,0 +1,171 @@
+from typing import Callable, Optional
+
+import numpy as np
+import tensorflow as tf
+
+# Names of EfficientNet layers around the stem convolution
+stem_pad_name = 'stem_conv_pad'
+stem_conv_name = 'stem_conv'
+
+
+def stem_affine(model: tf.keras.Model) -> tuple:
+    """Return tuple of (scale, offset) arrays, where <model> preprocesses
+    channel c of its input x to scale[c] * x + offset[c] before the stem
+    convolution (i.e. rescaling and normalization layers).
+    """
+    pre_stem = tf.keras.Model(model.inputs,
+                              model.get_layer(stem_pad_name).input)
+    shape = [size or 32 for size in model.input_shape[1:]]
+    zeros = np.zeros([1, *shape], dtype=np.float32)
+    offset = np.asarray(pre_stem.predict_on_batch(zeros),
+                        dtype=np.float64)[0, 0, 0]
+    scale = np.asarray(pre_stem.predict_on_batch(zeros + 1),
+                       dtype=np.float64)[0, 0, 0] - offset
+    return scale, offset
+
+
+def grayscale_input(shape=(None, None)) -> tuple:
+    """Return tuple of (1-channel input, 2-channel tensor), where the second
+    channel is constant. The constant channel carries the preprocessing
+    offset through the stem convolution's zero padding.
+    """
+    inputs = tf.keras.Input(shape=(*shape, 1))
+    ones = tf.keras.layers.Lambda(tf.ones_like, name='stem_ones')(inputs)
+    x = tf.keras.layers.Concatenate(name='stem_concat')([inputs, ones])
+    return inputs, x
+
+
+class FixedOffsetResponse(tf.keras.constraints.Constraint):
+    """Constraint on the 2-channel stem kernel of a grayscale model, keeping
+    its response to the constant channel fixed while the image channel
+    trains.
+
+    The response is the RGB stem kernel's response to the RGB preprocessing
+    offset, so it can always be unfolded back into RGB weights exactly (see
+    copy_to_rgb_model).
+
+    ==Attributes==:
+        response_ones: array of shape (height, width, filters), of the stem
+                        response to the constant channel per kernel element
+        gray_offset: preprocessing offset of the grayscale model's channels
+    """
+
+    def __init__(self, response_ones, gray_offset):
+        self.response_ones = np.asarray(response_ones, dtype=np.float32)
+        self.gray_offset = np.asarray(gray_offset, dtype=np.float32)
+
+    def __call__(self, kernel):
+        kernel_x = kernel[:, :, 0]
+        kernel_ones = (self.response_ones -
+                       kernel_x * self.gray_offset[0]) / self.gray_offset[1]
+        return tf.stack([kernel_x, kernel_ones], axis=2)
+
+    def get_config(self):
+        return {'response_ones': self.response_ones.tolist(),
+                'gray_offset': self.gray_offset.tolist()}
+
+
+def weighted_layers(model: tf.keras.Model) -> list:
+    """Return layers of <model> with weights, from the stem convolution
+    onwards.
+    """
+    layers = [layer for layer in model.layers if layer.weights]
+    names = [layer.name for layer in layers]
+    return layers[names.index(stem_conv_name):]
+
+
+def to_grayscale_model(model: tf.keras.Model,
+                       build: Callable[[tf.Tensor], tf.keras.Model]
+                       ) -> tf.keras.Model:
+    """Return model accepting 1-channel images, with the same outputs as
+    <model> given the image replicated across RGB channels.
+
+    Stem convolution weights are summed across RGB channels, after folding in
+    <model>'s per-channel rescaling and normalization. All other weights are
+    copied from <model>. The stem's response to the constant channel is kept
+    fixed during training (see FixedOffsetResponse).
+
+    ==Parameters==:
+        model: RGB EfficientNet model
+        build: function returning the same architecture as <model> (without
+                pretrained weights) on the given input tensor
+    """
+    inputs, x = grayscale_input(model.input_shape[1:3])
+    gray_model = build(x)
+
+    scale, offset = stem_affine(model)
+    gray_scale, gray_offset = stem_affine(gray_model)
+
+    # Kernel of shape (height, width, channels, filters)
+    layers = zip(weighted_layers(model), weighted_layers(gray_model))
+    stem, gray_stem = next(layers)
+    kernel = np.asarray(stem.get_weights()[0], dtype=np.float64)
+    kernel_x = (kernel * scale[:, None]).sum(axis=2) / gray_scale[0]
+    response_ones = (kernel * offset[:, None]).sum(axis=2)
+    kernel_ones = (response_ones - kernel_x * gray_offset[0]) / gray_offset[1]
+    gray_stem.set_weights([np.stack([kernel_x, kernel_ones], axis=2)
+                           .astype(np.float32)] + stem.get_weights()[1:])
+
+    # Optimizers apply the constraint of the kernel variable, which is only
+    # set when the layer is built
+    constraint = FixedOffsetResponse(response_ones, gray_offset)
+    gray_stem.kernel_constraint = constraint
+    gray_stem.kernel._constraint = constraint
+
+    for layer, gray_layer in layers:
+        gray_layer.set_weights(layer.get_weights())
+    return gray_model
+
+
+def stem_affines(gray_model: tf.keras.Model, model: tf.keras.Model) -> tuple:
+    """Return tuple of (scale, offset, gray_scale, gray_offset), the
+    preprocessing before the stem convolution of RGB <model> and of
+    <gray_model> (see stem_affine).
+
+    These only depend on preprocessing layers, which don't train. They can be
+    computed once, and passed to copy_to_rgb_model.
+    """
+    return (*stem_affine(model), *stem_affine(gray_model))
+
+
+def copy_to_rgb_model(gray_model: tf.keras.Model, model: tf.keras.Model,
+                      affines: Optional[tuple] = None) -> tf.keras.Model:
+    """Copy weights of <gray_model> (see to_grayscale_model) into RGB model
+    <model>, so that <model> gives the same outputs for grayscale images
+    replicated across RGB channels. Return <model>.
+
+    The stem convolution kernel is the minimum-norm RGB kernel with the same
+    response to the grayscale image and preprocessing offset. Raises
+    ValueError if no RGB kernel has the same response (i.e. the constant
+    channel's response changed, while <model> has no preprocessing offset).
+
+    ==Parameters==:
+        affines: OPTIONAL. Result of stem_affines(<gray_model>, <model>).
+                Computing it builds models, so it must be passed when copying
+                weights outside of the main thread.
+    """
+    if affines is None:
+        affines = stem_affines(gray_model, model)
+    scale, offset, gray_scale, gray_offset = affines
+
+    layers = zip(weighted_layers(model), weighted_layers(gray_model))
+    stem, gray_stem = next(layers)
+    gray_kernel = np.asarray(gray_stem.get_weights()[0], dtype=np.float64)
+    # Responses to x and to the constant offset, per kernel element
+    response_x = gray_kernel[:, :, 0] * gray_scale[0]
+    response_ones = gray_kernel[:, :, 0] * gray_offset[0] + \
+        gray_kernel[:, :, 1] * gray_offset[1]
+    coefficients = np.stack([scale, offset])
+    responses = np.stack([response_x, response_ones], axis=2)
+    kernel = np.einsum('cr,hwrf->hwcf', np.linalg.pinv(coefficients),
+                       responses)
+    if not np.allclose(np.einsum('rc,hwcf->hwrf', coefficients, kernel),
+                       responses, rtol=0,
+                       atol=1e-5 * np.abs(responses).max()):
+        raise ValueError("Grayscale stem can't be unfolded into RGB weights!")
+    stem.set_weights([kernel.astype(np.float32)] +
+                     gray_stem.get_weights()[1:])
+
+    for layer, gray_layer in layers:
+        layer.set_weights(gray_layer.get_weights())
+    return model
@@ -0,0 +1,155 @@
+import datetime
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Histogram:
+    """Histogram of non-negative values (e.g. seconds), with power-of-2
+    buckets. Keeps count, total, min and max exactly.
+
+    ==Attributes==:
+        buckets: dictionary of bucket exponent e to number of values in
+                    [2^(e-1), 2^e)
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = math.inf
+        self.max = 0.
+        self.buckets = defaultdict(int)
+
+    def add(self, value: float) -> None:
+        """Add <value> to histogram."""
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        self.buckets[math.frexp(value)[1] if value > 0 else -1074] += 1
+
+    def quantile(self, q: float) -> float:
+        """Return approximate <q>th quantile, as the upper bound of the
+        bucket containing it.
+        """
+        rank = q * self.count
+        accum = 0
+        for exponent in sorted(self.buckets):
+            accum += self.buckets[exponent]
+            if accum >= rank:
+                return min(math.ldexp(1, exponent), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """Return dictionary summarizing histogram."""
+        if self.count == 0:
+            return {'count': 0}
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99)}
+
+
+class Instrumentation:
+    """Thread-safe counters and histograms of stage timings.
+
+    Stages are timed with Instrumentation.timer, which records seconds taken
+    in histogram <stage> and the number of items processed in counter
+    '<stage>.items'. Throughput of a stage is items / total seconds.
+
+    ==Attributes==:
+        counters: dictionary of counter name to value
+        histograms: dictionary of histogram name to Histogram
+        start_time: time when instrumentation was last reset
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.start_time = time.perf_counter()
+
+    def reset(self) -> None:
+        """Remove all recorded values."""
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.start_time = time.perf_counter()
+
+    def count(self, name: str, value=1) -> None:
+        """Add <value> to counter <name>."""
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        """Add <value> to histogram <name>."""
+        with self.lock:
+            self.histograms[name].add(value)
+
+    @contextmanager
+    def timer(self, stage: str, items: int = 1):
+        """Context manager recording seconds taken by <stage>, which processes
+        <items> items (e.g. images, rows or queries).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.histograms[stage].add(seconds)
+                self.counters[f"{stage}.items"] += items
+
+    def summary(self) -> dict:
+        """Return dictionary of counters, and histogram summaries with
+        throughput of each stage.
+        """
+        with self.lock:
+            stages = {}
+            for name, histogram in self.histograms.items():
+                stages[name] = histogram.summary()
+                items = self.counters.get(f"{name}.items")
+                if items is not None and histogram.total > 0:
+                    stages[name]['items'] = items
+                    stages[name]['items_per_second'] = items / histogram.total
+            return {'wall_seconds': time.perf_counter() - self.start_time,
+                    'counters': dict(self.counters),
+                    'stages': stages}
+
+    def export(self, path: str, **run_metadata) -> dict:
+        """Save summary with <run_metadata> as JSON at <path>, and return it.
+        """
+        summary = {'time': datetime.datetime.now().isoformat(),
+                   **run_metadata, **self.summary()}
+        if not os.path.exists(os.path.dirname(path) or '.'):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2, default=str)
+        return summary
+
+    def timed(self, iterable, stage: str):
+        """Yield items of <iterable>, recording seconds spent waiting for each
+        item in histogram <stage>.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(stage, time.perf_counter() - start)
+            self.count(f"{stage}.items")
+            yield item
+
+
+# Shared instrumentation of this process
+instrumentation = Instrumentation()
@@ -0,0 +1,121 @@
+import json
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+# PATHS
+cyto_dir = '/ferrero/cytoimagenet/'
+shard_dir = '/ferrero/cytoimagenet/shards/'
+
+
+def load_resized(path: str, target_size=(224, 224)):
+    """Return tuple of (uint8 grayscale image resized to <target_size>,
+    original (height, width)). Raise OSError if image cannot be read.
+
+    Resizing is bilinear to match ImageDataGenerator.flow_from_dataframe.
+    """
+    try:
+        img = Image.open(path)
+        if img.mode != 'L':
+            img = img.convert('L')
+        orig_shape = (img.height, img.width)
+        img = img.resize((target_size[1], target_size[0]), Image.BILINEAR)
+        return np.asarray(img, dtype=np.uint8), orig_shape
+    except Exception as e:
+        raise OSError(f"Could not read {path}! ({e})")
+
+
+def pack_cytoimagenet(metadata_path: str = f"{cyto_dir}metadata.csv",
+                      out_dir: str = shard_dir, shard_size: int = 10000,
+                      target_size=(224, 224), num_workers: int = 30,
+                      overwrite: bool = False) -> pd.DataFrame:
+    """Pack images listed in <metadata_path> into fixed-size uint8 grayscale
+    shards of pre-resized images, and return the shard index.
+
+    Creates in <out_dir>:
+        - shard_XXXXX.npy: uint8 array of (<shard_size>, height, width)
+        - index.csv: one row per metadata row, containing row_id, label,
+            label_id, shard, offset and original height/width
+        - labels.json: sorted list of labels, where label_id indexes the list
+
+    Completed shards are skipped unless <overwrite>, so packing can be
+    resumed if interrupted. Packing stops at the first image that cannot be
+    read, so no shard contains blank images for labelled rows.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    df = pd.read_csv(metadata_path)
+    full_paths = (df.path + "/" + df.filename).tolist()
+
+    # Encode labels in the same (sorted) order as flow_from_dataframe
+    labels = sorted(df.label.unique())
+    label_to_id = {label: i for i, label in enumerate(labels)}
+
+    df_index = pd.DataFrame({
+        'row_id': np.arange(len(df)),
+        'label': df.label.to_numpy(),
+        'label_id': df.label.map(label_to_id).to_numpy(dtype=np.int16),
+        'shard': np.arange(len(df)) // shard_size,
+        'offset': np.arange(len(df)) % shard_size,
+        'height': 0,
+        'width': 0})
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        for shard, start in enumerate(range(0, len(df), shard_size)):
+            shard_file = f"{out_dir}/shard_{shard:05d}.npy"
+            shape_file = f"{out_dir}/shard_{shard:05d}-shapes.npy"
+            end = min(start + shard_size, len(df))
+
+            if os.path.exists(shard_file) and not overwrite:
+                shapes = np.load(shape_file)
+            else:
+                # Write to temporary file, so incomplete shards are never read
+                images = np.lib.format.open_memmap(
+                    f"{shard_file}.tmp", mode='w+', dtype=np.uint8,
+                    shape=(end - start, *target_size))
+                shapes = np.zeros((end - start, 2), dtype=np.int32)
+                results = pool.imap(load_resized, full_paths[start:end],
+                                    chunksize=64)
+                for i, (img, orig_shape) in enumerate(results):
+                    images[i] = img
+                    shapes[i] = orig_shape
+                images.flush()
+                del images
+                np.save(shape_file, shapes)
+                os.replace(f"{shard_file}.tmp", shard_file)
+                print(f"Packed shard {shard} [{end}/{len(df)}]")
+
+            df_index.loc[start:end - 1, 'height'] = shapes[:, 0]
+            df_index.loc[start:end - 1, 'width'] = shapes[:, 1]
+        pool.close()
+        pool.join()
+    except Exception as e:
+        pool.terminate()
+        raise e
+
+    df_index.to_csv(f"{out_dir}/index.csv", index=False)
+    with open(f"{out_dir}/labels.json", 'w') as f:
+        json.dump(labels, f)
+
+    return df_index
+
+
+def load_shards(out_dir: str = shard_dir) -> tuple:
+    """Return tuple of (list of memory-mapped shards, shard index dataframe,
+    list of labels) for shards packed in <out_dir>.
+    """
+    df_index = pd.read_csv(f"{out_dir}/index.csv")
+    with open(f"{out_dir}/labels.json") as f:
+        labels = json.load(f)
+    shards = [np.load(f"{out_dir}/shard_{shard:05d}.npy", mmap_mode='r')
+              for shard in range(df_index.shard.max() + 1)]
+    return shards, df_index, labels
+
+
+if __name__ == "__main__" and "D:\\" not in os.getcwd():
+    pack_cytoimagenet()
@@ -1,4 +1,4 @@
-from preprocessor import create_image, normalize
+from preprocessor import create_image, normalize, normalize_batch
 from scripts.data_curation.analyze_metadata import get_df_counts
 
 import glob
@@ -259,13 +259,23 @@ class Upsampler:
             # Save crop if mean pixel intensity is greater than 1 and less
             # than 254. And 75th percentile is not 0.
             if 1 < img_crop.mean() < 254 and np.percentile(img_crop, 75) != 0:
-                img_crops.append(normalize(img_crop) * 255)
+                img_crops.append(img_crop)
                 used_xmins.append(x_mins[i])
                 used_xmaxs.append(x_maxs[i])
                 used_ymins.append(y_mins[i])
                 used_ymaxs.append(y_maxs[i])
                 used_scaling.append(scaling[i])
 
+        # Normalize crops, one batch per crop shape
+        crops_by_shape = {}
+        for i, img_crop in enumerate(img_crops):
+            crops_by_shape.setdefault(img_crop.shape, []).append(i)
+        for indices in crops_by_shape.values():
+            normalized = normalize_batch(np.stack([img_crops[i]
+                                                   for i in indices]))
+            for i, img_crop in zip(indices, normalized):
+                img_crops[i] = img_crop * 255
+
         return img_crops, (used_xmins, used_xmaxs, used_ymins, used_ymaxs, used_scaling)
 
     def save_crops(self, imgs: list, x) -> list:
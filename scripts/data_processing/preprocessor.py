@@ -49,35 +49,130 @@ def save_img(x: np.array, name: str, dir_name: str, folder_name="merged") -> Non
     Image.fromarray(x).convert("L").save(f"{data_dir}{dir_name}/{folder_name}/{name}")
 
 
+def percentiles_from_counts(counts: np.array, percentiles=(0.1, 99.9),
+                            divisor=1) -> np.array:
+    """Return linearly interpolated <percentiles> of integer intensities,
+    given histogram <counts> of shape (..., num_bins), where bin i counts
+    pixels with intensity i. Intensities are divided by <divisor>.
+
+    Results are the same as np.percentile on the (divided) intensities.
+    """
+    cum_counts = np.cumsum(counts, axis=-1)
+    cum_counts = cum_counts.reshape(-1, cum_counts.shape[-1])
+    n = cum_counts[:, -1]
+
+    accum_percentiles = []
+    for percentile in percentiles:
+        # Same interpolation as np.percentile(..., method='linear')
+        virtual_idx = (n - 1) * (percentile / 100)
+        prev_idx = np.floor(virtual_idx)
+        next_idx = np.minimum(prev_idx + 1, n - 1)
+        gamma = virtual_idx - prev_idx
+
+        # Intensity at sorted position i is the first bin with > i pixels
+        prev_val = np.array([np.searchsorted(row, i, side='right')
+                             for row, i in zip(cum_counts, prev_idx)],
+                            dtype=np.float64) / divisor
+        next_val = np.array([np.searchsorted(row, i, side='right')
+                             for row, i in zip(cum_counts, next_idx)],
+                            dtype=np.float64) / divisor
+
+        diff = next_val - prev_val
+        value = np.where(gamma >= 0.5, next_val - diff * (1 - gamma),
+                         prev_val + diff * gamma)
+        accum_percentiles.append(value.reshape(counts.shape[:-1]))
+    return np.stack(accum_percentiles)
+
+
+def _integer_counts(img: np.array, rgb: bool = False) -> tuple:
+    """Return tuple of (histogram counts, divisor) for uint8/uint16 image/s
+    <img> of shape (..., H, W). If <rgb>, <img> is of shape (..., H, W, 3) and
+    histogram is of the sum over channels. Return (None, None) if <img> is not
+    an uint8/uint16 image.
+    """
+    if img.dtype not in (np.uint8, np.uint16):
+        return None, None
+
+    divisor = 1
+    if rgb:
+        divisor = img.shape[-1]
+        img = img.sum(axis=-1, dtype=np.int64)
+
+    # Single bincount over all images, with bins offset for each image
+    num_bins = int(img.max()) + 1
+    flat = img.reshape(-1, img.shape[-2] * img.shape[-1]).astype(np.int64)
+    flat += np.arange(len(flat), dtype=np.int64)[:, None] * num_bins
+    counts = np.bincount(flat.ravel(), minlength=len(flat) * num_bins)
+    counts = counts.reshape(img.shape[:-2] + (num_bins,))
+    return counts, divisor
+
+
 def normalize(img: np.array):
     """Normalize image between [0, 1].
         - Force new min intensity (0) to be the 0.1th percentile intensity
         - Force new max intensity to be the 99.9th percentile intensity
         - Divide by new max intensity
+
+    For uint8/uint16 images, percentiles are computed from a single histogram
+    pass instead of sorting.
     """
+    is_rgb = len(img.shape) == 3 and img.shape[-1] == 3
+    counts, divisor = _integer_counts(img, rgb=is_rgb)
+
     # If RGB, convert to grayscale
-    if len(img.shape) == 3 and img.shape[-1] == 3:
+    if is_rgb:
         img = img.mean(axis=-1)
 
     # Get 0.1 and 99.9th percentile of pixel intensities
-    top_001 = np.percentile(img.flatten(), 99.9)
-    bot_001 = np.percentile(img.flatten(), 0.1)
+    if counts is not None:
+        bot_001, top_001 = percentiles_from_counts(counts, (0.1, 99.9),
+                                                   divisor)
+    else:
+        top_001 = np.percentile(img.flatten(), 99.9)
+        bot_001 = np.percentile(img.flatten(), 0.1)
 
     # Limit maximum intensity to 0.99th percentile
-    img[img > top_001] = top_001
+    np.minimum(img, np.array(top_001).astype(img.dtype), out=img)
 
     # Then subtract by the 0.1th percentile intensity
     img = img - bot_001
 
     # Round intensities below 0.1th percentile to 0.
-    img[img < 0] = 0
+    np.maximum(img, 0, out=img)
 
     # Normalize between 0 and 1
-    img = img / img.max()
+    img /= img.max()
 
     return img
 
 
+def normalize_batch(imgs: np.array) -> np.array:
+    """Normalize each image in stack <imgs> of shape (N, H, W) or RGB
+    (N, H, W, 3) between [0, 1], as in normalize. Return float64 array of
+    shape (N, H, W).
+    """
+    is_rgb = len(imgs.shape) == 4 and imgs.shape[-1] == 3
+    counts, divisor = _integer_counts(imgs, rgb=is_rgb)
+
+    # If RGB, convert to grayscale
+    if is_rgb:
+        imgs = imgs.mean(axis=-1)
+
+    if counts is not None:
+        bot_001, top_001 = percentiles_from_counts(counts, (0.1, 99.9),
+                                                   divisor)
+    else:
+        flat = imgs.reshape(len(imgs), -1)
+        top_001 = np.percentile(flat, 99.9, axis=1)
+        bot_001 = np.percentile(flat, 0.1, axis=1)
+
+    imgs = np.minimum(imgs, top_001.astype(imgs.dtype)[:, None, None])
+    imgs = imgs - bot_001[:, None, None]
+    np.maximum(imgs, 0, out=imgs)
+    imgs /= imgs.max(axis=(1, 2), keepdims=True)
+    return imgs
+
+
 def merger(paths: list, filenames: list, new_filename: str, dir_name: str = dir_name) -> np.array:
     """Given list of paths + filenames to merge, do the following:
         1. Load in all images at paths
@@ -85,12 +180,10 @@ def merger(paths: list, filenames: list, new_filename: str, dir_name: str = dir_
         3. Add all images and divide by number of images
         4. Save new image as PNG named <new_filename> in "merged" folder
     """
-    img_stack = None
     img_stack = []
     for i in range(len(filenames)):
         if os.path.exists(paths[i] + "/" + filenames[i]):
-            img = load_image(paths[i] + "/" + filenames[i])
-            img_stack.append(normalize(img))
+            img_stack.append(load_image(paths[i] + "/" + filenames[i]))
         else:
             print(paths[i] + "/" + filenames[i] + " missing!")
 
@@ -98,9 +191,9 @@ def merger(paths: list, filenames: list, new_filename: str, dir_name: str = dir_
             print("Error! No images loaded for: " + paths[i] + "/" + filenames[i])
             return False
 
-    # Stack channel images. Then average along normalized channels.
-    img_stack = np.stack(img_stack, axis=-1)
-    img_stack = img_stack.mean(axis=-1)
+    # Normalize stacked channel images. Then average along normalized channels.
+    img_stack = normalize_batch(np.stack(img_stack))
+    img_stack = img_stack.mean(axis=0)
     # Normalize between [0, 255]
     img_stack = img_stack * 255
 
@@ -0,0 +1,297 @@
+import datetime
+import glob
+import os
+import re
+import sqlite3
+from contextlib import closing
+from typing import Optional
+
+import pandas as pd
+
+# PATHS
+if "D:\\" in os.getcwd():
+    evaluation_dir = "M:/home/stan/cytoimagenet/evaluation/"
+else:
+    evaluation_dir = "/home/stan/cytoimagenet/evaluation/"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    dataset TEXT NOT NULL,
+    weights TEXT NOT NULL,
+    checkpoint TEXT NOT NULL DEFAULT '',
+    concat INTEGER NOT NULL,
+    norm INTEGER NOT NULL,
+    k INTEGER NOT NULL,
+    vote TEXT NOT NULL,
+    metric TEXT,
+    index_type TEXT,
+    num_samples INTEGER,
+    total_accuracy REAL,
+    knn_seconds REAL,
+    created TEXT,
+    UNIQUE (dataset, weights, checkpoint, concat, norm, k, vote)
+);
+CREATE TABLE IF NOT EXISTS class_results (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    label TEXT NOT NULL,
+    correct INTEGER NOT NULL,
+    total INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_dataset ON runs (dataset, weights);
+CREATE INDEX IF NOT EXISTS class_results_by_run ON class_results (run_id);
+"""
+
+
+class ResultsDB:
+    """SQLite database of kNN classification results.
+
+    Each run (dataset, weights, checkpoint, preprocessing, k and vote method)
+    has one row in table 'runs' with run metadata, and one row per class in
+    table 'class_results'. The checkpoint identifies the weights file (e.g.
+    by checksum), so results of re-trained weights with the same name are
+    kept apart. Unless specified, results of each run are read for the
+    latest checkpoint of its weights with that run.
+
+    ==Attributes==:
+        path: path to SQLite database file
+        initialized: whether tables were created in this process
+    """
+
+    def __init__(self, path: str = f"{evaluation_dir}results.db"):
+        self.path = path
+        self.initialized = False
+
+    def connect(self) -> sqlite3.Connection:
+        """Return connection to database, creating tables if needed. Waits for
+        concurrent writers from other processes.
+        """
+        if not self.initialized:
+            if not os.path.exists(os.path.dirname(self.path) or '.'):
+                os.makedirs(os.path.dirname(self.path))
+            with closing(sqlite3.connect(self.path, timeout=60)) as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                self.migrate(conn)
+                conn.executescript(SCHEMA)
+            self.initialized = True
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    @staticmethod
+    def migrate(conn: sqlite3.Connection) -> None:
+        """Add checkpoint to the unique key of runs, in databases created
+        without it. Foreign keys must be off.
+        """
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = "
+                           "'table' AND name = 'runs'").fetchone()
+        if row is None or "UNIQUE (dataset, weights, checkpoint" in row[0]:
+            return
+        columns = ("run_id, dataset, weights, checkpoint, concat, norm, k, "
+                   "vote, metric, index_type, num_samples, total_accuracy, "
+                   "knn_seconds, created")
+        with conn:
+            # Table left by an interrupted migration
+            conn.execute("DROP TABLE IF EXISTS runs_new")
+            conn.execute(SCHEMA.split(";")[0].replace(
+                "EXISTS runs (", "EXISTS runs_new ("))
+            values = columns.replace("checkpoint", "COALESCE(checkpoint, '')")
+            conn.execute(f"INSERT INTO runs_new ({columns}) "
+                         f"SELECT {values} FROM runs")
+            conn.execute("DROP TABLE runs")
+            conn.execute("ALTER TABLE runs_new RENAME TO runs")
+
+    def add_run(self, dataset: str, weights: str, concat: bool, norm: bool,
+                k: int, df_results: pd.DataFrame, vote='majority',
+                checkpoint: str = '',
+                metric: Optional[str] = None,
+                index_type: Optional[str] = None,
+                knn_seconds: Optional[float] = None,
+                created: Optional[str] = None) -> int:
+        """Add kNN results <df_results> for run, replacing existing results
+        for the same run. Return run_id.
+
+        ==Parameters==:
+            df_results: dataframe with columns labels, correct_by_class,
+                        total_by_class and total_accuracy
+            created: OPTIONAL. ISO timestamp of when results were computed.
+                        Defaults to now
+        """
+        if created is None:
+            created = datetime.datetime.now().isoformat()
+        with closing(self.connect()) as conn, conn:
+            conn.execute("DELETE FROM runs WHERE dataset = ? AND weights = ? "
+                         "AND checkpoint = ? AND concat = ? AND norm = ? AND "
+                         "k = ? AND vote = ?",
+                         (dataset, weights, checkpoint, int(concat),
+                          int(norm), int(k), vote))
+            cursor = conn.execute(
+                "INSERT INTO runs (dataset, weights, checkpoint, concat, "
+                "norm, k, vote, metric, index_type, num_samples, "
+                "total_accuracy, knn_seconds, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (dataset, weights, checkpoint, int(concat), int(norm), int(k),
+                 vote, metric, index_type,
+                 int(df_results.total_by_class.sum()),
+                 float(df_results.total_accuracy.iloc[0]), knn_seconds,
+                 created))
+            run_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT INTO class_results (run_id, label, correct, total) "
+                "VALUES (?, ?, ?, ?)",
+                zip([run_id] * len(df_results),
+                    df_results.labels.astype(str),
+                    df_results.correct_by_class.astype(int).tolist(),
+                    df_results.total_by_class.astype(int).tolist()))
+        return run_id
+
+    def has_run(self, dataset: str, weights: str, concat: bool, norm: bool,
+                k: int, vote='majority',
+                checkpoint: Optional[str] = None) -> bool:
+        """Return True if results exist for run. If <checkpoint> is None,
+        results of any checkpoint count.
+        """
+        query = "SELECT 1 FROM runs WHERE dataset = ? AND weights = ? AND " \
+                "concat = ? AND norm = ? AND k = ? AND vote = ?"
+        params = [dataset, weights, int(concat), int(norm), int(k), vote]
+        if checkpoint is not None:
+            query += " AND checkpoint = ?"
+            params.append(checkpoint)
+        with closing(self.connect()) as conn:
+            row = conn.execute(query, params).fetchone()
+        return row is not None
+
+    def has_runs(self, keys: list) -> bool:
+        """Return True if results exist for all runs in <keys>, where each
+        key is a tuple of has_run arguments.
+        """
+        return all(self.has_run(*key) for key in keys)
+
+    def get_class_results(self, dataset: str, weights: str, concat: bool,
+                          norm: bool, k: int, vote='majority',
+                          checkpoint: Optional[str] = None) -> pd.DataFrame:
+        """Return per-class results for run, in the same format as
+        knn_results. If <checkpoint> is None, use the latest checkpoint of
+        <weights> with results for the run.
+        """
+        if checkpoint is None:
+            checkpoint = self.get_latest_checkpoint(dataset, weights, concat,
+                                                    norm, k, vote)
+        with closing(self.connect()) as conn:
+            df = pd.read_sql_query(
+                "SELECT c.label AS labels, c.correct AS correct_by_class, "
+                "c.total AS total_by_class, "
+                "CAST(c.correct AS REAL) / c.total AS accuracy_by_class, "
+                "r.total_accuracy "
+                "FROM runs r JOIN class_results c ON c.run_id = r.run_id "
+                "WHERE r.dataset = ? AND r.weights = ? AND r.checkpoint = ? "
+                "AND r.concat = ? AND r.norm = ? AND r.k = ? AND r.vote = ? "
+                "ORDER BY c.rowid",
+                conn, params=(dataset, weights, checkpoint, int(concat),
+                              int(norm), int(k), vote))
+        return df
+
+    def get_latest_checkpoint(self, dataset: str, weights: str, concat: bool,
+                              norm: bool, k: int, vote='majority') -> str:
+        """Return checkpoint of the most recent results for run, or '' if
+        there are none.
+        """
+        with closing(self.connect()) as conn:
+            row = conn.execute(
+                "SELECT checkpoint FROM runs WHERE dataset = ? AND "
+                "weights = ? AND concat = ? AND norm = ? AND k = ? AND "
+                "vote = ? ORDER BY created DESC LIMIT 1",
+                (dataset, weights, int(concat), int(norm), int(k),
+                 vote)).fetchone()
+        return '' if row is None else row[0]
+
+    def get_runs(self, dataset: Optional[str] = None,
+                 weights: Optional[list] = None) -> pd.DataFrame:
+        """Return dataframe of run metadata, optionally filtered by <dataset>
+        and list of <weights>.
+        """
+        query, params = "SELECT * FROM runs WHERE 1", []
+        if dataset is not None:
+            query += " AND dataset = ?"
+            params.append(dataset)
+        if weights is not None:
+            query += f" AND weights IN ({', '.join('?' * len(weights))})"
+            params.extend(weights)
+        with closing(self.connect()) as conn:
+            return pd.read_sql_query(query, conn, params=params)
+
+    def get_aggregated(self, dataset: str, weights: Optional[list] = None,
+                       k_values: Optional[tuple] = None,
+                       vote='majority') -> pd.DataFrame:
+        """Return dataframe of results for <dataset>, averaged over classes
+        and then over <k_values>, with one row per weights and preprocessing
+        method. If <weights> or <k_values> are not specified, use all. For
+        each run, only results of the latest checkpoint with that run are
+        used.
+
+        Rows are ordered by weights, then (concat, norm) as (True, True),
+        (True, False), (False, True), (False, False).
+        """
+        filters, params = "r.dataset = ? AND r.vote = ?", [dataset, vote]
+        filters += " AND r.checkpoint = (SELECT r2.checkpoint FROM runs r2 " \
+                   "WHERE r2.dataset = r.dataset AND r2.weights = r.weights " \
+                   "AND r2.concat = r.concat AND r2.norm = r.norm " \
+                   "AND r2.k = r.k AND r2.vote = r.vote " \
+                   "ORDER BY r2.created DESC LIMIT 1)"
+        if weights is not None:
+            filters += f" AND r.weights IN ({', '.join('?' * len(weights))})"
+            params.extend(weights)
+        if k_values is not None:
+            filters += f" AND r.k IN ({', '.join('?' * len(k_values))})"
+            params.extend(int(k) for k in k_values)
+
+        query = f"""
+            WITH per_run AS (
+                SELECT r.run_id, r.weights, r.concat, r.norm, r.total_accuracy,
+                    r.num_samples,
+                    AVG(c.correct) AS correct_by_class,
+                    AVG(c.total) AS total_by_class,
+                    AVG(CAST(c.correct AS REAL) / c.total)
+                        AS accuracy_by_class
+                FROM runs r JOIN class_results c ON c.run_id = r.run_id
+                WHERE {filters}
+                GROUP BY r.run_id)
+            SELECT AVG(correct_by_class) AS correct_by_class,
+                AVG(total_by_class) AS total_by_class,
+                AVG(accuracy_by_class) AS accuracy_by_class,
+                AVG(total_accuracy) AS total_accuracy,
+                1 - concat AS to_grayscale, norm AS normalized, weights,
+                MAX(num_samples) AS num_samples
+            FROM per_run
+            GROUP BY weights, concat, norm
+            ORDER BY weights, concat DESC, norm DESC"""
+        with closing(self.connect()) as conn:
+            df = pd.read_sql_query(query, conn, params=params)
+        df['to_grayscale'] = df.to_grayscale.astype(bool)
+        df['normalized'] = df.normalized.astype(bool)
+        return df
+
+    def import_csv(self, results_glob: str = f"{evaluation_dir}*_results/"
+                                             f"*_kNN_results(*).csv") -> int:
+        """Import kNN results CSV files matching <results_glob>, named
+        '{dataset}_kNN_results({weights}, {preprocessing}, k-{k}).csv'.
+        Return number of imported files.
+
+        Imported runs have no checkpoint, and are dated by when the file was
+        last modified, so they don't replace newer results as the latest.
+        """
+        pattern = re.compile(r"(.+)_kNN_results\((.+), (concat|merge), "
+                             r"(norm|no norm), k-(\d+)(?:, (\w+))?\)\.csv")
+        num_imported = 0
+        for path in glob.glob(results_glob):
+            match = pattern.fullmatch(os.path.basename(path))
+            if match is None:
+                continue
+            dataset, weights, concat, norm, k, vote = match.groups()
+            created = datetime.datetime.fromtimestamp(
+                os.path.getmtime(path)).isoformat()
+            self.add_run(dataset, weights, concat == 'concat', norm == 'norm',
+                         int(k), pd.read_csv(path), vote=vote or 'majority',
+                         created=created)
+            num_imported += 1
+        return num_imported
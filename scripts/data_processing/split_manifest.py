@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+# PATHS
+if "D:\\" in os.getcwd():
+    metadata_path = 'M:/ferrero/cytoimagenet/metadata.csv'
+    split_dir = 'M:/ferrero/cytoimagenet/splits/'
+else:
+    metadata_path = '/ferrero/cytoimagenet/metadata.csv'
+    split_dir = '/ferrero/cytoimagenet/splits/'
+
+
+def file_hash(path: str, cache_dir: str = split_dir) -> str:
+    """Return SHA-256 hash of the contents of file at <path>.
+
+    Hashes are cached in <cache_dir> by file size and modification time, so
+    the file is only read again if it changed.
+    """
+    stat = os.stat(path)
+    cache_path = f"{cache_dir}/file_hashes.json"
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    cached = cache.get(os.path.abspath(path))
+    if cached is not None and cached['size'] == stat.st_size and \
+            cached['mtime'] == stat.st_mtime:
+        return cached['sha256']
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    cache[os.path.abspath(path)] = {'size': stat.st_size,
+                                    'mtime': stat.st_mtime,
+                                    'sha256': sha256.hexdigest()}
+
+    # Atomically update cache
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    with open(f"{cache_path}.tmp", 'w') as f:
+        json.dump(cache, f)
+    os.replace(f"{cache_path}.tmp", cache_path)
+    return sha256.hexdigest()
+
+
+def split_path(labels: Optional[list] = None, test_size: float = 0.1,
+               random_state: int = 0, path: str = metadata_path) -> str:
+    """Return path to split manifest of metadata at <path>, for the subset of
+    <labels> (all labels if None).
+    """
+    content_hash = file_hash(path)[:16]
+    if labels is None:
+        subset = 'all'
+    else:
+        subset = hashlib.sha256(
+            "\n".join(sorted(labels)).encode()).hexdigest()[:16]
+    return f"{split_dir}/split-{content_hash}-{subset}" \
+           f"(test_{test_size}, seed_{random_state}).npz"
+
+
+def load_split(labels: Optional[list] = None, test_size: float = 0.1,
+               random_state: int = 0, path: str = metadata_path,
+               df: Optional[pd.DataFrame] = None
+               ) -> Tuple[np.array, np.array]:
+    """Return tuple of (training, validation) row numbers in metadata at
+    <path>, for the stratified train-val split of rows with label in <labels>
+    (all rows if None).
+
+    Rows are the same, and in the same order, as
+    train_test_split(df[df.label.isin(labels)], test_size=<test_size>,
+    random_state=<random_state>, stratify=df['label']). The split is computed
+    once per metadata contents and saved as arrays of row numbers.
+
+    ==Parameters==:
+        df: OPTIONAL. Metadata already loaded from <path>, to avoid reading
+                it again if the split must be computed
+    """
+    manifest_path = split_path(labels, test_size, random_state, path)
+    if os.path.exists(manifest_path):
+        with np.load(manifest_path) as split:
+            return split['train_rows'], split['val_rows']
+
+    if df is None:
+        df = pd.read_csv(path, usecols=['label'])
+    label_col = df['label'].to_numpy()
+    if labels is None:
+        rows = np.arange(len(df))
+    else:
+        rows = np.flatnonzero(np.isin(label_col, list(labels)))
+    train_rows, val_rows = train_test_split(rows, test_size=test_size,
+                                            random_state=random_state,
+                                            stratify=label_col[rows])
+    train_rows = train_rows.astype(np.int32)
+    val_rows = val_rows.astype(np.int32)
+
+    # Atomically save split manifest
+    if not os.path.exists(split_dir):
+        os.makedirs(split_dir)
+    with open(f"{manifest_path}.tmp", 'wb') as f:
+        np.savez(f, train_rows=train_rows, val_rows=val_rows)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+    return train_rows, val_rows
@@ -0,0 +1,175 @@
+import datetime
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Optional
+
+
+class Task:
+    """Unit of work in a TaskGraph, producing files at <outputs>.
+
+    A task is up to date if all its outputs exist, <is_complete> (if
+    specified) returns True, and its outputs are newer than the outputs of
+    its dependencies.
+
+    ==Attributes==:
+        name: unique name of task
+        func: module-level function called as func(*args, **kwargs) in a
+                worker process
+        outputs: paths of files created by task
+        deps: names of tasks that must finish before this task
+        cpus: number of CPUs reserved for the task while it runs
+        lock: OPTIONAL. Tasks with the same lock never run at the same time
+                (e.g. tasks using the GPU)
+        is_complete: OPTIONAL. Callable returning True if outputs are complete
+        isolate: if True, run in its own worker process, which exits when the
+                task finishes. TensorFlow only releases GPU memory when its
+                process exits, so tasks using the GPU must be isolated.
+    """
+
+    def __init__(self, name: str, func: Callable, args=(),
+                 kwargs: Optional[dict] = None, outputs=(), deps=(),
+                 cpus: int = 1, lock: Optional[str] = None,
+                 is_complete: Optional[Callable] = None,
+                 isolate: bool = False):
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.cpus = cpus
+        self.lock = lock
+        self.is_complete = is_complete
+        self.isolate = isolate
+
+    def outputs_exist(self) -> bool:
+        """Return True if all outputs exist and are complete."""
+        if not all(os.path.exists(path) for path in self.outputs):
+            return False
+        return self.is_complete is None or self.is_complete()
+
+    def oldest_output(self) -> float:
+        """Return modification time of the oldest output."""
+        return min((os.path.getmtime(path) for path in self.outputs),
+                   default=float('inf'))
+
+    def newest_output(self) -> float:
+        """Return modification time of the newest output."""
+        return max((os.path.getmtime(path) for path in self.outputs
+                    if os.path.exists(path)), default=0)
+
+
+class TaskGraph:
+    """Directed acyclic graph of Tasks, keyed by the files they create.
+
+    Only tasks that are out of date, or that depend on out-of-date tasks, are
+    run. Independent tasks run in parallel in a process pool, as long as their
+    CPUs fit within the CPU budget.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, task: Task) -> Task:
+        """Add <task> to the graph. Its dependencies must already be added."""
+        if task.name in self.tasks:
+            raise ValueError(f"Task {task.name} already exists!")
+        for dep in task.deps:
+            if dep not in self.tasks:
+                raise ValueError(f"Task {task.name} depends on unknown task "
+                                 f"{dep}!")
+        self.tasks[task.name] = task
+        return task
+
+    def get_stale(self, force: bool = False) -> set:
+        """Return names of tasks that need to be run. If <force>, all tasks
+        are stale.
+        """
+        stale = set()
+        # Dependencies are always added before dependents
+        for name, task in self.tasks.items():
+            if force or not task.outputs_exist() or \
+                    any(dep in stale for dep in task.deps) or \
+                    any(self.tasks[dep].newest_output() >
+                        task.oldest_output() for dep in task.deps):
+                stale.add(name)
+        return stale
+
+    def run(self, cpu_budget: int = os.cpu_count(),
+            max_workers: Optional[int] = None, force: bool = False) -> dict:
+        """Run all stale tasks, using at most <cpu_budget> CPUs at a time.
+        Return dictionary of task name to status ('up to date', 'done',
+        'failed' or 'cancelled'). Tasks depending on a failed task are
+        cancelled.
+        """
+        stale = self.get_stale(force)
+        status = {name: 'up to date' for name in self.tasks
+                  if name not in stale}
+        pending = [name for name in self.tasks if name in stale]
+        print(f"{len(pending)}/{len(self.tasks)} tasks to run.")
+
+        # Spawn workers, so they don't inherit TensorFlow/faiss state. Workers
+        # of the shared pool are reused across tasks. Isolated tasks get their
+        # own worker, which exits when the task finishes.
+        context = multiprocessing.get_context('spawn')
+        running = {}
+        isolated = {}
+        free_cpus = cpu_budget
+        with ProcessPoolExecutor(max_workers=max_workers or cpu_budget,
+                                 mp_context=context) as executor:
+            while pending or running:
+                # Cancel tasks depending on failed tasks
+                for name in list(pending):
+                    if any(status.get(dep) in ('failed', 'cancelled')
+                           for dep in self.tasks[name].deps):
+                        status[name] = 'cancelled'
+                        pending.remove(name)
+
+                # Start ready tasks that fit in CPU budget
+                locks = {self.tasks[name].lock for name, _ in running.values()}
+                for name in list(pending):
+                    task = self.tasks[name]
+                    cpus = min(task.cpus, cpu_budget)
+                    if cpus > free_cpus or \
+                            (task.lock is not None and task.lock in locks) or \
+                            any(status.get(dep) not in ('up to date', 'done')
+                                for dep in task.deps):
+                        continue
+                    if task.isolate:
+                        task_executor = ProcessPoolExecutor(
+                            max_workers=1, mp_context=context)
+                        future = task_executor.submit(task.func, *task.args,
+                                                      **task.kwargs)
+                        isolated[future] = task_executor
+                    else:
+                        future = executor.submit(task.func, *task.args,
+                                                 **task.kwargs)
+                    running[future] = (name, datetime.datetime.now())
+                    free_cpus -= cpus
+                    locks.add(task.lock)
+                    pending.remove(name)
+                    print(f"Started {name}")
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, start = running.pop(future)
+                    if future in isolated:
+                        isolated.pop(future).shutdown()
+                    free_cpus += min(self.tasks[name].cpus, cpu_budget)
+                    minutes = (datetime.datetime.now() - start
+                               ).total_seconds() / 60
+                    if future.exception() is not None:
+                        status[name] = 'failed'
+                        print(f"Failed {name}: {future.exception()!r}")
+                    else:
+                        status[name] = 'done'
+                        print(f"Finished {name} in {round(minutes, 2)} "
+                              f"minutes!")
+
+        for name in pending:
+            status[name] = 'cancelled'
+        return status
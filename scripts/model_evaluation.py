@@ -1,7 +1,12 @@
 import datetime
 import glob
+import hashlib
+import io
+import json
 import os
+import re
 import warnings
+from functools import partial
 from math import ceil
 from typing import List, Optional, Tuple
 
@@ -11,17 +16,20 @@ import faiss
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import scipy.stats as stats
 import seaborn as sns
 import tensorflow as tf
 import umap
 from sklearn import preprocessing
-from sklearn.model_selection import train_test_split
-from sklearn.neighbors import KNeighborsClassifier
 from tensorflow.keras.applications import EfficientNetB0
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 
+from data_processing.dir_manifest import get_manifest
+from data_processing.embedding_store import EmbeddingStore
+from data_processing.grayscale_model import to_grayscale_model
+from data_processing.instrumentation import instrumentation
 from data_processing.preprocessor import normalize as img_normalize
+from data_processing.results_db import ResultsDB
+from data_processing.split_manifest import load_split
+from data_processing.task_graph import Task, TaskGraph
 
 # Plotting Settings
 sns.set_style("white")
@@ -36,6 +44,7 @@ if "D:\\" in os.getcwd():
     embedding_dir = "M:/ferrero/stan_data/evaluation/"
     scripts_dir = "M:/home/stan/cytoimagenet/scripts"
     weights_dir = 'M:/home/stan/cytoimagenet/model/cytoimagenet-weights/'
+    model_dir = 'M:/home/stan/cytoimagenet/model/'
     plot_dir = "M:/home/stan/cytoimagenet/figures/"
 else:
     annotations_dir = "/home/stan/cytoimagenet/annotations/"
@@ -44,6 +53,7 @@ else:
     embedding_dir = "/ferrero/stan_data/evaluation/"
     scripts_dir = '/home/stan/cytoimagenet/scripts'
     weights_dir = '/home/stan/cytoimagenet/model/cytoimagenet-weights/'
+    model_dir = '/home/stan/cytoimagenet/model/'
     plot_dir = "/home/stan/cytoimagenet/figures/"
 
 
@@ -55,6 +65,10 @@ else:
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.filterwarnings("ignore", category=UserWarning)
 
+# Store of extracted embeddings
+embedding_store = EmbeddingStore(embedding_dir)
+results_db = ResultsDB(f"{evaluation_dir}results.db")
+
 # ==WEIGHTS==:
 # Weights for models trained on 894 class dataset
 weights_full_overfit = 'efficientnetb0_from_random(lr_0001_bs_64_epochs_100).h5'
@@ -67,16 +81,75 @@ weights_full_filtered_overfit = 'efficientnetb0_from_random-epoch_80.h5'
 weights_full_filtered_noaug = 'efficientnetb0_from_random-epoch_20.h5'
 
 
+# Models built in this process, keyed by load_model arguments
+model_registry = {}
+
+# Checksums of weights files, keyed by (path, size, modification time)
+checkpoint_registry = {}
+
+
+def file_checksum(path: str) -> str:
+    """Return SHA-256 checksum of file at <path>."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def weights_checkpoint(weights='cytoimagenet',
+                       weights_filename='efficientnetb0_from_random-epoch_24.h5',
+                       init='random', dset_=None) -> str:
+    """Return checkpoint identifying the weights loaded by load_model with the
+    same arguments, as the weights file and the start of its checksum.
+    ImageNet weights are identified by name.
+    """
+    if weights == "cytoimagenet":
+        path = f"{weights_dir}/{init}_init/{dset_}/{weights_filename}"
+        name = f"{init}_init/{dset_}/{weights_filename}"
+    elif weights is None:
+        path = f'{model_dir}random_efficientnetb0-notop.h5'
+        name = os.path.basename(path)
+    else:
+        return str(weights)
+    if not os.path.exists(path):
+        return name
+
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in checkpoint_registry:
+        checkpoint_registry[key] = file_checksum(path)[:16]
+    return f"{name}@{checkpoint_registry[key]}"
+
+
 def load_model(weights='cytoimagenet',
                weights_filename='efficientnetb0_from_random-epoch_24.h5',
-               init='random', overwrite=True, dset_=None, include_top=False):
+               init='random', overwrite=False, dset_=None, include_top=False,
+               channels=3):
     """Return EfficientNetB0 model. <weights> specify what weights to load into
     the model.
         - if weights == None, randomly initialize weights
         - elif weights == 'imagenet', load in weights from training on ImageNet
         - elif weights == 'cytoimagenet', load in weights from latest epoch
             of training on CytoImageNet.
+
+    Models are built once per process, and the same model is returned on
+    repeated calls with the same arguments. CytoImageNet weights without
+    prediction layers are saved once, alongside the checksum of the weights
+    they were converted from, and only converted again if the checksum
+    changes or if <overwrite>.
+
+    If <channels> == 1, return model accepting grayscale images, with stem
+    convolution weights summed across RGB channels. Its outputs are the same
+    as the RGB model's for grayscale images converted to RGB.
     """
+    if weights == "cytoimagenet":
+        key = (weights, weights_filename, init, dset_, include_top, channels)
+    else:
+        key = (weights, include_top, channels)
+    if key in model_registry and not overwrite:
+        return model_registry[key]
+
     if weights == "cytoimagenet":
         # Specify number of classes based on dset
         if dset_ == 'toy_20':
@@ -88,20 +161,34 @@ def load_model(weights='cytoimagenet',
         else:
             num_classes = 894
 
-        # Load weights
         weights_str = f"{weights_dir}/{init}_init/{dset_}/{weights_filename}"
-        model = EfficientNetB0(weights=None,
-                               input_shape=(224, 224, 3),
-                               classes=num_classes)
-        model.load_weights(weights_str)
 
-        if not include_top:
-            # Save notop weights if they don't exist
+        if include_top:
+            model = EfficientNetB0(weights=None,
+                                   input_shape=(224, 224, 3),
+                                   classes=num_classes)
+            model.load_weights(weights_str)
+        else:
+            # Save notop weights if they don't exist or are outdated
             weights_notop = weights_str.replace(".h5", "-notop.h5")
-            if not os.path.exists(weights_notop) or overwrite:
+            checksum = file_checksum(weights_str)
+            checksum_file = f"{weights_notop}.sha256"
+            saved_checksum = None
+            if os.path.exists(weights_notop) and \
+                    os.path.exists(checksum_file):
+                with open(checksum_file) as f:
+                    saved_checksum = f.read().strip()
+
+            if saved_checksum != checksum or overwrite:
                 # Save weights without prediction layers
+                model = EfficientNetB0(weights=None,
+                                       input_shape=(224, 224, 3),
+                                       classes=num_classes)
+                model.load_weights(weights_str)
                 model = tf.keras.Model(model.input, model.layers[-3].output)
                 model.save_weights(weights_notop)
+                with open(checksum_file, 'w') as f:
+                    f.write(checksum)
 
             # Load model weights with no top
             model = EfficientNetB0(weights=weights_notop,
@@ -109,7 +196,7 @@ def load_model(weights='cytoimagenet',
                                    input_shape=(None, None, 3),
                                    pooling="avg")
     elif weights is None:
-        weights_str = f'/home/stan/cytoimagenet/model/random_efficientnetb0-notop.h5'
+        weights_str = f'{model_dir}random_efficientnetb0-notop.h5'
         if not os.path.exists(
                 weights_str):  # if random weights doesn't exist yet
             model = EfficientNetB0(weights=None,
@@ -126,6 +213,15 @@ def load_model(weights='cytoimagenet',
                                include_top=include_top,
                                input_shape=(None, None, 3),
                                pooling="avg")
+
+    if channels == 1:
+        with_top = include_top and weights is not None
+        model = to_grayscale_model(model, lambda x: EfficientNetB0(
+            weights=None, include_top=with_top, input_tensor=x,
+            pooling="avg",
+            classes=model.output_shape[-1] if with_top else 1000))
+
+    model_registry[key] = model
     return model
 
 
@@ -139,57 +235,105 @@ class FaissKNeighbors:
 
     Cosine similarity code modified from GitHub Issue.
     Link: https://github.com/facebookresearch/faiss/issues/1119#issuecomment-596514782
+
+    ==Parameters==:
+        index: type of faiss index. One of
+            - 'flat': exact search
+            - 'ivf': inverted file index, searching <nprobe> of <nlist> lists
+            - 'hnsw': HNSW graph with <hnsw_m> links per node, searching with
+                <ef_search> candidates
+            - 'ivfpq': inverted file index with product-quantized vectors,
+                using <pq_m> sub-quantizers of 8 bits
+        nlist: number of inverted lists. Defaults to sqrt(num_samples)
     """
 
-    def __init__(self, k=5, metric='euclidean'):
+    def __init__(self, k=5, metric='euclidean', index='flat',
+                 nlist: Optional[int] = None, nprobe: int = 16,
+                 hnsw_m: int = 32, ef_search: int = 128, pq_m: int = 16):
         self.metric = metric
+        self.index_type = index
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.pq_m = pq_m
         self.index = None
+        self.quantizer = None
         self.y = None
         self.k = k
 
+    def prepare(self, X) -> np.array:
+        """Return <X> as a C-contiguous float32 array, L2-normalized if using
+        cosine distance. <X> is only copied if needed.
+        """
+        if self.metric == 'cosine':
+            # Normalization is in-place, so never modify the input
+            X = np.array(X, dtype=np.float32, order='C', copy=True)
+            faiss.normalize_L2(X)
+            return X
+        return np.ascontiguousarray(X, dtype=np.float32)
+
+    def create_index(self, num_samples: int, num_features: int):
+        """Return untrained faiss index specified by <index_type>."""
+        if self.metric == 'cosine':
+            faiss_metric = faiss.METRIC_INNER_PRODUCT
+            self.quantizer = faiss.IndexFlatIP(num_features)
+        else:
+            faiss_metric = faiss.METRIC_L2
+            self.quantizer = faiss.IndexFlatL2(num_features)
+        nlist = self.nlist or max(int(np.sqrt(num_samples)), 1)
+
+        if self.index_type == 'flat':
+            index = self.quantizer
+            self.quantizer = None
+        elif self.index_type == 'ivf':
+            index = faiss.IndexIVFFlat(self.quantizer, num_features, nlist,
+                                       faiss_metric)
+            index.nprobe = self.nprobe
+        elif self.index_type == 'hnsw':
+            index = faiss.IndexHNSWFlat(num_features, self.hnsw_m,
+                                        faiss_metric)
+            index.hnsw.efSearch = self.ef_search
+        elif self.index_type == 'ivfpq':
+            index = faiss.IndexIVFPQ(self.quantizer, num_features, nlist,
+                                     self.pq_m, 8, faiss_metric)
+            index.nprobe = self.nprobe
+        else:
+            raise ValueError(f"Invalid index type: {self.index_type}")
+        return index
+
     def fit(self, X, y):
-        X_copy = X.copy()
-        if self.metric == 'euclidean':
-            self.index = faiss.IndexFlatL2(X.shape[1])
-        else:  # cosine distance
-            quantizer = faiss.IndexFlatIP(X.shape[1])
-            self.index = faiss.IndexIVFFlat(quantizer, X.shape[1],
-                                            int(np.sqrt(X.shape[0])),
-                                            faiss.METRIC_INNER_PRODUCT)
-            faiss.normalize_L2(X_copy.astype(np.float32))
-            self.index.train(X_copy.astype(np.float32))
-        self.index.add(X_copy.astype(np.float32))
-        self.y = y
+        X = self.prepare(X)
+        self.index = self.create_index(*X.shape)
+        if not self.index.is_trained:
+            self.index.train(X)
+        self.index.add(X)
+        self.y = np.asarray(y)
 
     def predict(self, X):
-        # Create deep copy
-        X_copy = X.copy()
-
-        if self.metric == 'cosine':
-            # L2 Normalize
-            faiss.normalize_L2(X_copy.astype(np.float32))
-
-        distances, indices = self.index.search(X_copy.astype(np.float32),
-                                               k=self.k)
-        votes = self.y[indices]
-        predictions = np.array([np.argmax(np.bincount(x)) for x in votes])
-        return predictions
+        distances, indices = self.index.search(self.prepare(X), k=self.k)
+        return majority_vote(self.y[indices], self.y.max() + 1)
 
     def kneighbors(self, X, n_neighbors: int):
-        if isinstance(X, list):
-            X_copy = np.array(X)
-        else:
-            # Create deep copy
-            X_copy = X.copy()
-
-        if self.metric == 'cosine':
-            # L2 Normalize
-            faiss.normalize_L2(X_copy.astype(np.float32))
+        dist, ind = self.index.search(self.prepare(X), k=n_neighbors)
+        return dist, ind
 
-        dist, ind = self.index.search(X_copy.astype(np.float32),
-                                      k=n_neighbors)
+    def save(self, path: str) -> None:
+        """Save fitted faiss index to <path>. The temporary file is unique to
+        this process, so processes saving the same index don't collide.
+        """
+        faiss.write_index(self.index, f"{path}.{os.getpid()}.tmp")
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
 
-        return dist, ind
+    def load(self, path: str, y=None) -> None:
+        """Load fitted faiss index from <path>, with labels <y>."""
+        self.index = faiss.read_index(path)
+        # Search parameters are not always saved with the index
+        if self.index_type in ('ivf', 'ivfpq'):
+            faiss.extract_index_ivf(self.index).nprobe = self.nprobe
+        elif self.index_type == 'hnsw':
+            self.index.hnsw.efSearch = self.ef_search
+        self.y = None if y is None else np.asarray(y)
 
 
 # HELPER FUNCTIONS:
@@ -219,6 +363,79 @@ def check_weights_str(weights, weights_suffix=''):
     return weights_str
 
 
+def embeddings_exist(name: str, weights_str: str, concat: bool,
+                     norm: bool) -> bool:
+    """Return True if embeddings for dataset <name> exist in the embedding
+    store, or as a legacy HDF5 file."""
+    return embedding_store.exists(name, weights_str, concat, norm) or \
+        os.path.exists(legacy_embeddings_path(name, weights_str, concat, norm))
+
+
+def load_embeddings(name: str, weights_str: str, concat: bool,
+                    norm: bool, path_gens: Optional[list] = None) -> np.array:
+    """Return embeddings for dataset <name>. Embeddings in the embedding store
+    are memory-mapped. Legacy HDF5 embeddings are read into memory.
+
+    If <path_gens> is specified and embeddings were saved for images in a
+    different order, return embeddings reordered to match <path_gens>.
+    """
+    if embedding_store.exists(name, weights_str, concat, norm):
+        embeddings = embedding_store.load(name, weights_str, concat, norm)
+        saved_paths = embedding_store.load_metadata(name, weights_str,
+                                                    concat, norm)
+        if path_gens is None or saved_paths is None or \
+                saved_paths['channel_0'].tolist() == list(path_gens[0]):
+            return embeddings
+        # Reorder rows to match current order of images
+        row_by_path = pd.Series(np.arange(len(saved_paths)),
+                                index=saved_paths['channel_0'])
+        return embeddings[row_by_path.loc[list(path_gens[0])].to_numpy()]
+    return pd.read_hdf(legacy_embeddings_path(name, weights_str, concat, norm),
+                       'embed').to_numpy()
+
+
+def legacy_embeddings_path(name: str, weights_str: str, concat: bool,
+                           norm: bool) -> str:
+    """Return path to embeddings saved with DataFrame.to_hdf."""
+    return f"{embedding_dir}{weights_str}_embeddings/{name}_embeddings " \
+           f"({weights_str}, {create_save_str(concat, norm)}).h5"
+
+
+def instrumentation_path(name: str, stage: str, weights_str=None,
+                         concat=None, norm=None) -> str:
+    """Return path to save instrumentation of a run of <stage> on dataset
+    <name>. Each run has its own timestamped file.
+    """
+    config = ''
+    if weights_str is not None:
+        config = f"({weights_str}, {create_save_str(concat, norm)})"
+    timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    return f"{evaluation_dir}instrumentation/{name}_{stage}{config}-" \
+           f"{timestamp}.json"
+
+
+def log_inference_time(name: str, weights_str: str, concat: bool, norm: bool,
+                       minutes: float) -> None:
+    """Record <minutes> taken to extract embeddings for dataset <name> in its
+    inference times csv file, replacing the past record for the same
+    preprocessing.
+    """
+    time_dir = f"{evaluation_dir}inference_times"
+    if not os.path.exists(time_dir):
+        os.makedirs(time_dir)
+    filename = f"{time_dir}/{name}_inference_times({weights_str}).csv"
+
+    df_curr = pd.DataFrame({'to_grayscale': not concat, 'normalize': norm,
+                            'minutes': minutes}, index=[0])
+    if os.path.exists(filename):
+        df_time = pd.read_csv(filename)
+        # Remove past record
+        df_time = df_time[(df_time.to_grayscale != (not concat)) |
+                          (df_time.normalize != norm)]
+        df_curr = pd.concat([df_time, df_curr])
+    df_curr.to_csv(filename, index=False)
+
+
 def timer(start, end, print_out=False):
     time_delta = (end - start)
     total_seconds = time_delta.total_seconds()
@@ -228,6 +445,133 @@ def timer(start, end, print_out=False):
     return minutes
 
 
+def drop_self_neighbors(neigh_dist: np.array, neigh_ind: np.array) -> tuple:
+    """Return (distances, indices) of neighbours, with each query's own index
+    removed. Query i is assumed to be sample i in the fitted index, and
+    searched with one more neighbour than needed. If a query is not found
+    among its neighbours, its furthest neighbour is removed instead.
+    """
+    is_self = neigh_ind == np.arange(len(neigh_ind))[:, None]
+    # Keep first occurrence only
+    is_self &= np.cumsum(is_self, axis=1) == 1
+    is_self[~is_self.any(axis=1), -1] = True
+
+    shape = (len(neigh_ind), neigh_ind.shape[1] - 1)
+    return neigh_dist[~is_self].reshape(shape), \
+        neigh_ind[~is_self].reshape(shape)
+
+
+def distance_weights(neigh_dist: np.array) -> np.array:
+    """Return vote weights of 1 / distance for neighbours at <neigh_dist>, as
+    in KNeighborsClassifier(weights='distance'). Negative distances (from
+    floating-point error) are clipped to 0. If a sample has neighbours at
+    distance 0, only those neighbours vote, with weight 1. Neighbours at
+    infinite distance have no vote.
+    """
+    neigh_dist = np.maximum(neigh_dist, 0)
+    with np.errstate(divide='ignore'):
+        neigh_weights = 1. / neigh_dist
+    is_exact = np.isinf(neigh_weights)
+    has_exact = is_exact.any(axis=1)
+    neigh_weights[has_exact] = is_exact[has_exact]
+    return neigh_weights
+
+
+def majority_vote(neigh_labels: np.array, num_classes: int,
+                  neigh_weights: np.array = None) -> np.array:
+    """Return predicted label for each row of <neigh_labels>, an array of
+    (num_samples, k) encoded labels of neighbours ordered from closest to
+    furthest.
+
+    Each neighbour votes for its label, with weight <neigh_weights> if
+    specified. Ties are broken by the closest neighbour among tied labels.
+    """
+    rows = np.arange(len(neigh_labels))[:, None]
+    votes = np.zeros((len(neigh_labels), num_classes), dtype=np.float64)
+    if neigh_weights is None:
+        neigh_weights = np.ones(neigh_labels.shape)
+    np.add.at(votes, (rows, neigh_labels), neigh_weights)
+
+    # Closest neighbour with a label that has the most votes
+    is_tied = votes[rows, neigh_labels] == votes.max(axis=1)[:, None]
+    return neigh_labels[rows[:, 0], np.argmax(is_tied, axis=1)]
+
+
+def knn_results(neigh_labels: np.array, test_labels: np.array,
+                class_names: np.array,
+                neigh_weights: np.array = None) -> pd.DataFrame:
+    """Return dataframe of kNN classification results by class, given encoded
+    labels of neighbours <neigh_labels> of (num_samples, k) and encoded
+    <test_labels>. Predictions are by (weighted) majority vote.
+    """
+    # Majority vote. Ties are broken by the closest neighbour
+    predicted = majority_vote(neigh_labels, len(class_names), neigh_weights)
+
+    # Check prediction accuracy
+    is_correct = predicted == test_labels
+    correct_by_class = np.bincount(test_labels[is_correct],
+                                   minlength=len(class_names))
+    total_by_class = np.bincount(test_labels, minlength=len(class_names))
+
+    df_results = pd.DataFrame()
+    df_results['labels'] = class_names
+    df_results['correct_by_class'] = correct_by_class
+    df_results['total_by_class'] = total_by_class
+    df_results['accuracy_by_class'] = correct_by_class / total_by_class
+    df_results['total_accuracy'] = is_correct.sum() / len(test_labels)
+    return df_results
+
+
+def masked_neighbors(X: np.array, k: int, groups: tuple = (),
+                     metric='cosine', block_size: int = 1024) -> tuple:
+    """Return (distances, indices) of the <k> nearest neighbours of each
+    sample in <X>, among all other samples. Each array in <groups> assigns
+    samples to groups (e.g. compound), and neighbours that share a group with
+    the query are ignored. Neighbours are ordered from closest to furthest.
+
+    Distances are computed <block_size> queries at a time. If fewer than <k>
+    neighbours are left for a query, remaining neighbours have distance inf.
+
+    Raises ValueError if an array in <groups> doesn't have one group per
+    sample.
+    """
+    for group in groups:
+        if group is None or len(group) != len(X):
+            raise ValueError(f"Expected groups of {len(X)} samples. Got "
+                             f"{None if group is None else len(group)}")
+    X = np.asarray(X, dtype=np.float64)
+    if metric == 'cosine':
+        X = X / np.linalg.norm(X, axis=1, keepdims=True)
+    sq_norms = (X ** 2).sum(axis=1)
+    k = min(k, len(X) - 1)
+
+    neigh_dist = np.empty((len(X), k), dtype=np.float64)
+    neigh_ind = np.empty((len(X), k), dtype=np.int64)
+    for start in range(0, len(X), block_size):
+        rows = np.arange(start, min(start + block_size, len(X)))
+        if metric == 'cosine':
+            dist = 1 - X[rows] @ X.T
+        else:
+            dist = sq_norms[rows, None] + sq_norms[None] - 2 * X[rows] @ X.T
+            dist = np.sqrt(np.maximum(dist, 0))
+
+        # Mask query itself and samples in the same group
+        mask = rows[:, None] == np.arange(len(X))[None]
+        for group in groups:
+            group = np.asarray(group)
+            mask |= group[rows, None] == group[None]
+        dist[mask] = np.inf
+
+        # Top k per row, then sort by distance
+        ind = np.argpartition(dist, k - 1, axis=1)[:, :k]
+        dist = np.take_along_axis(dist, ind, axis=1)
+        order = np.argsort(dist, axis=1, kind='stable')
+        neigh_ind[rows] = np.take_along_axis(ind, order, axis=1)
+        neigh_dist[rows] = np.take_along_axis(dist, order, axis=1)
+
+    return neigh_dist, neigh_ind
+
+
 class ImageGenerator:
     """ImageGenerator Class. Used to return multi-channel images.
 
@@ -243,43 +587,79 @@ class ImageGenerator:
     """
 
     def __init__(self, path_gens: list, concat: bool, norm: bool,
-                 labels: Optional[list] = None):
+                 labels: Optional[list] = None, channels: int = 3):
         self.path_gens = path_gens
         self.concat = concat
         self.norm = norm
         self.labels = labels
+        self.channels = channels
         self.read_with = 'PIL'
 
-    def get_image(self, paths: list):
-        """Returns channel image/s after image operations specified in
-        class attributes.
-        """
-        imgs = []
-        for path in paths:
-            # Load images using OpenCV by default. PIL is used otherwise.
+    def read_image(self, path: str) -> np.array:
+        """Return channel image at <path>."""
+        with instrumentation.timer('image_read'):
+            with open(path, 'rb') as f:
+                data = f.read()
+        instrumentation.count('image_read.bytes', len(data))
+
+        # Decode images using OpenCV by default. PIL is used otherwise.
+        with instrumentation.timer('image_decode'):
             if self.read_with == 'cv2':
-                img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+                img = cv2.imdecode(np.frombuffer(data, np.uint8),
+                                   cv2.IMREAD_GRAYSCALE)
                 # Begin reading with PIL if cv2 fails
                 if img is None:
                     self.read_with = 'PIL'
-                    img = np.array(PIL.Image.open(path))
+                    img = np.array(PIL.Image.open(io.BytesIO(data)))
             else:
-                img = np.array(PIL.Image.open(path))
-
-            # Normalize between 0.1 and 99.9th percentile
-            if self.norm:
-                img = img_normalize(img) * 255
-
-            # Convert grayscale to RGB
-            imgs.append(np.stack([img] * 3, axis=-1))
+                img = np.array(PIL.Image.open(io.BytesIO(data)))
+        return img
+
+    @staticmethod
+    def process_image(channel_imgs: list, concat: bool, norm: bool,
+                      channels: int = 3):
+        """Returns channel image/s after preprocessing <channel_imgs> with
+        <concat> and <norm>, with <channels> color channels (1: grayscale,
+        3: RGB). Images in <channel_imgs> are not modified.
+        """
+        # Normalize between 0.1 and 99.9th percentile
+        if norm:
+            with instrumentation.timer('image_normalize',
+                                       items=len(channel_imgs)):
+                channel_imgs = [img_normalize(img.copy()) * 255
+                                for img in channel_imgs]
+
+        with instrumentation.timer('channel_merge'):
+            # Convert grayscale to RGB, or add channel axis
+            imgs = [np.stack([img] * channels, axis=-1)
+                    for img in channel_imgs]
+
+            # If concat, return array of images
+            if concat:
+                return np.array(imgs)
+
+            # Else, average over channel images to create single grayscale
+            # image
+            img = np.array(imgs).mean(axis=0)
+            return np.expand_dims(img, axis=0)
 
-        # If concat, return array of images
-        if self.concat:
-            return np.array(imgs)
+    def get_image(self, paths: list):
+        """Returns channel image/s after image operations specified in
+        class attributes.
+        """
+        channel_imgs = [self.read_image(path) for path in paths]
+        return self.process_image(channel_imgs, self.concat, self.norm,
+                                  self.channels)
 
-        # Else, average over channel images to create single grayscale image
-        img = np.array(imgs).mean(axis=0)
-        return np.expand_dims(img, axis=0)
+    def get_image_variants(self, i, variants: tuple) -> list:
+        """Return list of float32 channel image/s for the <i>th image, one for
+        each (concat, norm) in <variants>. Channel images are read once.
+        """
+        paths = [gen[int(i)] for gen in self.path_gens]
+        channel_imgs = [self.read_image(path) for path in paths]
+        return [self.process_image(channel_imgs, concat, norm,
+                                   self.channels).astype(np.float32)
+                for concat, norm in variants]
 
     def __iter__(self):
         for i in range(len(self)):
@@ -294,6 +674,66 @@ class ImageGenerator:
     def __len__(self):
         return len(self.path_gens[0])
 
+    def get_image_by_index(self, i) -> np.array:
+        """Return float32 channel image/s for the <i>th image."""
+        paths = [gen[int(i)] for gen in self.path_gens]
+        return self.get_image(paths).astype(np.float32)
+
+    def as_dataset(self, batch_size: int = 1,
+                   num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                   start: int = 0) -> tf.data.Dataset:
+        """Return tf.data.Dataset of batched images, which reads and
+        normalizes channel images in parallel.
+
+        Each batch contains <batch_size> images, where an image contributes
+        <num_channels> consecutive channel images if concat, or 1 merged
+        image otherwise. Order of images is the same as in <path_gens>,
+        beginning from the <start>th image.
+
+        NOTE: Images in a batch must share the same height and width.
+        """
+        ds = tf.data.Dataset.range(start, len(self))
+        ds = ds.map(lambda i: tf.numpy_function(self.get_image_by_index, [i],
+                                                tf.float32),
+                    num_parallel_calls=num_parallel_calls,
+                    deterministic=True)
+        ds = ds.map(lambda img: tf.ensure_shape(
+            img, [None, None, None, self.channels]))
+        # Flatten (batch, channels, H, W, C) to (batch * channels, H, W, C)
+        ds = ds.batch(batch_size)
+        ds = ds.map(lambda imgs: tf.reshape(
+            imgs, tf.concat([[-1], tf.shape(imgs)[2:]], axis=0)))
+        ds = ds.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        return ds
+
+    def as_fused_dataset(self, variants: tuple, batch_size: int = 1,
+                         num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                         start: int = 0) -> tf.data.Dataset:
+        """Return tf.data.Dataset of tuples of batched images, containing one
+        batch for each (concat, norm) in <variants>. Each image is read once,
+        then preprocessed for every variant. Begins from the <start>th image.
+
+        See ImageGenerator.as_dataset.
+        """
+        def flatten(imgs):
+            # (batch, channels, H, W, C) to (batch * channels, H, W, C)
+            return tf.reshape(imgs, tf.concat([[-1], tf.shape(imgs)[2:]],
+                                              axis=0))
+
+        ds = tf.data.Dataset.range(start, len(self))
+        ds = ds.map(lambda i: tuple(tf.numpy_function(
+            lambda j: self.get_image_variants(j, variants), [i],
+            [tf.float32] * len(variants))),
+                    num_parallel_calls=num_parallel_calls,
+                    deterministic=True)
+        ds = ds.map(lambda *imgs: tuple(
+            tf.ensure_shape(img, [None, None, None, self.channels])
+            for img in imgs))
+        ds = ds.batch(batch_size)
+        ds = ds.map(lambda *imgs: tuple(flatten(img) for img in imgs))
+        ds = ds.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        return ds
+
 
 # VALIDATION SET & DOWNSTREAM TASKS:
 class ValidationProcedure:
@@ -324,7 +764,17 @@ class ValidationProcedure:
             tuple of k values to test in kNN
         cytoimagenet_weights_suffix:
             suffix that specifies cytoimagenet weights used
+        input_channels:
+            number of color channels passed to models. Images are grayscale,
+            so 1 gives the same embeddings as RGB with 3x less input data
+        batch_size:
+            number of images per forward pass during extraction. 1 for
+            datasets of full fields of view, which don't fit on the GPU in
+            larger batches
     """
+    input_channels = 1
+    batch_size = 1
+    k_values = (1,)
 
     def __init__(self, dset):
         self.metadata = self.load_metadata()
@@ -333,7 +783,6 @@ class ValidationProcedure:
         self.num_channels = 3
         self.path_gens = self.create_path_iterators()
         self.len_dataset = len(self.path_gens[0])
-        self.k_values = (1,)
         self.dset = dset
 
         self.cytoimagenet_weights_suffix = ''
@@ -350,56 +799,257 @@ class ValidationProcedure:
         raise NotImplementedError()
 
     def extract_embeddings(self, concat=True, norm=False, weights="imagenet",
-                           overwrite=False, save=True) -> pd.DataFrame:
-        """Extract activations/embeddings for evaluation set.
+                           overwrite=False, save=True, batch_size=None,
+                           path_gens=None, name=None,
+                           dtype='float32', resume=False,
+                           commit_every=2048) -> np.array:
+        """Return array of activations/embeddings extracted for evaluation set.
             - If concat, extract embeddings for each channel. Else, average channels
                 to produce 1 grayscale image, then extract embeddings.
             - If norm, then normalize image between [0 and 1] with respect to
                 0.1th and 99.9th then normalize once again to [0, 255] by
                 multiplying 255.
+
+        Images are read and preprocessed in parallel, then passed to the
+        model in batches of <batch_size> images (the procedure's batch_size
+        if None). If <save>, embeddings are
+        appended to the embedding store in chunks (as <dtype>), and returned
+        memory-mapped. Otherwise, they are written into a preallocated
+        (num_images, num_features) array.
+
+        Every <commit_every> images, extracted embeddings are committed to the
+        store. If <resume> and a partial extraction was saved, continue
+        extraction after the last committed image.
+
+        If <path_gens> and <name> are specified, extract embeddings for those
+        images instead of the evaluation set's.
         """
+        if path_gens is None:
+            path_gens = self.path_gens
+        if name is None:
+            name = self.name
+        if batch_size is None:
+            batch_size = self.batch_size
+
+        instrumentation.reset()
+        weights_str = check_weights_str(weights,
+                                        self.cytoimagenet_weights_suffix)
+
         # Load model
-        model = load_model(weights, overwrite=overwrite, dset_=self.dset)
-
-        # Create efficient data generators
-        test_generator = ImageGenerator(self.path_gens, concat, norm)
-        ds_test = tf.data.Dataset.from_generator(lambda: test_generator,
-                                                 output_types=(tf.float32))
-
-        # Prefetch data in batches
-        batch_size = 1
-        # ds_test = ds_test.batch(batch_size)
-        ds_test = ds_test.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-        steps_to_predict = ceil(len(test_generator) / batch_size)
-        # Extract embeddings
-        accum_activations = model.predict(ds_test, verbose=1,
-                                          steps=steps_to_predict, workers=32)
+        with instrumentation.timer('model_load'):
+            model = load_model(weights, dset_=self.dset,
+                               channels=self.input_channels)
+
+        test_generator = ImageGenerator(path_gens, concat, norm,
+                                        channels=self.input_channels)
+        num_images = len(test_generator)
 
-        # Concatenate <num_channels> consecutive feature vectors that correspond to 1 image
+        # Number of features per image. If concat, features of consecutive
+        # channel images are concatenated.
+        num_features = model.output_shape[-1]
         if concat:
-            proc_activations = []
-            for i in range(self.num_channels, len(accum_activations) + 1,
-                           self.num_channels):
-                proc_activations.append(
-                    accum_activations[i - self.num_channels:i].flatten())
-            activations = pd.DataFrame(proc_activations)
+            num_features *= len(path_gens)
+
+        # If saving, append embeddings to the embedding store as they are
+        # extracted. Otherwise, write into a preallocated array.
+        start_row = 0
+        if save:
+            channel_paths = pd.DataFrame({f"channel_{i}": path_gens[i]
+                                          for i in range(len(path_gens))})
+            if resume and embedding_store.can_resume(
+                    name, weights_str, concat, norm, num_features,
+                    channel_paths):
+                writer = embedding_store.resume(name, weights_str, concat,
+                                                norm)
+                start_row = writer.num_rows
+                print(f"Resuming extraction from image {start_row}/"
+                      f"{num_images}...")
+            else:
+                writer = embedding_store.create(name, weights_str, concat,
+                                                norm, num_features,
+                                                dtype=dtype,
+                                                metadata=channel_paths)
         else:
-            activations = pd.DataFrame(accum_activations)
+            activations = np.empty((num_images, num_features), dtype=dtype)
+
+        # Create parallel input pipeline
+        ds_test = test_generator.as_dataset(batch_size=batch_size,
+                                            start=start_row)
+        steps_to_predict = ceil((num_images - start_row) / batch_size)
+
+        # Extract embeddings
+        progress_bar = tf.keras.utils.Progbar(steps_to_predict)
+        row = start_row
+        for imgs in instrumentation.timed(ds_test, 'input_wait'):
+            with instrumentation.timer('model_forward', items=len(imgs)):
+                features = np.asarray(model.predict_on_batch(imgs),
+                                      dtype=np.float32)
+            # Concatenate <num_channels> consecutive feature vectors that
+            # correspond to 1 image (as a view)
+            features = features.reshape(-1, num_features)
+            with instrumentation.timer('embedding_write', items=len(features)):
+                if save:
+                    writer.append(features)
+                    # Commit chunk of extracted embeddings
+                    if (row + len(features)) // commit_every > \
+                            row // commit_every:
+                        writer.commit()
+                else:
+                    activations[row:row + len(features)] = features
+            row += len(features)
+            progress_bar.add(1)
 
         # Save extracted embeddings
         if save:
+            with instrumentation.timer('embedding_write', items=0):
+                writer.close()
+            activations = embedding_store.load(name, weights_str, concat, norm)
+
+        instrumentation.export(
+            instrumentation_path(name, 'extraction', weights_str, concat,
+                                 norm),
+            dataset=name, stage='extraction', weights=weights_str,
+            concat=concat, norm=norm, batch_size=batch_size,
+            num_images=num_images, start_row=start_row)
+        return activations
+
+    def extract_embeddings_fused(self,
+                                 weights_list=('cytoimagenet', 'imagenet',
+                                               None),
+                                 variants=((True, True), (True, False),
+                                           (False, True), (False, False)),
+                                 overwrite=False, batch_size=None,
+                                 path_gens=None, name=None,
+                                 dtype='float32', commit_every=2048) -> None:
+        """Extract and save embeddings for every weights in <weights_list> and
+        every (concat, norm) in <variants>, reading each image only once.
+
+        Each image is read, then preprocessed for every variant. Each
+        preprocessed batch is passed to every model, and each
+        (weights, concat, norm) stream is saved to its own entry in the
+        embedding store. Existing embeddings are skipped, unless <overwrite>.
+
+        Unless <overwrite>, entries of an interrupted extraction are resumed.
+        Extraction continues from the smallest number of committed rows
+        across entries, and each entry only appends rows it's missing.
+
+        See ValidationProcedure.extract_embeddings.
+        """
+        if path_gens is None:
+            path_gens = self.path_gens
+        if name is None:
+            name = self.name
+        if batch_size is None:
+            batch_size = self.batch_size
+
+        # Only extract missing embeddings
+        to_extract = []
+        for weights in weights_list:
             weights_str = check_weights_str(weights,
                                             self.cytoimagenet_weights_suffix)
+            for concat, norm in variants:
+                if overwrite or not embeddings_exist(name, weights_str,
+                                                     concat, norm):
+                    to_extract.append((weights, concat, norm))
+        if len(to_extract) == 0:
+            return
+        weights_list = [w for w in weights_list
+                        if w in [key[0] for key in to_extract]]
+        variants = [v for v in variants
+                    if v in [key[1:] for key in to_extract]]
+
+        instrumentation.reset()
+
+        # Load models
+        with instrumentation.timer('model_load', items=len(weights_list)):
+            models = {weights: load_model(weights, dset_=self.dset,
+                                          channels=self.input_channels)
+                      for weights in weights_list}
+
+        # Create writers for each (weights, concat, norm), or reopen those
+        # of an interrupted extraction
+        channel_paths = pd.DataFrame({f"channel_{i}": path_gens[i]
+                                      for i in range(len(path_gens))})
+        writers = {}
+        for weights, concat, norm in to_extract:
+            weights_str = check_weights_str(weights,
+                                            self.cytoimagenet_weights_suffix)
+            num_features = models[weights].output_shape[-1]
+            if concat:
+                num_features *= len(path_gens)
+            if not overwrite and embedding_store.can_resume(
+                    name, weights_str, concat, norm, num_features,
+                    channel_paths):
+                writers[(weights, concat, norm)] = embedding_store.resume(
+                    name, weights_str, concat, norm)
+            else:
+                writers[(weights, concat, norm)] = embedding_store.create(
+                    name, weights_str, concat, norm, num_features,
+                    dtype=dtype, metadata=channel_paths)
+        start_row = min(writer.num_rows for writer in writers.values())
+        if start_row > 0:
+            print(f"Resuming fused extraction from image {start_row}/"
+                  f"{len(channel_paths)}...")
+
+        # Create parallel input pipeline, which reads each image once
+        test_generator = ImageGenerator(path_gens, concat=True, norm=False,
+                                        channels=self.input_channels)
+        ds_test = test_generator.as_fused_dataset(variants,
+                                                  batch_size=batch_size,
+                                                  start=start_row)
+        steps_to_predict = ceil((len(test_generator) - start_row) /
+                                batch_size)
 
-            # Check if directory exists
-            if not os.path.exists(f"{embedding_dir}/{weights_str}_embeddings"):
-                os.mkdir(f"{embedding_dir}/{weights_str}_embeddings")
-
-            filename = f"{embedding_dir}{weights_str}_embeddings/{self.name}_embeddings"
-            filename += f" ({weights_str}, {create_save_str(concat, norm)})"
-
-            activations.to_hdf(f"{filename}.h5", key='embed', index=False)
-        return activations
+        # Extract embeddings
+        print(f"Beginning fused extraction of {name.upper()} for "
+              f"{len(writers)} weights/preprocessing combinations...")
+        progress_bar = tf.keras.utils.Progbar(steps_to_predict)
+        row = start_row
+        for variant_imgs in instrumentation.timed(ds_test, 'input_wait'):
+            # Number of images in batch
+            batch_rows = len(variant_imgs[0])
+            if variants[0][0]:
+                batch_rows //= len(path_gens)
+
+            for (concat, norm), imgs in zip(variants, variant_imgs):
+                for weights in weights_list:
+                    if (weights, concat, norm) not in writers:
+                        continue
+                    writer = writers[(weights, concat, norm)]
+                    # Skip rows already committed by this entry
+                    skip_rows = writer.num_rows - row
+                    if skip_rows >= batch_rows:
+                        continue
+                    with instrumentation.timer('model_forward',
+                                               items=len(imgs)):
+                        features = np.asarray(
+                            models[weights].predict_on_batch(imgs),
+                            dtype=np.float32)
+                    with instrumentation.timer('embedding_write',
+                                               items=batch_rows - skip_rows):
+                        writer.append(features.reshape(
+                            -1, writer.manifest['num_features'])[skip_rows:])
+
+            # Commit chunk of extracted embeddings
+            if (row + batch_rows) // commit_every > row // commit_every:
+                with instrumentation.timer('embedding_write', items=0):
+                    for writer in writers.values():
+                        writer.commit()
+            row += batch_rows
+            progress_bar.add(1)
+
+        with instrumentation.timer('embedding_write', items=0):
+            for writer in writers.values():
+                writer.close()
+
+        instrumentation.export(
+            instrumentation_path(name, 'fused_extraction'),
+            dataset=name, stage='fused_extraction',
+            entries=[[check_weights_str(weights,
+                                        self.cytoimagenet_weights_suffix),
+                      concat, norm] for weights, concat, norm in writers],
+            batch_size=batch_size, num_images=len(test_generator),
+            start_row=start_row)
 
     def load_activations(self, concat=True, norm=False, weights="imagenet",
                          overwrite=False) -> pd.DataFrame:
@@ -407,50 +1057,32 @@ class ValidationProcedure:
         correspond to rows in the metadata. Activations are centered and
         standardized.
 
-        If <overwrite>, extract embeddings again.
+        If <overwrite>, extract embeddings again. Otherwise, if a previous
+        extraction was interrupted, resume from its last committed chunk.
         """
         # Filename of embeddings
         weights_str = check_weights_str(weights,
                                         self.cytoimagenet_weights_suffix)
-        filename = f"{embedding_dir}{weights_str}_embeddings/{self.name}_embeddings"
         suffix = f" ({weights_str}, {create_save_str(concat, norm)})"
         # Load embeddings if present
-        if os.path.exists(f"{filename}{suffix}.h5") and not overwrite:
-            activations = pd.read_hdf(f"{filename}{suffix}.h5", 'embed')
+        if embeddings_exist(self.name, weights_str, concat, norm) and \
+                not overwrite:
+            activations = load_embeddings(self.name, weights_str, concat,
+                                          norm, path_gens=self.path_gens)
         else:
             # If not, extract embeddings
             print(f"Beginning extraction of {self.name.upper()} w/{suffix}...")
             start = datetime.datetime.now()
             activations = self.extract_embeddings(concat, norm, weights,
-                                                  overwrite=overwrite)
+                                                  overwrite=overwrite,
+                                                  resume=not overwrite)
             end = datetime.datetime.now()
             total = timer(start, end)
             print("Finished Feature Extraction in ", round(total, 2),
                   " minutes!")
 
             # Log time taken
-            if not os.path.exists(
-                    evaluation_dir + f"inference_times/{self.name}_inference_times({weights_str}).csv"):
-                df_time = pd.DataFrame(
-                    {'to_grayscale': not concat, 'normalize': norm,
-                     'minutes': total}, index=[0])
-                df_time.to_csv(
-                    evaluation_dir + f"inference_times/{self.name}_inference_times({weights_str}).csv",
-                    index=False)
-            else:
-                df_time = pd.read_csv(
-                    evaluation_dir + f"inference_times/{self.name}_inference_times({weights_str}).csv")
-                # Remove past record
-                df_time = df_time[(df_time.to_grayscale == concat) | (
-                        df_time.normalize != norm)]
-                # Add existing time
-                df_curr = pd.DataFrame(
-                    {'to_grayscale': not concat, 'normalize': norm,
-                     'minutes': total}, index=[0])
-                df_time = pd.concat([df_time, df_curr])
-                df_time.to_csv(
-                    evaluation_dir + f"inference_times/{self.name}_inference_times({weights_str}).csv",
-                    index=False)
+            log_inference_time(self.name, weights_str, concat, norm, total)
 
         # Subtract Mean and Divide by Standard Deviation
         scaler = preprocessing.StandardScaler()
@@ -458,47 +1090,220 @@ class ValidationProcedure:
 
         return pd.DataFrame(transformed_activations)
 
+    def knn_results_exist(self, weights, concat: bool, norm: bool,
+                          k_values, votes=('majority',)) -> bool:
+        """Return True if kNN results exist for all <k_values> and <votes>,
+        for the current checkpoint of <weights>.
+        """
+        weights_str = check_weights_str(weights,
+                                        self.cytoimagenet_weights_suffix)
+        checkpoint = weights_checkpoint(weights, dset_=self.dset)
+        return results_db.has_runs([(self.name, weights_str, concat, norm, k,
+                                     vote, checkpoint)
+                                    for k in k_values for vote in votes])
+
+    def knn_summary_path(self, weights_str: str, concat: bool,
+                         norm: bool) -> str:
+        """Return path to summary of the latest kNN run for <weights_str>,
+        <concat> and <norm>. The summary is saved on every run, after results
+        are in the results database.
+        """
+        return f"{evaluation_dir}/{weights_str}_results/{self.name}_" \
+               f"kNN_summary({weights_str}, " \
+               f"{create_save_str(concat, norm)}).json"
+
+    def save_knn_summary(self, weights_str: str, concat: bool, norm: bool,
+                         **summary) -> None:
+        """Atomically save <summary> of the latest kNN run (see
+        knn_summary_path).
+        """
+        path = self.knn_summary_path(weights_str, concat, norm)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump({'time': datetime.datetime.now().isoformat(),
+                       **summary}, f)
+        os.replace(f"{path}.tmp", path)
+
+    def save_knn_results(self, df_results: pd.DataFrame, weights,
+                         concat: bool, norm: bool, k: int, vote='majority',
+                         **run_metadata) -> None:
+        """Save kNN results <df_results> (see knn_results) to the results
+        database, with optional <run_metadata> (metric, index_type,
+        knn_seconds).
+        """
+        weights_str = check_weights_str(weights,
+                                        self.cytoimagenet_weights_suffix)
+        checkpoint = weights_checkpoint(weights, dset_=self.dset)
+        results_db.add_run(self.name, weights_str, concat, norm, k,
+                           df_results, vote=vote, checkpoint=checkpoint,
+                           **run_metadata)
+
+    def fit_index(self, df_train: np.array, metric: str, index: str,
+                  weights_str: str, concat: bool,
+                  norm: bool) -> FaissKNeighbors:
+        """Return kNN index of type <index> fitted on training set
+        <df_train>, for embeddings specified by <weights_str>, <concat> and
+        <norm>.
+        """
+        knn_model = FaissKNeighbors(metric=metric, index=index)
+        with instrumentation.timer('index_build', items=len(df_train)):
+            knn_model.fit(df_train, np.zeros(len(df_train), dtype=int))
+        return knn_model
+
+    def embedding_sources(self, with_train: bool) -> Optional[list]:
+        """Return names of embedding store entries that kNN features are
+        computed from, or None if unknown. If <with_train>, features include
+        a training set.
+        """
+        return None if with_train else [self.name]
+
+    def source_order(self, name: str) -> list:
+        """Return paths (first channel) of images in store entry <name>, in
+        the order that embedding rows are loaded in (see load_embeddings).
+        """
+        return self.path_gens[0]
+
+    def embeddings_fingerprint(self, weights_str: str, concat: bool,
+                               norm: bool, with_train: bool) -> Optional[str]:
+        """Return string identifying the embedding store entries that kNN
+        features are computed from (see embedding_sources), by their
+        manifests, when they were last committed and the order rows are
+        loaded in. Return None if any entry is missing or incomplete (e.g.
+        legacy embeddings).
+        """
+        names = self.embedding_sources(with_train)
+        if names is None:
+            return None
+        entries = []
+        for name in names:
+            manifest = embedding_store.get_manifest(name, weights_str, concat,
+                                                    norm)
+            if manifest is None or not manifest['complete']:
+                return None
+            entry_dir = embedding_store.get_dir(name, weights_str, concat,
+                                                norm)
+            # Rows are reordered to the current order of images on load
+            row_order = hashlib.sha256(
+                "\n".join(map(str, self.source_order(name))).encode())
+            entries.append([name, manifest,
+                            os.path.getmtime(f"{entry_dir}/manifest.json"),
+                            row_order.hexdigest()])
+        return json.dumps(entries, sort_keys=True)
+
+    def get_neighbors(self, df_test: np.array, k: int, metric='euclidean',
+                      weights_str: str = 'imagenet', concat=True, norm=True,
+                      df_train=None, index='flat') -> tuple:
+        """Return (distances, indices) of the <k> nearest neighbours of each
+        sample in <df_test>, ordered from closest to furthest. Neighbours are
+        from <df_train> if specified. Else, neighbours are from <df_test>,
+        excluding the sample itself.
+
+        Neighbour tables are saved, and reused for any k up to the saved k
+        if the features, metric and index are unchanged. Features are
+        identified by the embedding store entries they are computed from (see
+        embeddings_fingerprint), or else by a hash of the features.
+        """
+        df_test = np.ascontiguousarray(df_test, dtype=np.float32)
+        if df_train is not None:
+            df_train = np.ascontiguousarray(df_train, dtype=np.float32)
+
+        # Identify features used for the search
+        sources = self.embeddings_fingerprint(weights_str, concat, norm,
+                                              df_train is not None)
+        if sources is not None:
+            sha256 = hashlib.sha256(sources.encode())
+            sha256.update(str([df_test.shape, None if df_train is None
+                               else df_train.shape]).encode())
+        else:
+            sha256 = hashlib.sha256(df_test)
+            if df_train is not None:
+                sha256.update(df_train)
+        sha256.update(f"{metric}, {index}".encode())
+        fingerprint = sha256.hexdigest()
+
+        table_path = f"{evaluation_dir}/{weights_str}_results/{self.name}_" \
+                     f"kNN_neighbors({weights_str}, " \
+                     f"{create_save_str(concat, norm)}).npz"
+        if os.path.exists(table_path):
+            table = np.load(table_path)
+            if str(table['fingerprint']) == fingerprint and \
+                    table['neigh_ind'].shape[1] >= k:
+                instrumentation.count('neighbor_table.reused')
+                return table['neigh_dist'][:, :k], table['neigh_ind'][:, :k]
+
+        # Fit on the training set, if specified. Else, fit on the test set.
+        if df_train is not None:
+            knn_model = self.fit_index(df_train, metric, index, weights_str,
+                                       concat, norm)
+            with instrumentation.timer('index_search', items=len(df_test)):
+                neigh_dist, neigh_ind = knn_model.kneighbors(df_test,
+                                                             n_neighbors=k)
+        else:
+            knn_model = FaissKNeighbors(k=k, metric=metric, index=index)
+            with instrumentation.timer('index_build', items=len(df_test)):
+                knn_model.fit(df_test, np.zeros(len(df_test), dtype=int))
+            # Ignore duplicate point if kNN fitted on test set
+            with instrumentation.timer('index_search', items=len(df_test)):
+                neigh_dist, neigh_ind = knn_model.kneighbors(
+                    df_test, n_neighbors=k + 1)
+                neigh_dist, neigh_ind = drop_self_neighbors(neigh_dist,
+                                                            neigh_ind)
+
+        # Convert inner product and squared L2 to distances
+        if metric == 'cosine':
+            neigh_dist = 1 - neigh_dist
+        else:
+            neigh_dist = np.sqrt(np.maximum(neigh_dist, 0))
+
+        # Atomically save neighbour table
+        if not os.path.exists(f"{evaluation_dir}/{weights_str}_results"):
+            os.mkdir(f"{evaluation_dir}/{weights_str}_results")
+        tmp_path = f"{table_path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, neigh_dist=neigh_dist, neigh_ind=neigh_ind,
+                 fingerprint=fingerprint)
+        os.replace(tmp_path, table_path)
+
+        return neigh_dist, neigh_ind
+
     # Leave-one-out Classifier
     def knn_classify(self, df_test: np.array, y_test: np.array,
-                     k: int, metric='euclidean',
+                     k, metric='euclidean',
                      weights: str = 'imagenet', concat=True, norm=True,
-                     overwrite=False, df_train=None, y_train=None):
+                     overwrite=False, df_train=None, y_train=None,
+                     index='flat', votes=('majority',)):
         """Perform <k> Nearest Neighbors Classification of test set. Implemented
-        using faiss library.
+        using faiss library, with faiss index type <index> (see
+        FaissKNeighbors).
 
         If <df_train> and <y_train> specified, predict labels in test set based
         on training set. Else, perform a leave-one-out on the test set.
 
+        Neighbours are searched once for the largest k, and results are saved
+        for each k and each vote method in <votes>:
+            - 'majority': each neighbour has one vote
+            - 'distance': each neighbour's vote is weighted by 1 / distance
+                (see distance_weights)
+
         ==Precondition==:
             - features in <df_test> are centered and standardized by
                 mean and std.
         ==Parameters==:
             - df_test is array of (num_samples, num_features)
+            - k is a number of neighbours, or a sequence of them
         """
         weights_str = check_weights_str(weights,
                                         self.cytoimagenet_weights_suffix)
+        k_values = sorted(set(np.atleast_1d(k).tolist()))
 
         # End early if results already exist
-        if not overwrite and os.path.exists(
-                f"{evaluation_dir}/{weights_str}_results/"
-                f"{self.name}_kNN_results({weights_str}, "
-                f"{create_save_str(concat, norm)}, k-{k}).csv"):
+        if not overwrite and self.knn_results_exist(weights, concat, norm,
+                                                    k_values, votes):
             return
 
         # Timing kNN
         start_kNN = datetime.datetime.now()
-
-        # Convert from pandas dataframe to numpy array
-        if type(df_train) == pd.DataFrame:
-            df_train = df_train.to_numpy()
-        if type(df_test) == pd.DataFrame:
-            df_test = df_test.to_numpy()
-
-        # Enforce C-Contiguity for arrays
-        if type(df_train) == np.ndarray and not df_train.flags['C_CONTIGUOUS']:
-            df_train = df_train.copy(order='C')
-        if type(df_test) == np.ndarray and not df_test.flags['C_CONTIGUOUS']:
-            df_test = df_test.copy(order='C')
+        instrumentation.reset()
 
         # Encode Labels
         le = preprocessing.LabelEncoder()
@@ -506,100 +1311,45 @@ class ValidationProcedure:
 
         if y_train is not None:
             train_labels = le.transform(y_train)
-
-        # Prediction/Results Accumulator
-        encoded_labels = np.unique(test_labels)
-        correct_by_class = np.zeros(len(encoded_labels), dtype=np.uint32)
-        total_by_class = np.zeros(len(encoded_labels), dtype=np.uint32)
-        correct = 0.0
-        total = 0.0
-
-        # Fit on the training set, if specified. Else, fit on the test set.
-        knn_model = FaissKNeighbors(k=k, metric=metric)
-        if df_train is not None:
-            knn_model.fit(df_train, train_labels)
         else:
-            knn_model.fit(df_test, test_labels)
-
-        # Time per iteration
-        time_per_iter = None
-
-        # Iterate through each sample. Match to existing samples.
-        for i in range(len(df_test)):
-            # Print progress
-            curr_status = round(100 * i / len(df_test), 2)
-            if curr_status in range(0, 101, 20):
-                progress_str = f"{curr_status}% [{i}/{len(df_test)}]"
-                if time_per_iter is not None:
-                    mins_remaining = round(time_per_iter * (len(df_test) - i),
-                                           0)
-                    hours = int(mins_remaining / 60)
-                    mins = int(mins_remaining % 60)
-                    progress_str += f" Time Remaining: {hours}:{mins}"
-                progress_bar = f"[{'=' * int(30 * i / len(df_test))}>{'.' * int(30 * (1 - (i / len(df_test))))}]"
-                print(progress_str)
-                print(progress_bar)
-            start = datetime.datetime.now()
+            train_labels = test_labels
 
-            # Ignore duplicate point if kNN fitted on test set
-            if y_train is None:
-                neigh_dist, neigh_ind = knn_model.kneighbors([df_test[i, :]],
-                                                             n_neighbors=k + 1)
-                neigh_dist = neigh_dist[0][1:]
-                neigh_ind = neigh_ind[0][1:]
-                neigh_labels = test_labels[neigh_ind]
-            else:
-                neigh_dist, neigh_ind = knn_model.kneighbors([df_test[i, :]],
-                                                             n_neighbors=k)
-                # remove outer list
-                neigh_dist = neigh_dist[0]
-                neigh_ind = neigh_ind[0]
-
-                neigh_labels = train_labels[neigh_ind]
-
-            predicted = 0
-            # if only one value predicted
-            if isinstance(neigh_labels, int):
-                predicted = neigh_labels
-            # elif more than one non-unique label, get mode
-            elif len(np.unique(neigh_labels)) < len(neigh_labels):
-                predicted = stats.mode(neigh_labels)[0][0]
-            # else, take the label of the closest point
-            else:
-                smallest_ind = np.argmin(neigh_dist)
-                predicted = neigh_labels[smallest_ind]
+        # Search neighbours for all samples at once
+        neigh_dist, neigh_ind = self.get_neighbors(
+            df_test, max(k_values), metric=metric, weights_str=weights_str,
+            concat=concat, norm=norm,
+            df_train=df_train if y_train is not None else None, index=index)
+        neigh_labels = train_labels[neigh_ind]
 
-            # Check prediction accuracy
-            if predicted == test_labels[i]:
-                correct += 1.0
-                correct_by_class[test_labels[i]] += 1
-            total += 1.0
-            total_by_class[test_labels[i]] += 1
-
-            # Time per iteration
-            end = datetime.datetime.now()
-            time_per_iter = timer(start, end)
+        knn_seconds = (datetime.datetime.now() - start_kNN).total_seconds()
 
         # Save Results
-        df_results = pd.DataFrame()
-        df_results['labels'] = le.inverse_transform(np.unique(test_labels))
-        df_results['correct_by_class'] = correct_by_class
-        df_results['total_by_class'] = total_by_class
-        df_results['accuracy_by_class'] = correct_by_class / total_by_class
-        df_results['total_accuracy'] = correct / total
-
-        # Check if directory exists
-        if not os.path.exists(f"{evaluation_dir}/{weights_str}_results"):
-            os.mkdir(f"{evaluation_dir}/{weights_str}_results")
-
-        df_results.to_csv(
-            f"{evaluation_dir}/{weights_str}_results/{self.name}_kNN_results({weights_str}, {create_save_str(concat, norm)}, k-{k}).csv",
-            index=False)
+        for vote in votes:
+            for k_ in k_values:
+                neigh_weights = None
+                if vote == 'distance':
+                    neigh_weights = distance_weights(neigh_dist[:, :k_])
+                with instrumentation.timer('knn_vote', items=len(test_labels)):
+                    df_results = knn_results(neigh_labels[:, :k_],
+                                             test_labels, le.classes_,
+                                             neigh_weights)
+                self.save_knn_results(df_results, weights, concat, norm, k_,
+                                      vote, metric=metric, index_type=index,
+                                      knn_seconds=knn_seconds)
+
+        instrumentation.export(
+            instrumentation_path(self.name, 'knn', weights_str, concat, norm),
+            dataset=self.name, stage='knn', weights=weights_str,
+            concat=concat, norm=norm, k_values=k_values, metric=metric,
+            index=index, num_queries=len(test_labels))
+        self.save_knn_summary(weights_str, concat, norm, k_values=k_values,
+                              votes=list(votes), metric=metric, index=index,
+                              num_queries=len(test_labels))
 
         # Log time for kNN Predictions
         end = datetime.datetime.now()
         time_taken = timer(start_kNN, end)
-        print(f"Finished {k}-NN prediction in ", round(time_taken, 2),
+        print(f"Finished {k_values}-NN prediction in ", round(time_taken, 2),
               " minutes!")
 
     # MAIN FUNCTION
@@ -613,38 +1363,33 @@ class ValidationProcedure:
         """Return Series containing kNN classification results averaged over all
         chosen k-values.
         """
+        df_results = self.get_all_results(weights, save=False)
+        df_results = df_results[(df_results.to_grayscale == (not concat)) &
+                                (df_results.normalized == norm)]
+        if df_results.empty:
+            raise KeyError(f"No results for {self.name} "
+                           f"({check_weights_str(weights)}, "
+                           f"{create_save_str(concat, norm)})")
+        return df_results.iloc[0].astype('object')
+
+    def get_all_results(self, weights, save=True) -> pd.DataFrame:
+        """Return aggregated results for <weights> from the results database,
+        with one row per preprocessing method. If <save>, also save it into a
+        csv file.
+        """
         weights_str = check_weights_str(weights,
                                         self.cytoimagenet_weights_suffix)  # converts None -> 'random'
-
-        accum = []
-        for k in self.k_values:
-            df_results = pd.read_csv(
-                f"{evaluation_dir}{weights_str}_results/{self.name}_kNN_results({weights_str}, {create_save_str(concat, norm)}, k-{k}).csv")
-            accum.append(df_results.mean())
-        df_return = pd.DataFrame(accum).mean().astype('object')
+        df_results = results_db.get_aggregated(self.name, [weights_str],
+                                               self.k_values)
         # Get 95% confidence interval on accuracy
-        acc = df_return['total_accuracy']
-        df_return['ci'] = 1.96 * np.sqrt((acc * (1 - acc)) / self.len_dataset)
-        df_return['to_grayscale'] = not concat
-        df_return['normalized'] = norm
-        return df_return
-
-    def get_all_results(self, weights):
-        """Aggregates results for <weights> and saves it into a csv file."""
-        weights_str = check_weights_str(weights,
-                                        self.cytoimagenet_weights_suffix)  # converts None -> 'random'
-        accum = []
-        for concat in [True, False]:
-            for norm in [True, False]:
-                try:
-                    accum.append(self.get_results(concat, norm, weights))
-                except:
-                    pass
-        df_results = pd.DataFrame(accum)
-        df_results['weights'] = weights_str
-        df_results.to_csv(
-            f"{evaluation_dir}{self.name}_aggregated_results({weights_str}).csv",
-            index=False)
+        acc = df_results['total_accuracy']
+        df_results.insert(4, 'ci',
+                          1.96 * np.sqrt((acc * (1 - acc)) / self.len_dataset))
+        if save:
+            df_results.to_csv(
+                f"{evaluation_dir}{self.name}_aggregated_results({weights_str}).csv",
+                index=False)
+        return df_results
 
     # Plots Aggregated Results
     def plot_all_results(self, save=True, by='method'):
@@ -655,18 +1400,12 @@ class ValidationProcedure:
                        'random']
 
         # Get accumulated results
-        accum_df = []
-        for i in range(len(all_weights)):
-            curr_df = pd.read_csv(
-                f"{evaluation_dir}{self.name}_aggregated_results({all_weights[i]}).csv")
-            curr_df['ci'] = curr_df.apply(lambda x: 1.96 * np.sqrt(
-                (x.total_accuracy * (1 - x.total_accuracy)) / self.len_dataset),
-                                          axis=1)
-            curr_df['preproc_method'] = curr_df.apply(
-                lambda x: create_save_str(not x.to_grayscale, x.normalized),
-                axis=1)
-            accum_df.append(curr_df)
-        df = pd.concat(accum_df, ignore_index=True)
+        df = results_db.get_aggregated(self.name, all_weights, self.k_values)
+        df['ci'] = 1.96 * np.sqrt(
+            (df.total_accuracy * (1 - df.total_accuracy)) / self.len_dataset)
+        df['preproc_method'] = [create_save_str(not to_grayscale, normalized)
+                                for to_grayscale, normalized
+                                in zip(df.to_grayscale, df.normalized)]
 
         # Plotting by preprocessing method, or by weights
         if by == 'method':
@@ -765,90 +1504,192 @@ class ValidationProcedure:
 
 
 class CytoImageNetValidation():
-    """Predict on validation set."""
+    """Predict on validation set.
 
-    def __init__(self):
+    Predictions are streamed in batches of <batch_size> images. Per-class
+    correct/total counts, top-k counts and a confusion matrix are updated as
+    each batch completes, and predictions are written in chunks, so only one
+    batch of class probabilities is held in memory.
+
+    ==Attributes==:
+        metadata: validation set metadata, from the saved train-val split
+        class_names: sorted labels, in the order of model outputs
+        batch_size: number of images per batch
+        channels: number of color channels passed to the model
+        top_k: number of top predictions counted for top-k accuracy
+    """
+
+    def __init__(self, batch_size=256, channels=1, top_k=5):
         self.metadata = self.load_metadata()
-        self.class_encoding = {}  # numeric encoding to label
-        self.batch_size = 1
-        self.val_gen, self.steps = self.get_generator()
+        self.class_names = sorted(self.metadata.label.unique())
+        self.batch_size = batch_size
+        self.channels = channels
+        self.top_k = top_k
 
     def load_metadata(self):
-        """Get metadata for validation set."""
+        """Get metadata for validation set, using the saved train-val split.
+        """
         df = pd.read_csv('/ferrero/cytoimagenet/metadata.csv')
-        df['full_path'] = df.apply(
-            lambda x: "/ferrero/" + x.path + "/" + x.filename, axis=1)
-        df_train, df_val = train_test_split(df, test_size=0.1, random_state=0,
-                                            stratify=df['label'])
-        return df_val
+        _, val_rows = load_split(df=df)
+        df_val = df.loc[val_rows]
+        return df_val.assign(full_path="/ferrero/" + df_val.path + "/" +
+                             df_val.filename)
 
     def get_generator(self):
-        """Returns tuple of tf.data.Dataset (image generator), and number of
-        steps.
+        """Returns tuple of tf.data.Dataset of image batches, in the order
+        of the metadata, and number of steps.
         """
-        # Create generator from metadata dataframe
-        val_gen = ImageDataGenerator()
-        val_gen = val_gen.flow_from_dataframe(
-            dataframe=self.metadata,
-            directory=None,
-            x_col='full_path',
-            y_col='label',
-            shuffle=False,
-            batch_size=self.batch_size,
-            target_size=(224, 224),
-            interpolation="bilinear",
-            color_mode="rgb",
-            seed=728565
-        )
-        steps_per_epoch_val = val_gen.n // val_gen.batch_size
-
-        # Package into tf.data.Dataset API
-        ds_val = tf.data.Dataset.from_generator(
-            lambda: val_gen,
-            output_types=(tf.float32, tf.float32),
-            output_shapes=([None, 224, 224, 3], [None, 894]))
+        def read_image(path):
+            img = tf.io.decode_image(tf.io.read_file(path),
+                                     channels=self.channels,
+                                     expand_animations=False)
+            img = tf.image.resize(img, (224, 224), method='bilinear')
+            return tf.ensure_shape(img, [224, 224, self.channels])
+
+        ds_val = tf.data.Dataset.from_tensor_slices(
+            self.metadata.full_path.to_numpy().astype(str))
+        ds_val = ds_val.map(read_image,
+                            num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                            deterministic=True)
+        ds_val = ds_val.batch(self.batch_size)
         ds_val = ds_val.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+        return ds_val, ceil(len(self.metadata) / self.batch_size)
+
+    def get_save_str(self, weights_filename=None) -> str:
+        """Return suffix of saved files, for CytoImageNet weights saved as
+        <weights_filename>. Default weights have no suffix.
+        """
+        if weights_filename is None:
+            return ''
+        return f"({weights_filename.replace('.h5', '')})"
+
+    def evaluate(self, weights_filename=None, init='random'):
+        """Predict on validation set with CytoImageNet weights
+        <weights_filename> (default weights of load_model if None). Return
+        dataframe of accuracy by class.
 
-        # Store class encoding map. Invert to obtain encoding to original label.
-        class_map = val_gen.class_indices.copy()
-        self.class_encoding = {v: k for k, v in class_map.items()}
-
-        return ds_val, steps_per_epoch_val
-
-    def evaluate(self):
-        """Predict on validation set."""
-        model = load_model(weights="cytoimagenet", include_top=True,
-                           overwrite=False, dset_="full")
-        y_pred = model.predict(self.val_gen, batch_size=self.batch_size,
-                               steps=self.steps, verbose=1)
-        y_pred_label_prob = np.max(y_pred, axis=1)
-        y_pred_label = np.argmax(y_pred, axis=1)
-        y_pred_label = [self.class_encoding[i] for i in y_pred_label]
-
-        # Save predictions
-        df_val = self.load_metadata()
-        df_val["predicted"] = y_pred_label
-        df_val["probability"] = y_pred_label_prob
-        df_val.to_csv(f"{evaluation_dir}/val_metadata-predictions.csv",
-                      index=False)
+        Saves predictions, accuracy by class and, for each class, the
+        <top_k> labels it is most often predicted as.
+        """
+        save_str = self.get_save_str(weights_filename)
+        if weights_filename is None:
+            model = load_model(weights="cytoimagenet", include_top=True,
+                               overwrite=False, dset_="full",
+                               channels=self.channels)
+        else:
+            model = load_model(weights="cytoimagenet",
+                               weights_filename=weights_filename, init=init,
+                               include_top=True, overwrite=False,
+                               dset_="full", channels=self.channels)
+        ds_val, steps = self.get_generator()
+
+        num_classes = len(self.class_names)
+        y_true = self.metadata.label.map(
+            {label: i for i, label in enumerate(self.class_names)}
+        ).to_numpy()
+        confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+        top_k_correct = np.zeros(num_classes, dtype=np.int64)
+
+        # Write predictions in chunks
+        predictions_path = f"{evaluation_dir}/val_metadata-predictions" \
+                           f"{save_str}.csv"
+        progress_bar = tf.keras.utils.Progbar(steps)
+        row = 0
+        with open(f"{predictions_path}.tmp", 'w', newline='') as f:
+            for imgs in ds_val:
+                y_prob = np.asarray(model.predict_on_batch(imgs))
+                batch_true = y_true[row:row + len(y_prob)]
+
+                # Update counters
+                y_pred = y_prob.argmax(axis=1)
+                np.add.at(confusion, (batch_true, y_pred), 1)
+                top_k_pred = np.argpartition(-y_prob, self.top_k - 1,
+                                             axis=1)[:, :self.top_k]
+                np.add.at(top_k_correct, batch_true,
+                          (top_k_pred == batch_true[:, None]).any(axis=1))
+
+                df_batch = self.metadata.iloc[row:row + len(y_prob)].assign(
+                    predicted=np.array(self.class_names)[y_pred],
+                    probability=y_prob.max(axis=1))
+                df_batch.to_csv(f, index=False, header=row == 0)
+                row += len(y_prob)
+                progress_bar.add(1)
+        os.replace(f"{predictions_path}.tmp", predictions_path)
+
+        # Accuracy by class
+        total_by_class = confusion.sum(axis=1)
+        acc_by_class = pd.DataFrame({
+            'label': self.class_names,
+            'correct': np.diag(confusion),
+            'total': total_by_class,
+            'accuracy': np.diag(confusion) / total_by_class,
+            f'top_{self.top_k}_accuracy': top_k_correct / total_by_class})
+        acc_by_class.to_csv(f"{evaluation_dir}/val_accuracy_by_class"
+                            f"{save_str}.csv", index=False)
+
+        # Labels each class is most often confused with
+        off_diagonal = confusion.copy()
+        np.fill_diagonal(off_diagonal, 0)
+        most_confused = np.argsort(-off_diagonal, axis=1,
+                                   kind='stable')[:, :self.top_k]
+        df_confusion = pd.DataFrame({
+            'label': np.repeat(self.class_names, self.top_k),
+            'rank': np.tile(np.arange(1, self.top_k + 1), num_classes),
+            'predicted': np.array(self.class_names)[most_confused.ravel()],
+            'count': np.take_along_axis(off_diagonal, most_confused,
+                                        axis=1).ravel()})
+        df_confusion = df_confusion[df_confusion['count'] > 0]
+        df_confusion.to_csv(f"{evaluation_dir}/val_confusion_top_"
+                            f"{self.top_k}{save_str}.csv", index=False)
+
+        print(f"Validation accuracy: "
+              f"{np.diag(confusion).sum() / total_by_class.sum():.4f}")
+        return acc_by_class
+
+    def evaluate_checkpoints(self, init='random') -> pd.DataFrame:
+        """Evaluate every saved checkpoint of training on the full dataset
+        from <init> weights. Return and save dataframe of validation accuracy
+        by epoch.
+        """
+        checkpoint_dir = f"{weights_dir}/{init}_init/full/"
+        epoch_by_filename = {}
+        for path in glob.glob(f"{checkpoint_dir}/efficientnetb0_from_*.h5"):
+            match = re.search(r"(\d+)\.h5$", path)
+            if match is not None:
+                epoch_by_filename[os.path.basename(path)] = \
+                    int(match.group(1))
+        filenames = sorted(epoch_by_filename, key=epoch_by_filename.get)
+
+        accum = []
+        for filename in filenames:
+            acc_by_class = self.evaluate(filename, init)
+            accum.append({
+                'weights_filename': filename,
+                'epoch': epoch_by_filename[filename],
+                'accuracy': acc_by_class.correct.sum() /
+                acc_by_class.total.sum(),
+                'mean_class_accuracy': acc_by_class.accuracy.mean(),
+                f'top_{self.top_k}_accuracy':
+                    (acc_by_class[f'top_{self.top_k}_accuracy'] *
+                     acc_by_class.total).sum() / acc_by_class.total.sum()})
+            # Only keep the current checkpoint's model in memory
+            model_registry.pop(("cytoimagenet", filename, init, "full", True,
+                                self.channels), None)
+
+        df_checkpoints = pd.DataFrame(accum)
+        df_checkpoints.to_csv(f"{evaluation_dir}/val_accuracy_by_checkpoint"
+                              f"({init}_init).csv", index=False)
+        return df_checkpoints
 
     def analyze_results(self):
         df_val = pd.read_csv(f"{evaluation_dir}/val_metadata-predictions.csv")
         # confusion_matrix(df_val.label, df_val.predicted)
 
-        # Accuracy per class
-        acc_by_class = df_val.groupby(by=["label"]).apply(
-            lambda df: sum(df.label == df.predicted) / len(df))
-        acc_by_class.name = "accuracy"
-        acc_by_class = acc_by_class.reset_index()
-
-        # Get category
-        label_category = df_val.groupby(by=["label"]).sample(n=1)[
-            ["label", "category"]]
-        label_category_map = dict(
-            zip(label_category.label, label_category.category))
-        acc_by_class["category"] = acc_by_class['label'].map(
-            lambda x: label_category_map[x])
+        # Accuracy per class and category
+        acc_by_class = df_val.assign(
+            accuracy=df_val.label == df_val.predicted
+        ).groupby("label", as_index=False).agg(
+            accuracy=('accuracy', 'mean'), category=('category', 'first'))
 
         # Zero-Accuracy classes + Cell Visible
         print(acc_by_class[(acc_by_class.accuracy == 0) &
@@ -870,6 +1711,7 @@ class BBBC021Protocol(ValidationProcedure):
                 feature vectors.
         NOTE: Time for feature extraction is recorded.
     """
+    k_values = (1,)
 
     def __init__(self, dset, suffix=''):
         self.data_dir = f"{data_dir}bbbc021"
@@ -878,7 +1720,6 @@ class BBBC021Protocol(ValidationProcedure):
         self.num_channels = 3
         self.path_gens = self.create_path_iterators()
         self.len_dataset = 103
-        self.k_values = (1,)
         self.dset = dset
         self.cytoimagenet_weights_suffix = suffix
 
@@ -914,27 +1755,40 @@ class BBBC021Protocol(ValidationProcedure):
 
     # Modified kNN for Not-Same-Compound (NSC) MOA classification
     def knn_classify(self, df_test, y_test: np.array, compounds: np.array,
-                     k: int, metric='cosine', method="nsc",
+                     k, metric='cosine', method="nsc",
                      weights: str = 'imagenet', concat=True, norm=True,
-                     overwrite=False):
+                     overwrite=False, batches: np.array = None,
+                     votes=('majority',)):
         """Perform <k> Nearest Neighbors Classification leave-one-out of each
         sample, using activations in <df_test>, and labels in <y_test>.
-        Implemented using faiss library.
+        Implemented with a masked similarity matrix.
+
+        If <method> == 'nsc', neighbours of the same compound are ignored. If
+        <method> == 'nsb', neighbours of the same compound or same batch
+        (e.g. plate) in <batches> are ignored. Raises ValueError if <method>
+        == 'nsb' and <batches> isn't specified.
+
+        Neighbours are found once for the largest k, and results are saved
+        for each k and each vote method in <votes> (see
+        ValidationProcedure.knn_classify).
 
         ==Precondition==:
             - <df_test> activations and <y_test> correspond. As a result, their
                 lengths should also be equal.
         ==Parameters==:
             - df_test is array of (num_samples, num_features)
+            - k is a number of neighbours, or a sequence of them
+            - compounds and batches are arrays of (num_samples,)
         """
+        if method == 'nsb' and batches is None:
+            raise ValueError("Method 'nsb' requires <batches>!")
         weights_str = check_weights_str(weights,
                                         self.cytoimagenet_weights_suffix)
+        k_values = sorted(set(np.atleast_1d(k).tolist()))
 
         # End early if results already exist
-        if not overwrite and os.path.exists(
-                f"{evaluation_dir}/{weights_str}_results/"
-                f"{self.name}_kNN_results({weights_str}, "
-                f"{create_save_str(concat, norm)}, k-{k}).csv"):
+        if not overwrite and self.knn_results_exist(weights, concat, norm,
+                                                    k_values, votes):
             return
         # Convert pandas dataframe to numpy arrays
         if type(df_test) == pd.DataFrame:
@@ -944,88 +1798,48 @@ class BBBC021Protocol(ValidationProcedure):
         le = preprocessing.LabelEncoder()
         test_labels = le.fit_transform(y_test)
 
-        # Prediction/Results Accumulator
-        encoded_labels = np.unique(test_labels)
-        correct_by_class = np.zeros(len(encoded_labels), dtype=np.uint32)
-        total_by_class = np.zeros(len(encoded_labels), dtype=np.uint32)
-        correct = 0.0
-        total = 0.0
-
-        # Fit KNN Classifier on the entire dataset
-        knn_model = KNeighborsClassifier(n_neighbors=k, metric=metric,
-                                         algorithm='brute')
-        knn_model.fit(df_test, test_labels)
-
-        # Iterate through each sample. Match to existing samples.
-        for i in range(len(df_test)):
-            # print(f"Classifying MOA: {unproc_labels[i]}, Compound: {compounds[i]}")
-
-            # Get k+1 neighbors of current sample, since 1st point is duplicate
-            neigh_dist, neigh_ind = knn_model.kneighbors([df_test[i, :]],
-                                                         n_neighbors=k + 1)
-            # Ignore duplicate point
-            neigh_dist = neigh_dist[0][1:]
-            neigh_ind = neigh_ind[0][1:]
-
-            # Ignore Same Compound
-            if method == 'nsc':
-                # Filter only for other compounds. NOTE: Removes duplicate query
-                num_same = np.sum(compounds[neigh_ind] == compounds[i])
-                accum_num_same = num_same
-
-                # If same compound found, get neighbors again
-                while num_same > 0:
-                    neigh_dist, neigh_ind = knn_model.kneighbors(
-                        [df_test[i, :]], n_neighbors=k + 1 + accum_num_same)
-
-                    # Ignore duplicate point
-                    neigh_dist = neigh_dist[0][1:]
-                    neigh_ind = neigh_ind[0][1:]
-
-                    # Filter neighbors distances & indices
-                    idx_to_keep = np.argmax(
-                        compounds[neigh_ind] != compounds[i])
-                    neigh_dist = neigh_dist[idx_to_keep]
-                    neigh_ind = neigh_ind[idx_to_keep]
-                    # Update
-                    num_same = np.sum(compounds[neigh_ind] == compounds[i])
-                    accum_num_same += num_same
-
-            neigh_labels = test_labels[neigh_ind]
-
-            # If there is at least one non-unique value, take the mode, otherwise take the closest
-            predicted = 0
-            if not isinstance(neigh_labels, np.ndarray) and not isinstance(
-                    neigh_labels, list):  # if only one value
-                predicted = neigh_labels
-            elif len(np.unique(neigh_labels)) < len(
-                    neigh_labels):  # if more than one non-unique label, get mode
-                predicted = stats.mode(neigh_labels)[0][0]
-            else:
-                smallest_ind = np.argmin(neigh_dist)
-                predicted = neigh_labels[smallest_ind]
+        # Exclude neighbours of the same compound (and batch, if NSB)
+        if method == 'nsc':
+            groups = (compounds,)
+        elif method == 'nsb':
+            groups = (compounds, batches)
+        else:
+            groups = ()
 
-            # Check predictions
-            if predicted == test_labels[i]:
-                correct += 1.0
-                correct_by_class[test_labels[i]] += 1
-            total += 1.0
-            total_by_class[test_labels[i]] += 1
+        # Get k nearest neighbours of each sample, ignoring itself
+        instrumentation.reset()
+        start = datetime.datetime.now()
+        with instrumentation.timer('index_search', items=len(df_test)):
+            neigh_dist, neigh_ind = masked_neighbors(df_test, max(k_values),
+                                                     groups=groups,
+                                                     metric=metric)
+        neigh_labels = test_labels[neigh_ind]
+        knn_seconds = (datetime.datetime.now() - start).total_seconds()
 
         # Save Results
-        df_results = pd.DataFrame()
-        df_results['labels'] = le.inverse_transform(np.unique(test_labels))
-        df_results['correct_by_class'] = correct_by_class
-        df_results['total_by_class'] = total_by_class
-        df_results['accuracy_by_class'] = correct_by_class / total_by_class
-        df_results['total_accuracy'] = correct / total
-
-        if not os.path.exists(f"{evaluation_dir}/{weights_str}_results"):
-            os.mkdir(f"{evaluation_dir}/{weights_str}_results")
-
-        df_results.to_csv(
-            f"{evaluation_dir}/{weights_str}_results/{self.name}_kNN_results({weights_str}, {create_save_str(concat, norm)}, k-{k}).csv",
-            index=False)
+        for vote in votes:
+            for k_ in k_values:
+                # Masked neighbours (infinite distance) have no vote
+                if vote == 'distance':
+                    neigh_weights = distance_weights(neigh_dist[:, :k_])
+                else:
+                    neigh_weights = np.isfinite(neigh_dist[:, :k_]) * 1.
+                with instrumentation.timer('knn_vote', items=len(test_labels)):
+                    df_results = knn_results(neigh_labels[:, :k_],
+                                             test_labels, le.classes_,
+                                             neigh_weights)
+                self.save_knn_results(df_results, weights, concat, norm, k_,
+                                      vote, metric=metric, index_type=method,
+                                      knn_seconds=knn_seconds)
+
+        instrumentation.export(
+            instrumentation_path(self.name, 'knn', weights_str, concat, norm),
+            dataset=self.name, stage='knn', weights=weights_str,
+            concat=concat, norm=norm, k_values=k_values, metric=metric,
+            method=method, num_queries=len(test_labels))
+        self.save_knn_summary(weights_str, concat, norm, k_values=k_values,
+                              votes=list(votes), metric=metric,
+                              index=method, num_queries=len(test_labels))
 
     # MAIN FUNCTION
     def evaluate(self, weights, concat, norm, overwrite=False):
@@ -1048,10 +1862,9 @@ class BBBC021Protocol(ValidationProcedure):
         treatment_activations = df_activations.groupby(by=['treatment']).mean()
 
         # kNN Classifier
-        for k in self.k_values:
-            self.knn_classify(treatment_activations, labels,
-                              compounds, k, concat=concat,
-                              norm=norm, weights=weights, overwrite=True)
+        self.knn_classify(treatment_activations, labels,
+                          compounds, self.k_values, concat=concat,
+                          norm=norm, weights=weights, overwrite=True)
 
         # Create UMAP visualization of features
         self.umap_visualize(treatment_activations, labels=labels,
@@ -1085,11 +1898,10 @@ class BBBC021Protocol(ValidationProcedure):
         treatment_activations = df_activations.groupby(by=['treatment']).mean()
 
         # kNN Classifier
-        for k in self.k_values:
-            self.knn_classify(treatment_activations, labels,
-                              compounds, k, concat=True,
-                              norm=True, weights="cyto_imagenet_fusion",
-                              overwrite=True)
+        self.knn_classify(treatment_activations, labels,
+                          compounds, self.k_values, concat=True,
+                          norm=True, weights="cyto_imagenet_fusion",
+                          overwrite=True)
 
         # Create UMAP visualization of features
         self.umap_visualize(treatment_activations, labels=labels,
@@ -1111,6 +1923,16 @@ class COOS7Validation(ValidationProcedure):
                 either train or test set for the COOS-7 dataset
     """
 
+    # Images are small crops of single cells
+    batch_size = 64
+    k_values = (11,)
+
+    # Scaled training embeddings and kNN indices shared by all test sets in
+    # this process. Only the most recent <max_shared> are kept.
+    shared_train = {}
+    shared_indices = {}
+    max_shared = 1
+
     def __init__(self, dset, test, suffix=''):
         self.coos_dir = f'/neuhaus/alexlu/datasets/IMAGE_DATASETS/COOS-MOUSE_david-andrews/CURATED-COOS7/'
         self.data_dir = f'{self.coos_dir}{test}'
@@ -1121,46 +1943,45 @@ class COOS7Validation(ValidationProcedure):
         self.num_channels = 2
         self.path_gens = self.create_path_iterators()
         self.len_dataset = len(self.path_gens[0])
-        self.k_values = (11,)
         self.dset = dset
 
         self.cytoimagenet_weights_suffix = suffix
 
     def load_metadata(self, coos_dset='test') -> pd.DataFrame:
-        """Return metadata dataframe for COOS-7 based on directory structure..
+        """Return metadata dataframe for COOS-7 based on directory structure.
+        Directory listings are cached, and only changed directories are
+        listed again.
         """
-        # Get labels
         if coos_dset == 'test':
-            files = glob.glob(os.sep.join([self.data_dir, '*']))
-            labels = [file.split(self.data_dir + os.sep)[-1] for file in files]
+            data_dir = self.data_dir
         else:
-            train_dir = f'{self.coos_dir}/train'
-            files = glob.glob(os.sep.join([train_dir, '*']))
-            labels = [file.split(train_dir + os.sep)[-1] for file in files]
-
-        accum_df = []
-        for i in range(len(labels)):
-            # Get all files for label
-            label_files = glob.glob(os.sep.join([files[i], '*']))
-            # Get unique filenames
-            label_files = list(
-                set(["_".join(file.split('_')[:-1]) for file in label_files]))
-
-            # Filter for channels
-            protein_paths = [f"{file}_protein.tif" for file in label_files]
-            nucleus_paths = [f"{file}_nucleus.tif" for file in label_files]
-            masks_paths = [f"{file}_mask.tif" for file in label_files]
-            filtered_df = pd.DataFrame({'protein_paths': protein_paths,
-                                        'nucleus_paths': nucleus_paths,
-                                        'mask_paths': masks_paths})
-            # Assign label
-            filtered_df['label'] = labels[i]
-
-            # Accumulate
-            accum_df.append(filtered_df)
-        df_metadata = pd.concat(accum_df, ignore_index=True)
-
-        return df_metadata
+            data_dir = f'{self.coos_dir}/train'
+
+        def build_coos_metadata(label_files: dict) -> pd.DataFrame:
+            accum_df = []
+            for label, filenames in label_files.items():
+                # Get unique filenames
+                label_paths = sorted(set(
+                    os.sep.join([data_dir, label,
+                                 "_".join(file.split('_')[:-1])])
+                    for file in filenames))
+
+                # Filter for channels
+                filtered_df = pd.DataFrame({
+                    'protein_paths': [f"{path}_protein.tif"
+                                      for path in label_paths],
+                    'nucleus_paths': [f"{path}_nucleus.tif"
+                                      for path in label_paths],
+                    'mask_paths': [f"{path}_mask.tif"
+                                   for path in label_paths]})
+                # Assign label
+                filtered_df['label'] = label
+
+                # Accumulate
+                accum_df.append(filtered_df)
+            return pd.concat(accum_df, ignore_index=True)
+
+        return get_manifest(data_dir).get_dataframe(build_coos_metadata)
 
     def create_path_iterators(self, coos_dset='test') -> List[List[str]]:
         """Return list containing list of absolute paths for each channel."""
@@ -1173,6 +1994,27 @@ class COOS7Validation(ValidationProcedure):
             path_gens.append(metadata[channel].tolist())
         return path_gens
 
+    def extract_embeddings_fused(self,
+                                 weights_list=('cytoimagenet', 'imagenet',
+                                               None),
+                                 variants=((True, True), (True, False),
+                                           (False, True), (False, False)),
+                                 overwrite=False, batch_size=None,
+                                 coos_dset='test') -> None:
+        """Extract and save embeddings for the COOS-7 <coos_dset> set, for
+        every weights and preprocessing variant, reading each image once.
+        See ValidationProcedure.extract_embeddings_fused.
+        """
+        if coos_dset == 'test':
+            name = self.name
+        else:
+            name = 'coos7_train'
+
+        super().extract_embeddings_fused(
+            weights_list, variants, overwrite=overwrite, batch_size=batch_size,
+            path_gens=self.create_path_iterators(coos_dset=coos_dset),
+            name=name)
+
     def evaluate(self, weights, concat, norm, overwrite=False):
         """Main function to carry out evaluation protocol.
         If overwrite, ignore existing embeddings and extract.
@@ -1183,11 +2025,10 @@ class COOS7Validation(ValidationProcedure):
         y_test = self.test_metadata['label'].to_numpy()
 
         # kNN Classifier
-        for k in self.k_values:
-            self.knn_classify(df_test, y_test, k, concat=concat,
-                              norm=norm, weights=weights,
-                              df_train=df_train, y_train=y_train,
-                              overwrite=True)
+        self.knn_classify(df_test, y_test, self.k_values, concat=concat,
+                          norm=norm, weights=weights,
+                          df_train=df_train, y_train=y_train,
+                          overwrite=True)
 
         # Create UMAP visualization of features
         self.umap_visualize(df_test, labels=y_test, weights=weights,
@@ -1215,11 +2056,10 @@ class COOS7Validation(ValidationProcedure):
         y_test = self.test_metadata['label'].to_numpy()
 
         # kNN Classifier
-        for k in self.k_values:
-            self.knn_classify(df_test, y_test, k, concat=True,
-                              norm=True, weights="cyto_imagenet_fusion",
-                              df_train=df_train, y_train=y_train,
-                              overwrite=True)
+        self.knn_classify(df_test, y_test, self.k_values, concat=True,
+                          norm=True, weights="cyto_imagenet_fusion",
+                          df_train=df_train, y_train=y_train,
+                          overwrite=True)
 
         # Create UMAP visualization of features
         self.umap_visualize(df_test, labels=y_test,
@@ -1233,138 +2073,184 @@ class COOS7Validation(ValidationProcedure):
         corresponding to training and test set embeddings, respectively.
 
         Activations are centered and standardized with respect to the training
-        set.
+        set. Scaled training embeddings are shared by all test sets, and
+        scaler statistics are saved alongside the training embeddings.
 
         If <overwrite>, extract embeddings even if embeddings already exist.
+        Otherwise, interrupted extractions are resumed.
         """
-        # Filename of embeddings
         weights_str = check_weights_str(weights,
                                         self.cytoimagenet_weights_suffix)
-
-        # Get activations for train set and test set
-        for dset in ['train', 'test']:
-            if dset == 'train':
-                name = 'coos7_train'
+        key = (weights_str, concat, norm)
+
+        if overwrite or key not in COOS7Validation.shared_train:
+            df_train = self.load_embeddings_for(concat, norm, weights,
+                                                'train', overwrite)
+            # Get mean and standard deviation of training set
+            if embedding_store.exists('coos7_train', weights_str, concat,
+                                      norm):
+                mean, scale = embedding_store.get_scaler(
+                    'coos7_train', weights_str, concat, norm)
             else:
-                name = self.name
+                mean = df_train.mean(axis=0, dtype=np.float64)
+                scale = df_train.std(axis=0, dtype=np.float64)
+                scale[scale == 0] = 1.
+            train_scaled = ((df_train - mean) / scale).astype(np.float32)
 
-            filename = f"{embedding_dir}{weights_str}_embeddings/{name}_embeddings"
-            suffix = f" ({weights_str}, {create_save_str(concat, norm)})"
-            # Load embeddings if present
-            if os.path.exists(f"{filename}{suffix}.h5") and not overwrite:
-                activations = pd.read_hdf(f"{filename}{suffix}.h5", 'embed')
-            else:
-                # If not, extract embeddings
-                print(f"Beginning extraction of {name.upper()} w/{suffix}...")
-                start = datetime.datetime.now()
-                activations = self.extract_embeddings(concat, norm, weights,
-                                                      overwrite=overwrite,
-                                                      coos_dset=dset)
-                end = datetime.datetime.now()
-                total = timer(start, end)
-                print("Finished Feature Extraction in ", round(total, 2),
-                      " minutes!")
-
-                # Log time taken
-                if not os.path.exists(
-                        evaluation_dir + f"inference_times/{name}_inference_times({weights_str}).csv"):
-                    df_time = pd.DataFrame(
-                        {'to_grayscale': not concat, 'normalize': norm,
-                         'minutes': total}, index=[0])
-                    df_time.to_csv(
-                        evaluation_dir + f"inference_times/{self.name}_inference_times({weights_str}).csv",
-                        index=False)
-                else:
-                    df_time = pd.read_csv(
-                        evaluation_dir + f"inference_times/{name}_inference_times({weights_str}).csv")
-                    # Remove past record
-                    df_time = df_time[(df_time.to_grayscale == concat) | (
-                            df_time.normalize != norm)]
-                    # Add existing time
-                    df_curr = pd.DataFrame(
-                        {'to_grayscale': not concat, 'normalize': norm,
-                         'minutes': total}, index=[0])
-                    df_time = pd.concat([df_time, df_curr])
-                    df_time.to_csv(
-                        evaluation_dir + f"inference_times/{name}_inference_times({weights_str}).csv",
-                        index=False)
-
-            # Reassign variable
-            if dset == 'train':
-                df_train = activations
-            else:
-                df_test = activations
+            if len(COOS7Validation.shared_train) >= self.max_shared:
+                COOS7Validation.shared_train.pop(
+                    next(iter(COOS7Validation.shared_train)))
+            COOS7Validation.shared_train[key] = (train_scaled, mean, scale)
+        train_scaled, mean, scale = COOS7Validation.shared_train[key]
 
         # Subtract Mean and Divide by Standard Deviation
-        scaler = preprocessing.StandardScaler()
-        train_scaled = scaler.fit_transform(df_train)
-        test_scaled = scaler.transform(df_test)
+        df_test = self.load_embeddings_for(concat, norm, weights, 'test',
+                                           overwrite)
+        test_scaled = ((df_test - mean) / scale).astype(np.float32)
 
         return (train_scaled, test_scaled)
 
-    def extract_embeddings(self, concat=True, norm=False, weights="imagenet",
-                           overwrite=False, coos_dset='test',
-                           save=True) -> pd.DataFrame:
-        """Extract activations/embeddings for evaluation set.
-            - If concat, extract embeddings for each channel. Else, average channels
-                to produce 1 grayscale image, then extract embeddings.
-            - If norm, then normalize image between [0 and 1] with respect to
-                0.1th and 99.9th then normalize once again to [0, 255] by
-                multiplying 255.
+    def load_embeddings_for(self, concat: bool, norm: bool, weights,
+                            coos_dset: str, overwrite=False) -> np.array:
+        """Return unscaled embeddings for the COOS-7 <coos_dset> set, which
+        are extracted if they don't exist or if <overwrite>.
         """
-        # Load model
-        model = load_model(weights, overwrite=overwrite, dset_=self.dset)
-
-        # Create efficient data generators
-        test_generator = ImageGenerator(self.create_path_iterators(
-            coos_dset=coos_dset), concat, norm)
-        ds_test = tf.data.Dataset.from_generator(lambda: test_generator,
-                                                 output_types=(tf.float32))
-
-        # Prefetch data in batches
-        batch_size = 1
-        # ds_test = ds_test.batch(batch_size)
-        ds_test = ds_test.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-        steps_to_predict = ceil(len(test_generator) / batch_size)
-        # Extract embeddings
-        accum_activations = model.predict(ds_test, verbose=1,
-                                          steps=steps_to_predict, workers=32)
+        weights_str = check_weights_str(weights,
+                                        self.cytoimagenet_weights_suffix)
+        name = 'coos7_train' if coos_dset == 'train' else self.name
+        suffix = f" ({weights_str}, {create_save_str(concat, norm)})"
 
-        # Concatenate <num_channels> consecutive feature vectors that correspond to 1 image
-        if concat:
-            proc_activations = []
-            for i in range(self.num_channels, len(accum_activations) + 1,
-                           self.num_channels):
-                proc_activations.append(
-                    accum_activations[i - self.num_channels:i].flatten())
-            activations = pd.DataFrame(proc_activations)
-        else:
-            activations = pd.DataFrame(accum_activations)
+        # Load embeddings if present
+        if embeddings_exist(name, weights_str, concat, norm) and \
+                not overwrite:
+            return load_embeddings(
+                name, weights_str, concat, norm,
+                path_gens=self.create_path_iterators(coos_dset=coos_dset))
+
+        # If not, extract embeddings
+        print(f"Beginning extraction of {name.upper()} w/{suffix}...")
+        start = datetime.datetime.now()
+        activations = self.extract_embeddings(concat, norm, weights,
+                                              overwrite=overwrite,
+                                              coos_dset=coos_dset,
+                                              resume=not overwrite)
+        end = datetime.datetime.now()
+        total = timer(start, end)
+        print("Finished Feature Extraction in ", round(total, 2),
+              " minutes!")
 
-        # Save extracted embeddings
-        if save:
-            weights_str = check_weights_str(weights,
-                                            self.cytoimagenet_weights_suffix)
+        # Log time taken
+        log_inference_time(name, weights_str, concat, norm, total)
+        return activations
 
-            # Check if directory exists
-            if not os.path.exists(f"{embedding_dir}/{weights_str}_embeddings"):
-                os.mkdir(f"{embedding_dir}/{weights_str}_embeddings")
+    def prepare_train(self, weights, concat: bool, norm: bool,
+                      metric='euclidean', index='flat') -> None:
+        """Compute and save scaler statistics and the kNN index of the scaled
+        COOS-7 training set, for <weights>, <concat> and <norm>. These are
+        shared by all test sets, so they are prepared once before the test
+        sets are evaluated in parallel.
+        """
+        weights_str = check_weights_str(weights,
+                                        self.cytoimagenet_weights_suffix)
+        df_train = self.load_embeddings_for(concat, norm, weights, 'train')
+        mean, scale = embedding_store.get_scaler('coos7_train', weights_str,
+                                                 concat, norm)
+        self.fit_index(((df_train - mean) / scale).astype(np.float32),
+                       metric, index, weights_str, concat, norm)
+
+    def embedding_sources(self, with_train: bool) -> Optional[list]:
+        """Return names of embedding store entries that kNN features are
+        computed from. Training features are from the COOS-7 training set.
+        """
+        return ['coos7_train', self.name] if with_train else [self.name]
 
-            if coos_dset == 'test':
-                name = self.name
-            else:
-                name = 'coos7_train'
+    def source_order(self, name: str) -> list:
+        """Return paths (protein channel) of images in store entry <name>, in
+        the order that embedding rows are loaded in.
+        """
+        if name == 'coos7_train':
+            return self.create_path_iterators(coos_dset='train')[0]
+        return self.path_gens[0]
+
+    @staticmethod
+    def train_index_path(weights_str: str, concat: bool, norm: bool,
+                         metric='euclidean', index='flat') -> str:
+        """Return path of saved kNN index of the scaled COOS-7 training
+        set.
+        """
+        entry_dir = embedding_store.get_dir('coos7_train', weights_str,
+                                            concat, norm)
+        return f"{entry_dir}/knn_index({metric}, {index}).faiss"
+
+    def fit_index(self, df_train: np.array, metric: str, index: str,
+                  weights_str: str, concat: bool,
+                  norm: bool) -> FaissKNeighbors:
+        """Return kNN index fitted on the scaled COOS-7 training set
+        <df_train>. Indices are shared by all test sets, and saved alongside
+        the training embeddings.
+        """
+        key = (weights_str, concat, norm, metric, index)
+        if key in COOS7Validation.shared_indices:
+            knn_model = COOS7Validation.shared_indices[key]
+            if knn_model.index.ntotal == len(df_train):
+                instrumentation.count('index.reused')
+                return knn_model
+
+        # Saved index is valid if saved after the scaler statistics
+        index_path = None
+        index_valid = False
+        if embedding_store.exists('coos7_train', weights_str, concat, norm):
+            index_path = self.train_index_path(weights_str, concat, norm,
+                                               metric, index)
+            scaler_path = embedding_store.get_scaler_path(
+                'coos7_train', weights_str, concat, norm)
+            index_valid = os.path.exists(index_path) and \
+                os.path.exists(scaler_path) and \
+                os.path.getmtime(index_path) >= os.path.getmtime(scaler_path)
+
+        knn_model = FaissKNeighbors(metric=metric, index=index)
+        if index_valid:
+            with instrumentation.timer('index_load', items=len(df_train)):
+                knn_model.load(index_path)
+        if knn_model.index is None or \
+                knn_model.index.ntotal != len(df_train):
+            knn_model = super().fit_index(df_train, metric, index,
+                                          weights_str, concat, norm)
+            if index_path is not None:
+                knn_model.save(index_path)
+
+        if len(COOS7Validation.shared_indices) >= self.max_shared:
+            COOS7Validation.shared_indices.pop(
+                next(iter(COOS7Validation.shared_indices)))
+        COOS7Validation.shared_indices[key] = knn_model
+        return knn_model
 
-            filename = f"{embedding_dir}{weights_str}_embeddings/{name}_embeddings"
-            filename += f" ({weights_str}, {create_save_str(concat, norm)})"
+    def extract_embeddings(self, concat=True, norm=False, weights="imagenet",
+                           overwrite=False, coos_dset='test',
+                           save=True, batch_size=None,
+                           resume=False) -> np.array:
+        """Extract activations/embeddings for the COOS-7 <coos_dset> set.
+        See ValidationProcedure.extract_embeddings.
+        """
+        if coos_dset == 'test':
+            name = self.name
+        else:
+            name = 'coos7_train'
 
-            activations.to_hdf(f"{filename}.h5", key='embed', index=False)
-        return activations
+        return super().extract_embeddings(
+            concat, norm, weights, overwrite=overwrite, save=save,
+            batch_size=batch_size,
+            path_gens=self.create_path_iterators(coos_dset=coos_dset),
+            name=name, resume=resume)
 
 
 class CYCLoPsValidation(ValidationProcedure):
     """Yeast Perturbation Dataset Evaluation."""
 
+    # Images are small crops of single cells
+    batch_size = 64
+    k_values = (11,)
+
     def __init__(self, dset, suffix=''):
         self.data_dir = f'/neuhaus/alexlu/datasets/IMAGE_DATASETS/YEAST-PERTURBATION_yolanda-chong/chong_labeled'
         self.metadata = self.load_metadata()
@@ -1372,44 +2258,43 @@ class CYCLoPsValidation(ValidationProcedure):
         self.num_channels = 2
         self.path_gens = self.create_path_iterators()
         self.len_dataset = len(self.path_gens[0])
-        self.k_values = (11,)
         self.dset = dset
 
         self.cytoimagenet_weights_suffix = suffix
 
     def load_metadata(self) -> pd.DataFrame:
         """Return metadata dataframe for CYCLoPs based on directory structure.
+        Directory listings are cached, and only changed directories are
+        listed again.
         """
-        files = glob.glob(os.sep.join([self.data_dir, '*']))
-        # Get labels
-        labels = [file.split(self.data_dir + os.sep)[-1] for file in files]
-        labels.remove('DEAD')
-        labels.remove('GHOST')
-
-        accum_df = []
-        for i in range(len(labels)):
-            # Get all files for label
-            label_files = glob.glob(os.sep.join([files[i], '*']))
-            # Get unique filenames
-            label_files = list(
-                set(["_".join(file.split('_')[:-1]) for file in label_files]))
-
-            # Filter for channels
-            gfp_paths = [f"{file}_rfp.tif" for file in label_files]
-            rfp_paths = [f"{file}_gfp.tif" for file in label_files]
-            filtered_df = pd.DataFrame({'gfp_paths': gfp_paths,
-                                        'rfp_paths': rfp_paths})
-            # Assign label. Merge spindle and spindlepole
-            if labels[i] == 'SPINDLEPOLE':
-                filtered_df['label'] = 'SPINDLE'
-            else:
-                filtered_df['label'] = labels[i]
+        data_dir = self.data_dir
 
-            # Accumulate
-            accum_df.append(filtered_df)
-        df_metadata = pd.concat(accum_df, ignore_index=True)
+        def build_cyclops_metadata(label_files: dict) -> pd.DataFrame:
+            accum_df = []
+            for label, filenames in label_files.items():
+                if label in ('DEAD', 'GHOST'):
+                    continue
+                # Get unique filenames
+                label_paths = sorted(set(
+                    os.sep.join([data_dir, label,
+                                 "_".join(file.split('_')[:-1])])
+                    for file in filenames))
+
+                # Filter for channels
+                filtered_df = pd.DataFrame({
+                    'gfp_paths': [f"{path}_rfp.tif" for path in label_paths],
+                    'rfp_paths': [f"{path}_gfp.tif" for path in label_paths]})
+                # Assign label. Merge spindle and spindlepole
+                if label == 'SPINDLEPOLE':
+                    filtered_df['label'] = 'SPINDLE'
+                else:
+                    filtered_df['label'] = label
 
-        return df_metadata
+                # Accumulate
+                accum_df.append(filtered_df)
+            return pd.concat(accum_df, ignore_index=True)
+
+        return get_manifest(data_dir).get_dataframe(build_cyclops_metadata)
 
     def create_path_iterators(self) -> List[List[str]]:
         """Return list containing list of absolute paths for each channel."""
@@ -1432,9 +2317,9 @@ class CYCLoPsValidation(ValidationProcedure):
                                                    overwrite=True)
 
         # kNN Classifier
-        for k in self.k_values:
-            self.knn_classify(df_activations, labels, k, concat=concat,
-                              norm=norm, weights=weights, overwrite=True)
+        self.knn_classify(df_activations, labels, self.k_values,
+                          concat=concat, norm=norm, weights=weights,
+                          overwrite=True)
 
         # Create UMAP visualization of features
         self.umap_visualize(df_activations, labels=labels, weights=weights,
@@ -1454,10 +2339,9 @@ class CYCLoPsValidation(ValidationProcedure):
         labels = self.metadata['label'].to_numpy()
 
         # kNN Classifier
-        for k in self.k_values:
-            self.knn_classify(df_activations, labels, k, concat=True,
-                              norm=True, weights="cyto_imagenet_fusion",
-                              overwrite=True)
+        self.knn_classify(df_activations, labels, self.k_values,
+                          concat=True, norm=True,
+                          weights="cyto_imagenet_fusion", overwrite=True)
 
         # Create UMAP visualization of features
         self.umap_visualize(df_activations, labels=labels,
@@ -1471,26 +2355,37 @@ def main_cytoimagenet():
 
 
 def main_coos(cyto_suffix='', dset='full'):
+    start = datetime.datetime.now()
+    protocols = []
     for i in range(1, 5):
-        start = datetime.datetime.now()
         protocol = COOS7Validation(dset, test=f"test{i}")
         protocol.cytoimagenet_weights_suffix = cyto_suffix
-        print("=" * 30)
-        print(f"COOS-7 Test Set {i} Processing...")
-        print("=" * 30)
-        for weights in ['cytoimagenet', 'imagenet', None]:
-            for concat in [True, False]:
-                for norm in [True, False]:
+        protocols.append(protocol)
+    print("=" * 30)
+    print(f"COOS-7 Processing...")
+    print("=" * 30)
+    # Extract all embeddings, reading each image once
+    protocols[0].extract_embeddings_fused(coos_dset='train')
+    for protocol in protocols:
+        protocol.extract_embeddings_fused(coos_dset='test')
+
+    # Evaluate all test sets for each configuration, so that training set
+    # embeddings, scaler and kNN index are shared
+    for weights in ['cytoimagenet', 'imagenet', None]:
+        for concat in [True, False]:
+            for norm in [True, False]:
+                for protocol in protocols:
                     suffix = f" ({check_weights_str(weights)}, {create_save_str(concat, norm)})"
                     print(
                         f"Processing kNN predictions for {protocol.name.upper()} w/{suffix}...")
                     protocol.evaluate(weights=weights, concat=concat, norm=norm)
-            # Get final results
+        # Get final results
+        for protocol in protocols:
             protocol.get_all_results(weights)
-            print(f"Done with {check_weights_str(weights)}!")
-        end = datetime.datetime.now()
-        total = timer(start, end)
-        print(f"COOS-7 Test Set {i} finished in {round(total, 2)} minutes..")
+        print(f"Done with {check_weights_str(weights)}!")
+    end = datetime.datetime.now()
+    total = timer(start, end)
+    print(f"COOS-7 finished in {round(total, 2)} minutes..")
 
     # Create plot comparing ImageNet, CytoImageNet and Random features
     protocol.plot_all_results()
@@ -1503,6 +2398,8 @@ def main_cyclops(cyto_suffix='', dset='full'):
     print("=" * 30)
     print(f"CYCLoPs Processing...")
     print("=" * 30)
+    # Extract all embeddings, reading each image once
+    protocol.extract_embeddings_fused()
     for weights in ['cytoimagenet', 'imagenet', None]:
         for concat in [True, False]:
             for norm in [True, False]:
@@ -1529,6 +2426,9 @@ def main_bbbc021(cyto_suffix='', dset='full'):
     print("=" * 30)
     print(f"BBBC021 Processing...")
     print("=" * 30)
+    # Extract all embeddings, reading each image once
+    protocol.extract_embeddings_fused(
+        variants=((True, False), (False, True), (False, False)))
     for weights in ['cytoimagenet', 'imagenet', None]:
         for concat in [True, False]:
             for norm in [True, False]:
@@ -1549,12 +2449,30 @@ def main_bbbc021(cyto_suffix='', dset='full'):
     protocol.plot_all_results()
 
 
-def compile_results(val_set='bbbc021'):
-    files = glob.glob(f"{evaluation_dir}{val_set}_aggregated_results(*).csv")
+def procedure_class(val_set: str) -> type:
+    """Return ValidationProcedure subclass evaluating <val_set>."""
+    if val_set == 'bbbc021':
+        return BBBC021Protocol
+    elif val_set == 'cyclops':
+        return CYCLoPsValidation
+    elif val_set.startswith('coos7'):
+        return COOS7Validation
+    raise ValueError(f"Unknown validation set {val_set}!")
+
+
+def compile_results(val_set='bbbc021', k_values=None):
+    """Save table of accuracy (with 95% confidence interval) by preprocessing
+    method and weights for <val_set>, from the results database. Results are
+    averaged over <k_values>, which defaults to the k-values of the validation
+    procedure.
+    """
+    if k_values is None:
+        k_values = procedure_class(val_set).k_values
+    df = results_db.get_aggregated(val_set, k_values=k_values)
 
     if val_set == 'bbbc021':
-        files = [i for i in files if 'toy' not in i]  # remove toy examples
-        files = [i for i in files if '(cytoimagenet).csv' not in i]
+        df = df[~df.weights.str.contains('toy')]  # remove toy examples
+        df = df[df.weights != 'cytoimagenet']
 
     # Change naming convention
     map_name = {'cytoimagenetfull-16_epochs': 'CytoImageNet-894 [16 epochs]',
@@ -1568,28 +2486,23 @@ def compile_results(val_set='bbbc021'):
                 'cyto_imagenet_fusion': 'CytoImageNet + ImageNet Fusion'
                 }
 
-    curr_df = pd.read_csv(files[0])
-    accum_df = pd.DataFrame()
-    accum_df['Accuracy by preprocessing method'] = curr_df.apply(
-        lambda x: create_save_str(not x.to_grayscale, x.normalized).replace(
-            ', ', ' and '), axis=1)
-    accuracy_ci = curr_df.apply(lambda
-                                    x: f"{round(x.total_accuracy * 100, 2)} +/- {round(x.ci * 100, 2)}%",
-                                axis=1).tolist()
-    accum_df = accum_df.assign(
-        **{map_name[curr_df.weights.iloc[0]]: accuracy_ci})
-
-    for file in files[1:]:
-        curr_df = pd.read_csv(file)
-        accuracy_ci = curr_df.apply(lambda
-                                        x: f"{round(x.total_accuracy * 100, 2)} +/- {round(x.ci * 100, 2)}%",
-                                    axis=1).tolist()
-        # If only concat & norm present, fill remaining with missing values
-        if len(accuracy_ci) == 1:
-            accuracy_ci.extend([None, None, None])
-        # Assign weights to accuracy
-        accum_df = accum_df.assign(
-            **{map_name[curr_df.weights.iloc[0]]: accuracy_ci})
+    df['method'] = [create_save_str(not to_grayscale, normalized).replace(
+        ', ', ' and ') for to_grayscale, normalized in
+        zip(df.to_grayscale, df.normalized)]
+    ci = 1.96 * np.sqrt((df.total_accuracy * (1 - df.total_accuracy)) /
+                        df.num_samples)
+    df['accuracy_ci'] = [f"{round(acc * 100, 2)} +/- {round(ci_ * 100, 2)}%"
+                         for acc, ci_ in zip(df.total_accuracy, ci)]
+    df['weights'] = df.weights.map(lambda x: map_name.get(x, x))
+
+    # One row per preprocessing method, one column per weights
+    methods = [create_save_str(concat, norm).replace(', ', ' and ')
+               for concat in [True, False] for norm in [True, False]]
+    accum_df = df.pivot(index='method', columns='weights',
+                        values='accuracy_ci').reindex(methods)
+    accum_df = accum_df.rename_axis(
+        'Accuracy by preprocessing method').reset_index()
+    accum_df.columns.name = None
 
     # Reorder columns
     preferred = ['Accuracy by preprocessing method', 'Random', 'ImageNet',
@@ -1606,6 +2519,161 @@ def compile_results(val_set='bbbc021'):
                     index=False)
 
 
+# Scheduled Evaluation
+def embeddings_file(name: str, weights_str: str, concat: bool,
+                    norm: bool) -> str:
+    """Return path of file marking embeddings for key. This is the store
+    manifest, unless only legacy embeddings exist.
+    """
+    legacy_path = legacy_embeddings_path(name, weights_str, concat, norm)
+    if not embedding_store.exists(name, weights_str, concat, norm) and \
+            os.path.exists(legacy_path):
+        return legacy_path
+    return f"{embedding_store.get_dir(name, weights_str, concat, norm)}" \
+           f"/manifest.json"
+
+
+def all_embeddings_exist(keys: list) -> bool:
+    """Return True if embeddings exist for all (name, weights_str, concat,
+    norm) in <keys>.
+    """
+    return all(embeddings_exist(*key) for key in keys)
+
+
+def run_evaluation_task(protocol: ValidationProcedure, weights, concat: bool,
+                        norm: bool, num_threads: int = 1) -> None:
+    """Evaluate <protocol> for one configuration of weights and preprocessing,
+    using <num_threads> threads for kNN search.
+    """
+    faiss.omp_set_num_threads(num_threads)
+    protocol.evaluate(weights=weights, concat=concat, norm=norm,
+                      overwrite=False)
+
+
+def run_prepare_task(protocol: COOS7Validation, weights, concat: bool,
+                     norm: bool, num_threads: int = 1) -> None:
+    """Prepare the COOS-7 training set scaler and kNN index for one
+    configuration of weights and preprocessing, using <num_threads> threads.
+    """
+    faiss.omp_set_num_threads(num_threads)
+    protocol.prepare_train(weights, concat, norm)
+
+
+def build_evaluation_graph(cyto_suffix='', dset='full', knn_cpus=4,
+                           extract_cpus=8) -> TaskGraph:
+    """Return task graph of embedding extraction -> scaling and kNN ->
+    get_all_results -> compile_results for BBBC021, CYCLoPs and COOS-7
+    test sets 1-4. COOS-7 test sets share the training set's scaler and kNN
+    index, which are prepared by their own task before any test set.
+
+    Scaling is done in memory by load_activations, and so runs in the same
+    task as kNN classification. kNN results are complete once they are in the
+    results database, and are out of date if their summary is older than the
+    embeddings. Extraction tasks share the GPU, and never run at the same
+    time. Each runs in its own process, which releases its GPU memory when
+    it exits.
+    """
+    graph = TaskGraph()
+    weights_list = ['cytoimagenet', 'imagenet', None]
+    protocols = [BBBC021Protocol(dset), CYCLoPsValidation(dset)] + \
+                [COOS7Validation(dset, test=f"test{i}") for i in range(1, 5)]
+
+    for protocol in protocols:
+        protocol.cytoimagenet_weights_suffix = cyto_suffix
+        weights_strs = [check_weights_str(weights, cyto_suffix)
+                        for weights in weights_list]
+        if protocol.name == 'bbbc021':
+            variants = ((True, False), (False, True), (False, False))
+        else:
+            variants = ((True, True), (True, False), (False, True),
+                        (False, False))
+
+        # Extract embeddings. COOS-7 test sets share training embeddings
+        extractions = [(protocol.name, {})]
+        if isinstance(protocol, COOS7Validation):
+            extractions = [('coos7_train', {'coos_dset': 'train'}),
+                           (protocol.name, {'coos_dset': 'test'})]
+        extract_tasks = []
+        for name, kwargs in extractions:
+            extract_tasks.append(f"extract[{name}]")
+            if extract_tasks[-1] in graph.tasks:
+                continue
+            keys = [(name, weights_str, concat, norm)
+                    for weights_str in weights_strs
+                    for concat, norm in variants]
+            graph.add(Task(
+                extract_tasks[-1], protocol.extract_embeddings_fused,
+                kwargs={'weights_list': weights_list, 'variants': variants,
+                        **kwargs},
+                outputs=[embeddings_file(*key) for key in keys],
+                cpus=extract_cpus, lock='gpu', isolate=True,
+                is_complete=partial(all_embeddings_exist, keys)))
+
+        aggregate_tasks = []
+        for weights, weights_str in zip(weights_list, weights_strs):
+            # Scale embeddings and classify with kNN
+            knn_tasks = []
+            for concat, norm in variants:
+                knn_deps = list(extract_tasks)
+                if isinstance(protocol, COOS7Validation):
+                    knn_deps.append(f"prepare[coos7_train, {weights_str}, "
+                                    f"{create_save_str(concat, norm)}]")
+                    if knn_deps[-1] not in graph.tasks:
+                        graph.add(Task(
+                            knn_deps[-1], run_prepare_task,
+                            args=(protocol, weights, concat, norm, knn_cpus),
+                            outputs=[
+                                embedding_store.get_scaler_path(
+                                    'coos7_train', weights_str, concat, norm),
+                                protocol.train_index_path(weights_str, concat,
+                                                          norm)],
+                            deps=extract_tasks[:1], cpus=knn_cpus))
+
+                knn_tasks.append(f"knn[{protocol.name}, {weights_str}, "
+                                 f"{create_save_str(concat, norm)}]")
+                graph.add(Task(
+                    knn_tasks[-1], run_evaluation_task,
+                    args=(protocol, weights, concat, norm, knn_cpus),
+                    outputs=[protocol.knn_summary_path(weights_str, concat,
+                                                       norm)],
+                    deps=knn_deps, cpus=knn_cpus,
+                    is_complete=partial(protocol.knn_results_exist,
+                                        weights, concat, norm,
+                                        protocol.k_values)))
+
+            # Aggregate results for weights
+            aggregate_tasks.append(f"aggregate[{protocol.name}, "
+                                   f"{weights_str}]")
+            graph.add(Task(
+                aggregate_tasks[-1], protocol.get_all_results,
+                args=(weights,),
+                outputs=[f"{evaluation_dir}{protocol.name}_aggregated_"
+                         f"results({weights_str}).csv"],
+                deps=knn_tasks))
+
+        # Compile results over all weights
+        graph.add(Task(
+            f"compile[{protocol.name}]", compile_results,
+            args=(protocol.name,),
+            outputs=[f"{evaluation_dir}/{protocol.name}_final_results.csv"],
+            deps=aggregate_tasks))
+
+    return graph
+
+
+def main_scheduled(cyto_suffix='', dset='full', cpu_budget=32,
+                   force=False):
+    """Run all evaluations as a task graph, skipping up-to-date results and
+    running independent tasks in parallel within <cpu_budget> CPUs.
+    """
+    start = datetime.datetime.now()
+    graph = build_evaluation_graph(cyto_suffix, dset)
+    status = graph.run(cpu_budget=cpu_budget, force=force)
+    end = datetime.datetime.now()
+    print(f"Evaluation finished in {round(timer(start, end), 2)} minutes..")
+    print(pd.Series(status).value_counts())
+
+
 if __name__ == "__main__" and "D:\\" not in os.getcwd():
     dset = 'full'
     curr_weights = 'full(aug)-24_epochs'
@@ -1,23 +1,28 @@
 import tensorflow as tf
 from tensorflow.keras import mixed_precision
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from tensorflow.keras.layers import Dense, Activation, Dropout
 from tensorflow.keras.applications import EfficientNetB0
 from tensorflow.keras.optimizers import Adam, RMSprop
-from tensorflow.keras.callbacks import ModelCheckpoint, ReduceLROnPlateau
+from tensorflow.keras.callbacks import CSVLogger, ReduceLROnPlateau
 
-from sklearn.model_selection import train_test_split
 import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import glob
 
+from data_processing.grayscale_model import copy_to_rgb_model, \
+    stem_affines, to_grayscale_model
+from data_processing.pack_shards import load_shards
+from data_processing.split_manifest import load_split
+
 # PATHS
 annotations_dir = "/home/stan/cytoimagenet/annotations/"
 model_dir = "/home/stan/cytoimagenet/model/"
 plot_dir = "/home/stan/cytoimagenet/figures/training/"
 cyto_dir = '/ferrero/cytoimagenet/'
+shard_dir = '/ferrero/cytoimagenet/shards/'
 
 # Only use CPU
 # os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -78,111 +83,289 @@ def get_labels(diverse: bool = False, toy=None) -> list:
 
 
 # ==Data Loading==:
-def load_dataset(batch_size: int = 64, split=False, labels=None):
-    """Return tuple of (training, validation) data iterators, constructed from
-    metadata.
+def rotation_transforms(angles: tf.Tensor, height: int,
+                        width: int) -> tf.Tensor:
+    """Return (batch, 8) projective transforms rotating images of shape
+    (<height>, <width>) about their center by <angles> (in radians).
+
+    Transforms map output to input coordinates, as in
+    tf.raw_ops.ImageProjectiveTransformV2.
+    """
+    cos = tf.math.cos(angles)
+    sin = tf.math.sin(angles)
+    x_offset = ((width - 1) - (cos * (width - 1) - sin * (height - 1))) / 2
+    y_offset = ((height - 1) - (sin * (width - 1) + cos * (height - 1))) / 2
+    zeros = tf.zeros_like(angles)
+    return tf.stack([cos, -sin, x_offset, sin, cos, y_offset, zeros, zeros],
+                    axis=1)
+
+
+def random_rotate(images: tf.Tensor, seed: tf.Tensor) -> tf.Tensor:
+    """Return batch of <images> rotated by uniformly random angles, filling
+    corners by reflecting the image. Same as ImageDataGenerator with
+    rotation_range=360 and fill_mode='reflect', but applied to the whole batch
+    in one op.
+
+    ==Parameters==:
+        seed: shape (2,) int32/int64 tensor for stateless random angles
+    """
+    shape = tf.shape(images)
+    angles = tf.random.stateless_uniform([shape[0]], seed=seed,
+                                         maxval=2 * np.pi)
+    transforms = rotation_transforms(angles, tf.cast(shape[1], tf.float32),
+                                     tf.cast(shape[2], tf.float32))
+    return tf.raw_ops.ImageProjectiveTransformV2(
+        images=images, transforms=transforms, output_shape=shape[1:3],
+        interpolation='BILINEAR', fill_mode='REFLECT')
+
+
+def epoch_indices(num_samples: int, batch_size: int, shuffle: bool,
+                  initial_epoch: int = 0) -> tf.data.Dataset:
+    """Return infinite dataset of sample indices, from epoch <initial_epoch>
+    onwards. Each epoch has (<num_samples> // <batch_size>) full batches.
+
+    If <shuffle>, each epoch is drawn from a permutation seeded by the epoch
+    number, so resumed training sees the same samples in the same order.
+    """
+    num_epoch_samples = num_samples // batch_size * batch_size
+    if not shuffle:
+        return tf.data.Dataset.range(num_epoch_samples).repeat()
+
+    def permute(epoch):
+        noise = tf.random.stateless_uniform(
+            [num_samples], seed=tf.stack([tf.constant(728565, tf.int64),
+                                          epoch]))
+        return tf.data.Dataset.from_tensor_slices(
+            tf.argsort(noise)[:num_epoch_samples])
+
+    return tf.data.Dataset.range(initial_epoch, 2 ** 62).flat_map(permute)
+
+
+def batch_and_augment(ds: tf.data.Dataset, batch_size: int,
+                      augment: bool, initial_step: int = 0,
+                      num_parallel_calls=tf.data.experimental.AUTOTUNE
+                      ) -> tf.data.Dataset:
+    """Return <ds> of (image, label) batched and prefetched. If <augment>,
+    randomly rotate each batch, with seeds fixed by batch position (counted
+    from <initial_step>).
+    """
+    ds = ds.batch(batch_size)
+    if augment:
+        ds = ds.enumerate(start=initial_step).map(
+            lambda step, batch: (
+                random_rotate(batch[0],
+                              tf.stack([tf.constant(728565, tf.int64), step])),
+                batch[1]),
+            num_parallel_calls=num_parallel_calls)
+    return ds.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
+
+
+def read_image(path: tf.Tensor, channels: int = 3,
+               image_size: int = 224) -> tf.Tensor:
+    """Return image at <path> with <channels> channels (1: grayscale, 3: RGB),
+    resized to (<image_size>, <image_size>) with bilinear interpolation, as
+    float32 in [0, 255]. Downscaling is antialiased, filtering over the source
+    area like PIL's BILINEAR resize in flow_from_dataframe and packed shards.
+    """
+    img = tf.io.decode_image(tf.io.read_file(path), channels=channels,
+                             expand_animations=False)
+    img = tf.image.resize(img, (image_size, image_size), method='bilinear',
+                          antialias=True)
+    return tf.ensure_shape(img, [image_size, image_size, channels])
+
+
+def create_image_dataset(paths: np.array, class_ids: np.array,
+                         num_classes: int, batch_size: int, augment: bool,
+                         shuffle: bool, channels: int = 3,
+                         initial_epoch: int = 0,
+                         num_parallel_calls=tf.data.experimental.AUTOTUNE,
+                         image_size: int = 224) -> tf.data.Dataset:
+    """Return infinite tf.data.Dataset of (images, one-hot labels) batches,
+    reading images at <paths> with <num_parallel_calls> parallel decodes.
+
+    See load_dataset.
+    """
+    paths = tf.constant(np.asarray(paths).astype(str))
+    class_ids = tf.constant(np.asarray(class_ids))
+    ds = epoch_indices(len(paths), batch_size, shuffle, initial_epoch)
+    ds = ds.map(lambda i: (read_image(tf.gather(paths, i), channels,
+                                      image_size),
+                           tf.one_hot(tf.gather(class_ids, i), num_classes)),
+                num_parallel_calls=num_parallel_calls)
+    return batch_and_augment(ds, batch_size, augment,
+                             initial_epoch * (len(paths) // batch_size),
+                             num_parallel_calls)
+
+
+def load_dataset(batch_size: int = 64, split=False, labels=None,
+                 channels: int = 3, initial_epoch: int = 0,
+                 image_size: int = 224):
+    """Return tuple of (training, validation) tf.data.Dataset, and tuple of
+    (training, validation) steps per epoch, constructed from metadata.
 
     With following fixed parameters:
-        - target size: (224, 224)
-        - color mode: RGB
-        - shuffle: True
-        - seed: 7779836983
+        - target size: (224, 224), unless <image_size> is specified
+        - color mode: RGB, or grayscale if <channels> == 1
+        - shuffle: True (training set only)
+        - seed: 728565
         - interpolation: bilinear
+        - augmentation: random rotation with reflect padding (training set)
+
+    Images are decoded in parallel and augmented a batch at a time. Epochs
+    are the same when resuming from <initial_epoch> (see epoch_indices). The
+    train-val split is loaded from its saved manifest (see
+    data_processing/split_manifest.py).
     """
-    # Use metadata to create generators of image batches
+    # Use metadata to create datasets of image batches
     df = pd.read_csv('/ferrero/cytoimagenet/metadata.csv')
+    if split:
+        train_rows, val_rows = load_split(labels, df=df)
     df = df[df.label.isin(labels)]
-    df['full_path'] = df.apply(lambda x: x.path + "/" + x.filename, axis=1)
+    df['full_path'] = df.path + "/" + df.filename
+
+    # Labels are one-hot encoded in sorted order
+    class_names = sorted(df.label.unique())
+    df['class_id'] = df.label.map({label: i for i, label in
+                                   enumerate(class_names)})
+
+    def create_dataset(df_subset, augment, shuffle):
+        return create_image_dataset(
+            df_subset.full_path.to_numpy(), df_subset.class_id.to_numpy(),
+            len(class_names), batch_size, augment, shuffle, channels,
+            initial_epoch, image_size=image_size)
 
     if split:   # if train-val split
-        df_train, df_val = train_test_split(df, test_size=0.1, random_state=0,
-                                            stratify=df['label'])
-        train_gen = ImageDataGenerator(
-            rotation_range=360, fill_mode='reflect'
-        )
-        train_generator = train_gen.flow_from_dataframe(
-            dataframe=df_train,
-            directory=None,
-            x_col='full_path',
-            y_col='label',
-            batch_size=batch_size,
-            target_size=(224, 224),
-            interpolation="bilinear",
-            color_mode="rgb",
-            shuffle=True,
-            seed=728565,
-        )
-        val_gen = ImageDataGenerator()
-        val_generator = val_gen.flow_from_dataframe(
-            dataframe=df_val,
-            directory=None,
-            x_col='full_path',
-            y_col='label',
-            shuffle=False,
-            batch_size=batch_size,
-            target_size=(224, 224),
-            interpolation="bilinear",
-            color_mode="rgb",
-            seed=728565
-        )
-        return train_generator, val_generator
-    else:
-        # If no train-val split
-        datagen = ImageDataGenerator(
-            rotation_range=360, fill_mode='reflect'
-        )
-        train_generator = datagen.flow_from_dataframe(
-            dataframe=df,
-            directory=None,
-            x_col='full_path',
-            y_col='label',
-            batch_size=batch_size,
-            target_size=(224, 224),
-            interpolation="bilinear",
-            color_mode="rgb",
-            shuffle=True,
-            seed=728565
-        )
-        return train_generator, None
+        df_train, df_val = df.loc[train_rows], df.loc[val_rows]
+        return (create_dataset(df_train, True, True),
+                create_dataset(df_val, False, False)), \
+               (len(df_train) // batch_size, len(df_val) // batch_size)
+    # If no train-val split
+    return (create_dataset(df, True, True), None), \
+           (len(df) // batch_size, None)
+
+
+def load_packed_dataset(batch_size: int = 64, split=False, labels=None,
+                        packed_dir: str = shard_dir, channels: int = 3,
+                        initial_epoch: int = 0, image_size: int = 224):
+    """Return tuple of (training, validation) tf.data.Dataset, constructed from
+    memory-mapped shards of pre-resized images. See
+    data_processing/pack_shards.py to create shards from metadata.
+
+    Images, labels and train-val split are the same as in load_dataset.
+    Images are read from the shards as contiguous bytes, so no PNG decoding
+    or resizing is done during training, unless <image_size> differs from
+    the packed size (224). Grayscale images are converted to RGB unless
+    <channels> == 1. Rows of images that could not be read when packed
+    (height 0) are dropped.
+    """
+    shards, df, all_labels = load_shards(packed_dir)
+    df = df.set_index('row_id', drop=False)
+    df = df[df.label.isin(labels)]
+
+    # Drop unreadable images, left blank by shards packed before this check
+    unreadable = (df.height == 0)
+    if unreadable.any():
+        print(f"Dropping {unreadable.sum()} unreadable images from "
+              f"{packed_dir}!")
+        df = df[~unreadable]
+
+    # Re-encode labels (sorted) for the chosen subset of labels
+    subset_labels = sorted(df.label.unique())
+    subset_ids = np.full(len(all_labels), -1, dtype=np.int32)
+    for i, label in enumerate(subset_labels):
+        subset_ids[all_labels.index(label)] = i
+    df = df.assign(class_id=subset_ids[df.label_id.to_numpy()])
+
+    def read_packed_image(shard, offset):
+        return np.asarray(shards[shard][offset], dtype=np.float32)[..., None]
+
+    def create_dataset(df_subset, augment, shuffle):
+        shard_ids = tf.constant(df_subset.shard.to_numpy())
+        offsets = tf.constant(df_subset.offset.to_numpy())
+        class_ids = tf.constant(df_subset.class_id.to_numpy())
+        ds = epoch_indices(len(df_subset), batch_size, shuffle,
+                           initial_epoch)
+
+        def load(i):
+            img = tf.numpy_function(read_packed_image,
+                                    [tf.gather(shard_ids, i),
+                                     tf.gather(offsets, i)],
+                                    tf.float32)
+            img = tf.ensure_shape(img, [224, 224, 1])
+            if image_size != 224:
+                img = tf.image.resize(img, (image_size, image_size),
+                                      method='bilinear', antialias=True)
+            if channels == 3:
+                img = tf.image.grayscale_to_rgb(img)
+            return img, tf.one_hot(tf.gather(class_ids, i),
+                                   len(subset_labels))
+
+        ds = ds.map(load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        return batch_and_augment(
+            ds, batch_size, augment,
+            initial_epoch * (len(df_subset) // batch_size))
+
+    if split:   # if train-val split
+        train_rows, val_rows = load_split(labels)
+        df_train = df.loc[train_rows[np.isin(train_rows, df.index)]]
+        df_val = df.loc[val_rows[np.isin(val_rows, df.index)]]
+        return (create_dataset(df_train, True, True),
+                create_dataset(df_val, False, False)), \
+               (len(df_train) // batch_size, len(df_val) // batch_size)
+    return (create_dataset(df, True, True), None), \
+           (len(df) // batch_size, None)
 
 
 def get_dset_generators(split=False, num_classes=894, batch_size=64,
-                        labels=None) -> tuple:
-    """Return tuple of dataset generators. If split == False, return tuple with
-    only 1 training generator. Else, return tuple with training and validation
-    data generator.
+                        labels=None, packed=False, channels=3,
+                        initial_epoch=0, image_size=224) -> tuple:
+    """Return tuple of (training, validation) tf.data.Dataset and tuple of
+    (training, validation) steps per epoch. If split == False, validation
+    dataset and steps are None.
+
+    If <packed>, read images from memory-mapped shards of pre-resized images.
+    Otherwise, decode images listed in the metadata. If <channels> == 1,
+    images are grayscale. Datasets begin at epoch <initial_epoch>, with
+    images resized to (<image_size>, <image_size>).
     """
-    # Get data generators
-    train_gen, val_gen = load_dataset(batch_size=batch_size, split=split,
-                                      labels=labels)
-    # Number of Steps
-    steps_per_epoch_train = train_gen.n // train_gen.batch_size
-    # Create tf.data.Dataset objects from generator
-    ds_train = tf.data.Dataset.from_generator(
-        lambda: train_gen,
-        output_types=(tf.float32, tf.float32),
-        output_shapes=([None, 224, 224, 3], [None, num_classes]))
-    # Prefetch data
-    ds_train = ds_train.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-
-    if split:  # If split into train-val sets
-        steps_per_epoch_val = val_gen.n // val_gen.batch_size
-        ds_val = tf.data.Dataset.from_generator(
-            lambda: val_gen,
-            output_types=(tf.float32, tf.float32),
-            output_shapes=([None, 224, 224, 3], [None, num_classes]))
-        ds_val = ds_val.prefetch(buffer_size=tf.data.experimental.AUTOTUNE)
-        return (ds_train, ds_val), (steps_per_epoch_train, steps_per_epoch_val)
-    return (ds_train, None), (steps_per_epoch_train, None)
+    if packed:
+        return load_packed_dataset(batch_size=batch_size, split=split,
+                                   labels=labels, channels=channels,
+                                   initial_epoch=initial_epoch,
+                                   image_size=image_size)
+    return load_dataset(batch_size=batch_size, split=split, labels=labels,
+                        channels=channels, initial_epoch=initial_epoch,
+                        image_size=image_size)
 
 
 # ==Defining Model==:
-def create_model(num_classes: int, weights=None, pooling="avg"):
-    """Construct tensorflow model."""
+def create_model(num_classes: int, weights=None, pooling="avg", channels=3,
+                 input_tensor=None, image_size=224):
+    """Construct tensorflow model, for images of size
+    (<image_size>, <image_size>). Weights don't depend on <image_size>, so
+    they can be transferred between models of different image sizes.
+
+    If <channels> == 1, the model accepts grayscale images. Its stem
+    convolution weights are summed across RGB channels, so its outputs are
+    the same as the RGB model's for grayscale images converted to RGB. See
+    data_processing/grayscale_model.py.
+
+    If <input_tensor> is specified, build the model on <input_tensor>.
+    """
+    if channels == 1:
+        model = create_model(num_classes, weights=weights, pooling=pooling,
+                             image_size=image_size)
+        return to_grayscale_model(
+            model, lambda x: create_model(num_classes, pooling=pooling,
+                                          input_tensor=x))
+
+    input_shape = (image_size, image_size, 3) if input_tensor is None \
+        else None
     if pooling == "max":
         efficient_model = EfficientNetB0(weights=weights,
                                          include_top=False,
-                                         input_shape=(224, 224, 3),
+                                         input_shape=input_shape,
+                                         input_tensor=input_tensor,
                                          pooling="max")
         efficient_model.trainable = True
 
@@ -196,12 +379,14 @@ def create_model(num_classes: int, weights=None, pooling="avg"):
     else:
         if weights is None:
             model = EfficientNetB0(weights=weights,
-                                   input_shape=(224, 224, 3),
+                                   input_shape=input_shape,
+                                   input_tensor=input_tensor,
                                    classes=num_classes)
             model.trainable = True
         elif weights == "imagenet":
             efficient_model = EfficientNetB0(weights=weights,
-                                             input_shape=(224, 224, 3))
+                                             input_shape=input_shape,
+                                             input_tensor=input_tensor)
             efficient_model.trainable = True
 
             x = Dense(num_classes, activation='softmax')(efficient_model.layers[-2].output)
@@ -210,24 +395,181 @@ def create_model(num_classes: int, weights=None, pooling="avg"):
     return model
 
 
+# ==Checkpoints==:
+def optimizer_variables(optimizer) -> list:
+    """Return list of <optimizer> variables (iterations and slots)."""
+    variables = optimizer.variables
+    return list(variables() if callable(variables) else variables)
+
+
+def list_training_states(checkpoint_dir: str) -> list:
+    """Return paths to training states in <checkpoint_dir>, sorted by epoch.
+    """
+    paths = glob.glob(f"{checkpoint_dir}/training_state-epoch_*.npz")
+    return sorted(paths, key=lambda path: int(
+        path.split("training_state-epoch_")[-1].replace(".npz", "")))
+
+
+def latest_training_state(checkpoint_dir: str):
+    """Return path to the latest training state in <checkpoint_dir>, or None
+    if there is none.
+    """
+    paths = list_training_states(checkpoint_dir)
+    return paths[-1] if paths else None
+
+
+def save_training_state(path: str, epoch: int, model_weights: list,
+                        optimizer_weights: list) -> None:
+    """Atomically save training state after <epoch> epochs, with model and
+    optimizer weights (as lists of arrays).
+    """
+    arrays = {f"model_{i}": w for i, w in enumerate(model_weights)}
+    arrays.update({f"optimizer_{i}": w
+                   for i, w in enumerate(optimizer_weights)})
+    with open(f"{path}.tmp", 'wb') as f:
+        np.savez(f, epoch=epoch, num_model=len(model_weights),
+                 num_optimizer=len(optimizer_weights), **arrays)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_training_state(path: str) -> tuple:
+    """Return tuple of (epochs completed, model weights, optimizer weights)
+    from the training state at <path>.
+    """
+    with np.load(path) as state:
+        model_weights = [state[f"model_{i}"]
+                         for i in range(int(state['num_model']))]
+        optimizer_weights = [state[f"optimizer_{i}"]
+                             for i in range(int(state['num_optimizer']))]
+        return int(state['epoch']), model_weights, optimizer_weights
+
+
+def get_training_state(model: tf.keras.Model) -> tuple:
+    """Return tuple of (model weights, optimizer weights) of compiled
+    <model>, as lists of arrays.
+    """
+    return model.get_weights(), [variable.numpy() for variable in
+                                 optimizer_variables(model.optimizer)]
+
+
+def set_training_state(model: tf.keras.Model, model_weights: list,
+                       optimizer_weights: list) -> None:
+    """Set weights of compiled <model> and its optimizer."""
+    model.set_weights(model_weights)
+
+    # Create optimizer slots before assigning them
+    optimizer = model.optimizer
+    if hasattr(optimizer, '_create_all_weights'):
+        optimizer._create_all_weights(model.trainable_variables)
+    else:
+        optimizer.build(model.trainable_variables)
+    variables = optimizer_variables(optimizer)
+    if len(variables) != len(optimizer_weights):
+        raise ValueError(f"Optimizer has {len(variables)} variables, but "
+                         f"{len(optimizer_weights)} weights were given!")
+    for variable, value in zip(variables, optimizer_weights):
+        variable.assign(value)
+
+
+def restore_training_state(model: tf.keras.Model, path: str) -> int:
+    """Restore weights of <model> and its optimizer from the training state
+    at <path>. Return number of epochs completed.
+    """
+    epoch, model_weights, optimizer_weights = load_training_state(path)
+    set_training_state(model, model_weights, optimizer_weights)
+    return epoch
+
+
+class AsyncCheckpoint(tf.keras.callbacks.Callback):
+    """Save model weights (as h5) and training state every epoch. Weights are
+    copied on the training thread, then written in a background thread while
+    the next epoch trains.
+
+    Weights of grayscale models (see create_model) are saved as weights of
+    the equivalent RGB model, so they can be loaded with EfficientNetB0.
+
+    ==Attributes==:
+        shadow_model: model of the same architecture as the trained model,
+                        holding the weights being saved
+        rgb_model: RGB model whose weights are saved. Same as <shadow_model>
+                        if the trained model is RGB
+        affines: stem preprocessing of <shadow_model> and <rgb_model>, computed
+                        once on the training thread (see stem_affines)
+        filepath: path of weights, formatted with the epoch number
+        checkpoint_dir: directory of training states
+        keep: number of latest training states to keep
+    """
+
+    def __init__(self, shadow_model: tf.keras.Model,
+                 rgb_model: tf.keras.Model, filepath: str,
+                 checkpoint_dir: str, keep: int = 2):
+        super().__init__()
+        self.shadow_model = shadow_model
+        self.rgb_model = rgb_model
+        self.affines = None
+        if rgb_model is not shadow_model:
+            self.affines = stem_affines(shadow_model, rgb_model)
+        self.filepath = filepath
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def on_epoch_end(self, epoch, logs=None):
+        model_weights, optimizer_weights = get_training_state(self.model)
+        # Only one checkpoint is written at a time
+        self.wait()
+        self.pending = self.executor.submit(self.save, epoch + 1,
+                                            model_weights, optimizer_weights)
+
+    def on_train_end(self, logs=None):
+        self.wait()
+
+    def wait(self) -> None:
+        """Wait for checkpoint being written. Raises errors from writing."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def save(self, epoch: int, model_weights: list,
+             optimizer_weights: list) -> None:
+        """Save weights and training state after <epoch> epochs."""
+        self.shadow_model.set_weights(model_weights)
+        if self.rgb_model is not self.shadow_model:
+            copy_to_rgb_model(self.shadow_model, self.rgb_model,
+                              self.affines)
+        self.rgb_model.save_weights(self.filepath.format(epoch=epoch))
+
+        # Training state is saved last, so its weights always exist
+        save_training_state(
+            f"{self.checkpoint_dir}/training_state-epoch_{epoch:03d}.npz",
+            epoch, model_weights, optimizer_weights)
+        for path in list_training_states(self.checkpoint_dir)[:-self.keep]:
+            os.remove(path)
+
+
 # ==Plot==:
 def plot_loss(history, weight, dset: str = "toy", split=False):
-    """Plot training and validation results over the number of epochs."""
+    """Plot training and validation results over the number of epochs.
+
+    ==Parameters==:
+        history: dataframe (or dictionary) of metric values by epoch
+    """
     # Check if parent directory exists
     if not os.path.exists(plot_dir):
         os.mkdir(plot_dir)
 
     fig, (ax1, ax2) = plt.subplots(2, 1)
     # Plot Loss
-    ax1.plot(history.history['loss'], label='Training Set')
+    ax1.plot(history['loss'], label='Training Set')
     if split:
-        ax1.plot(history.history['val_loss'], label='Validation Data)')
+        ax1.plot(history['val_loss'], label='Validation Data)')
     ax1.set_ylabel('Categorical Cross Entropy Loss')
 
     # Plot Accuracy
-    ax2.plot(history.history['categorical_accuracy'], label='Training Set')
+    ax2.plot(history['categorical_accuracy'], label='Training Set')
     if split:
-        ax2.plot(history.history['val_categorical_accuracy'],
+        ax2.plot(history['val_categorical_accuracy'],
                  label='Validation Data)')
     ax2.set_ylabel('Accuracy')
     ax2.set_xlabel('Num Epochs')
@@ -258,31 +600,28 @@ def main():
     learn_rate = 0.001
     weights = None              # initialize from random or 'imagenet'
     pooling = "avg"             # 'avg' or 'max'
+    packed = False              # read from pre-resized image shards
+    channels = 1                # 1 for grayscale input, 3 for RGB
+    resume = True               # resume from latest training state
+    progressive = False         # train early epochs at lower resolution
+
+    # Training stages of (first epoch, image size, batch size). Lower
+    # resolution stages use larger batches.
+    if progressive:
+        schedule = [(0, 128, batch_size * 2),
+                    (num_epochs // 3, 160, batch_size * 3 // 2),
+                    (num_epochs * 2 // 3, 224, batch_size)]
+    else:
+        schedule = [(0, 224, batch_size)]
 
-    # Get data generators
-    gens, steps = get_dset_generators(split=split, num_classes=num_classes,
-                                      batch_size=batch_size, labels=classes)
-    ds_train, ds_val = gens
-    steps_per_epoch_train, steps_per_epoch_val = steps
-
-    # Construct model
-    model = create_model(num_classes, weights=weights, pooling=pooling)
-
-    # Optimizer
-    optimizer = Adam(lr=learn_rate)
-    # optimizer = RMSprop(lr=learn_rate,
-    #                     decay=0.9,
-    #                     momentum=0.9)
-
-    # Metrics
-    top_n_acc = tf.keras.metrics.TopKCategoricalAccuracy(
-        k=7, name='top_k_categorical_accuracy', dtype=None)
-
-    # Compile
-    model.compile(optimizer, loss="categorical_crossentropy",
-                  metrics=['categorical_accuracy', top_n_acc])
+    # Models holding weights while they are saved. Weights are saved for the
+    # RGB model at full resolution.
+    rgb_model = create_model(num_classes, pooling=pooling)
+    shadow_model = create_model(num_classes, pooling=pooling,
+                                channels=channels) \
+        if channels == 1 else rgb_model
 
-    # Callbacks. Save model weights every 2 epochs.
+    # Callbacks. Save model weights and training state every epoch.
     if weights is None:
         checkpoint_dir = model_dir + f"/cytoimagenet-weights/random_init/{dset}/"
         checkpoint_filename = checkpoint_dir + "efficientnetb0_from_random-epoch_{epoch:02d}.h5"
@@ -292,36 +631,97 @@ def main():
     # Check if model weights directory exists. If not, create
     if not os.path.exists(checkpoint_dir):
         os.mkdir(checkpoint_dir)
-
-    callbacks = [ModelCheckpoint(checkpoint_filename, monitor='loss', verbose=0,
-                                 save_best_only=False, save_weights_only=True,
-                                 save_freq='epoch')]
-                 # ReduceLROnPlateau(monitor='loss', factor=0.1, patience=5,
-                 #                   verbose=1,
-                 #                   min_lr=0.001)]
-
-    # Fit model
-    if split:
-        history = model.fit(ds_train,
-                            steps_per_epoch=steps_per_epoch_train,
-                            validation_data=ds_val,
-                            validation_steps=steps_per_epoch_val,
-                            epochs=num_epochs,
-                            callbacks=callbacks,
-                            verbose=1,
-                            use_multiprocessing=False
-                            )
-    else:
-        history = model.fit(ds_train,
-                            steps_per_epoch=steps_per_epoch_train,
-                            epochs=num_epochs,
-                            callbacks=callbacks,
-                            verbose=1,
-                            use_multiprocessing=False
-                            )
+    history_log = f"{checkpoint_dir}/history-log.csv"
+
+    # Resume from latest training state
+    initial_epoch = 0
+    state = None
+    state_path = latest_training_state(checkpoint_dir) if resume else None
+    if state_path is not None:
+        initial_epoch, *state = load_training_state(state_path)
+        print(f"Resuming training from epoch {initial_epoch}...")
+
+    model = None
+    for i, (first_epoch, image_size, stage_batch_size) in enumerate(schedule):
+        last_epoch = schedule[i + 1][0] if i + 1 < len(schedule) \
+            else num_epochs
+        if last_epoch <= initial_epoch:
+            continue
+        first_epoch = max(first_epoch, initial_epoch)
+        print(f"Training epochs {first_epoch}-{last_epoch} at "
+              f"{image_size}x{image_size} with batch size "
+              f"{stage_batch_size}...")
+
+        # Construct model. Weights and optimizer state are carried over from
+        # the last stage or training state.
+        if model is not None:
+            state = get_training_state(model)
+        stage_model = create_model(
+            num_classes, weights=weights if state is None else None,
+            pooling=pooling, channels=channels, image_size=image_size)
+
+        # Optimizer
+        optimizer = Adam(lr=learn_rate)
+        # optimizer = RMSprop(lr=learn_rate,
+        #                     decay=0.9,
+        #                     momentum=0.9)
+
+        # Metrics
+        top_n_acc = tf.keras.metrics.TopKCategoricalAccuracy(
+            k=7, name='top_k_categorical_accuracy', dtype=None)
+
+        # Compile
+        stage_model.compile(optimizer, loss="categorical_crossentropy",
+                            metrics=['categorical_accuracy', top_n_acc])
+        if state is not None:
+            set_training_state(stage_model, *state)
+        model = stage_model
+
+        callbacks = [AsyncCheckpoint(shadow_model, rgb_model,
+                                     checkpoint_filename, checkpoint_dir),
+                     CSVLogger(history_log, append=first_epoch > 0)]
+                     # ReduceLROnPlateau(monitor='loss', factor=0.1,
+                     #                   patience=5, verbose=1,
+                     #                   min_lr=0.001)]
+
+        # Get data generators
+        gens, steps = get_dset_generators(split=split,
+                                          num_classes=num_classes,
+                                          batch_size=stage_batch_size,
+                                          labels=classes, packed=packed,
+                                          channels=channels,
+                                          initial_epoch=first_epoch,
+                                          image_size=image_size)
+        ds_train, ds_val = gens
+        steps_per_epoch_train, steps_per_epoch_val = steps
+
+        # Fit model
+        if split:
+            model.fit(ds_train,
+                      steps_per_epoch=steps_per_epoch_train,
+                      validation_data=ds_val,
+                      validation_steps=steps_per_epoch_val,
+                      epochs=last_epoch,
+                      initial_epoch=first_epoch,
+                      callbacks=callbacks,
+                      verbose=1,
+                      use_multiprocessing=False
+                      )
+        else:
+            model.fit(ds_train,
+                      steps_per_epoch=steps_per_epoch_train,
+                      epochs=last_epoch,
+                      initial_epoch=first_epoch,
+                      callbacks=callbacks,
+                      verbose=1,
+                      use_multiprocessing=False
+                      )
+
+    # Training history, including epochs before resuming and earlier stages
+    hist_df = pd.read_csv(history_log).drop_duplicates('epoch', keep='last')
 
     # Create plot
-    plot_loss(history, weights, dset, split)
+    plot_loss(hist_df, weights, dset, split)
 
     # Save model weights & history
     if weights is None:
@@ -331,11 +731,18 @@ def main():
     if not os.path.exists(save_dir):
         os.mkdir(save_dir)
     # Save training history
-    hist_df = pd.DataFrame(history.history)
-    hist_df.to_csv(
+    hist_df.drop(columns='epoch').to_csv(
         f"{save_dir}/history{save_weights_suffix}.csv", index=False)
-    # Save weights
-    model.save_weights(
+    # Save weights. If training had already finished, use the weights of
+    # the training state.
+    if model is None:
+        model = shadow_model
+        model.set_weights(state[0])
+    if channels == 1:
+        copy_to_rgb_model(model, rgb_model)
+    elif model is not rgb_model:
+        rgb_model.set_weights(model.get_weights())
+    rgb_model.save_weights(
         f"{save_dir}/efficientnetb0_from_random{save_weights_suffix}.h5")
 
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Scripts are run from scripts/, so modules import each other from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
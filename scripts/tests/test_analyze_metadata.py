@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+pytest.importorskip("matplotlib")
+pytest.importorskip("seaborn")
+
+from data_curation import analyze_metadata
+
+
+def test_store_dtypes_round_trip(tmp_path):
+    df = pd.DataFrame({'idx': ['a', 'b', 'c', 'd'],
+                       'gene': ['x', 1.0, np.nan, 'x'],
+                       'microscopy': ['fluorescence'] * 4,
+                       'num': [1, 2, 3, 4]})
+    df['gene'] = df['gene'].astype(object)
+
+    df_store = analyze_metadata.to_store_dtypes(df)
+    assert isinstance(df_store['gene'].dtype, pd.CategoricalDtype)
+    assert isinstance(df_store['microscopy'].dtype, pd.CategoricalDtype)
+    assert not isinstance(df_store['idx'].dtype, pd.CategoricalDtype)
+
+    df_store.to_feather(tmp_path / "metadata.ftr")
+    df_read = pd.read_feather(tmp_path / "metadata.ftr")
+    assert df_read['gene'].tolist()[:2] == ['x', '1.0']
+    assert pd.isna(df_read['gene'].iloc[2])
+    assert df_read['idx'].tolist() == ['a', 'b', 'c', 'd']
+    assert df_read['num'].tolist() == [1, 2, 3, 4]
+
+
+def test_get_df_metadata_from_store(tmp_path, monkeypatch):
+    (tmp_path / "clean").mkdir()
+    pd.DataFrame({'idx': ['a1', 'a2'], 'gene': ['x', 'x'],
+                  'sirna': ['1', 'y']}) \
+        .to_csv(tmp_path / "clean" / "a_metadata.csv", index=False)
+    pd.DataFrame({'idx': ['b1'], 'gene': ['y|x'], 'sirna': [2]}) \
+        .to_csv(tmp_path / "clean" / "b_metadata.csv", index=False)
+    monkeypatch.setattr(analyze_metadata, 'annotations_dir', f"{tmp_path}/")
+    monkeypatch.setattr(analyze_metadata, 'metadata_store_path',
+                        f"{tmp_path}/clean_metadata.ftr")
+    monkeypatch.setattr(analyze_metadata, 'loaded_store', {})
+
+    df = analyze_metadata.get_df_metadata()
+    assert sorted(df['idx']) == ['a1', 'a2', 'b1']
+    assert not analyze_metadata.metadata_store_is_stale()
+
+    df = analyze_metadata.get_df_metadata(['gene'], categorical=True)
+    assert list(df.columns) == ['gene']
+    assert isinstance(df['gene'].dtype, pd.CategoricalDtype)
+    assert df['gene'].str.contains('x', na=False).astype(bool).all()
+
+    # Adding a source file recompiles the store
+    pd.DataFrame({'idx': ['c1'], 'gene': ['z'], 'sirna': ['3']}) \
+        .to_csv(tmp_path / "clean" / "c_metadata.csv", index=False)
+    assert analyze_metadata.metadata_store_is_stale()
+    assert len(analyze_metadata.get_df_metadata(['idx'])) == 4
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from tensorflow.keras.applications import EfficientNetB0
+
+from data_processing.grayscale_model import copy_to_rgb_model, \
+    to_grayscale_model
+
+image_size = 32
+
+
+def build(input_tensor=None):
+    """Return randomly initialized EfficientNetB0, as in model_pretraining."""
+    input_shape = (image_size, image_size, 3) if input_tensor is None \
+        else None
+    return EfficientNetB0(weights=None, include_top=False, pooling="avg",
+                          input_shape=input_shape, input_tensor=input_tensor)
+
+
+def test_rgb_model_matches_gray_model_after_training():
+    tf.random.set_seed(0)
+    rng = np.random.default_rng(0)
+    gray_model = to_grayscale_model(build(), build)
+    gray_model.compile(tf.keras.optimizers.SGD(0.1), loss="mse")
+
+    imgs = rng.uniform(0, 255, (4, image_size, image_size, 1)) \
+        .astype(np.float32)
+    targets = rng.normal(size=(4, gray_model.output_shape[-1])) \
+        .astype(np.float32)
+    kernel_before = gray_model.get_layer("stem_conv").get_weights()[0]
+    for _ in range(3):
+        gray_model.train_on_batch(imgs, targets)
+    kernel_after = gray_model.get_layer("stem_conv").get_weights()[0]
+    # Image channel trains, constant channel's response stays fixed
+    assert not np.allclose(kernel_before[:, :, 0], kernel_after[:, :, 0])
+    np.testing.assert_allclose(kernel_before[:, :, 1], kernel_after[:, :, 1],
+                               atol=1e-7)
+
+    rgb_model = copy_to_rgb_model(gray_model, build())
+    np.testing.assert_allclose(
+        rgb_model.predict_on_batch(np.repeat(imgs, 3, axis=-1)),
+        gray_model.predict_on_batch(imgs), rtol=1e-3, atol=1e-4)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+for module in ("tensorflow", "faiss", "cv2", "umap", "sklearn", "PIL",
+               "seaborn"):
+    pytest.importorskip(module)
+
+from model_evaluation import (BBBC021Protocol, distance_weights,
+                              masked_neighbors)
+
+
+def test_nsb_without_batches_raises():
+    protocol = object.__new__(BBBC021Protocol)
+    protocol.cytoimagenet_weights_suffix = ''
+    X = np.random.default_rng(0).normal(size=(6, 4))
+    with pytest.raises(ValueError, match="nsb"):
+        protocol.knn_classify(X, np.array(list("aabbcc")),
+                              np.array(list("xyzxyz")), 1, method='nsb',
+                              overwrite=True)
+
+
+def test_masked_neighbors_checks_groups():
+    X = np.random.default_rng(0).normal(size=(6, 4))
+    with pytest.raises(ValueError):
+        masked_neighbors(X, 1, groups=(np.arange(6), None))
+    with pytest.raises(ValueError):
+        masked_neighbors(X, 1, groups=(np.arange(5),))
+
+
+def test_masked_neighbors_excludes_groups():
+    X = np.random.default_rng(0).normal(size=(6, 4))
+    compounds = np.array([0, 0, 1, 1, 2, 2])
+    batches = np.array([0, 1, 0, 1, 0, 1])
+    _, neigh_ind = masked_neighbors(X, 2, groups=(compounds, batches))
+    for i, ind in enumerate(neigh_ind):
+        assert not np.any(compounds[ind] == compounds[i])
+        assert not np.any(batches[ind] == batches[i])
+
+
+def test_distance_weights_clip_and_exact_matches():
+    neigh_dist = np.array([[-1e-7, 0.5, np.inf],
+                           [0.5, 2., np.inf]])
+    np.testing.assert_array_equal(distance_weights(neigh_dist),
+                                  [[1., 0., 0.], [2., 0.5, 0.]])